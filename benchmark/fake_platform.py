@@ -0,0 +1,348 @@
+"""
+本地模拟直播平台，用于离线压测
+
+模拟各平台的直播检测接口，并以指定码率提供FLV和HLS（m3u8 + ts）直播流
+房间号以live开头的直播间视为正在直播，以push开头的直播间在启动push_after秒后开播，其余均为未开播
+/sub和/pubsub分别模拟哔哩哔哩弹幕服务器和Twitch PubSub的WebSocket开播推送
+
+python benchmark/fake_platform.py --port 18080 --bitrate 2000000
+"""
+import argparse
+import asyncio
+import base64
+import hashlib
+import json
+import struct
+import time
+import zlib
+from collections import defaultdict
+from urllib.parse import parse_qs, urlsplit
+
+HUYA_PADDING = "<div>" + "x" * 200 * 1024 + "</div>"
+WEBSOCKET_GUID = "258EAFA5-E914-47DA-95CA-C5AB0DC85B11"
+
+
+class FakePlatform:
+    def __init__(self, host, port, bitrate, segment_duration=2, live_duration=0, push_after=10, drop_after=0):
+        self.host = host
+        self.port = port
+        self.bitrate = bitrate
+        self.segment_duration = segment_duration
+        # 直播时长（秒），为0时一直直播
+        self.live_duration = live_duration
+        # push开头的直播间的开播时间（秒）
+        self.push_after = push_after
+        # 模拟直播流中断，FLV连接每隔drop_after秒断开，HLS播放列表每隔drop_after秒有2秒无法访问
+        self.drop_after = drop_after
+        self.started = time.monotonic()
+        self.stats = defaultdict(lambda: defaultdict(int))
+        self.requests = defaultdict(int)
+
+    @property
+    def base_url(self):
+        return f"http://{self.host}:{self.port}"
+
+    def live_at(self, room_id):
+        if str(room_id).startswith("push"):
+            return self.started + self.push_after
+        return None
+
+    def is_live(self, room_id):
+        if str(room_id).startswith("live"):
+            return True
+        return (live_at := self.live_at(room_id)) is not None and time.monotonic() >= live_at
+
+    def detect(self, room_id):
+        """记录从开播到第一次检测到开播的耗时"""
+        live = self.is_live(room_id)
+        if live and (live_at := self.live_at(room_id)) and "detect_latency" not in self.stats[room_id]:
+            self.stats[room_id]["detect_latency"] = time.monotonic() - live_at
+        return live
+
+    async def serve(self):
+        server = await asyncio.start_server(self.handle, self.host, self.port)
+        async with server:
+            await server.serve_forever()
+
+    async def handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                method, target, _ = request_line.decode().split(" ", 2)
+                headers = {}
+                while (line := await reader.readline()).strip():
+                    key, value = line.decode().split(":", 1)
+                    headers[key.strip().lower()] = value.strip()
+                body = b""
+                if length := int(headers.get("content-length", 0)):
+                    body = await reader.readexactly(length)
+                url = urlsplit(target)
+                host = headers.get("host", "").split(":")[0]
+                self.requests[host] += 1
+                if headers.get("upgrade", "").lower() == "websocket":
+                    await self.handle_websocket(reader, writer, url.path, headers)
+                    break
+                if url.path.startswith("/flv/"):
+                    await self.send_flv(writer, url.path)
+                    break
+                status, content_type, content, extra = self.route(method, host, url, body)
+                response_headers = (
+                    f"HTTP/1.1 {status}\r\nContent-Type: {content_type}\r\n"
+                    f"Content-Length: {len(content)}\r\n{extra}\r\n"
+                )
+                writer.write(response_headers.encode() + content)
+                await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+    def route(self, method, host, url, body):
+        params = {k: v[-1] for k, v in parse_qs(url.query).items()}
+        if url.path.startswith("/hls/"):
+            return self.route_hls(url.path)
+        if url.path == "/stats":
+            return self.json({"requests": self.requests, "streams": self.stats})
+        if host == "api.live.bilibili.com":
+            if url.path.endswith("getRoomBaseInfo"):
+                room_ids = parse_qs(url.query).get("room_ids", [])
+                return self.json({"code": 0, "data": {"by_room_ids": {
+                    i: {"room_id": i, "short_id": 0, "live_status": int(self.detect(i)), "title": "bench"} for i in room_ids
+                }}})
+            room_id = params.get("room_id")
+            return self.json({"code": 0, "data": {"room_id": room_id, "live_status": int(self.detect(room_id)), "title": "bench"}})
+        if host == "gql.twitch.tv":
+            return self.json([self.twitch(query["variables"]["channelLogin"]) for query in json.loads(body)])
+        if host == "www.huya.com":
+            return self.html(f'<html><script>"isOn":false,"introduction":"bench"</script>{HUYA_PADDING}</html>')
+        if host == "open.douyucdn.cn":
+            return self.json({"error": 0, "data": {"room_status": "2", "owner_name": "bench"}})
+        if host == "live.douyin.com":
+            if url.path == "/":
+                return "200 OK", "text/html", b"", "Set-Cookie: ttwid=bench; Path=/\r\n"
+            return self.json(self.douyin(params.get("web_rid")))
+        if host == "ta.bigo.tv":
+            room_id = params.get("siteId")
+            return self.json({"data": {
+                "alive": self.is_live(room_id),
+                "clientBigoId": room_id,
+                "country_code": "CN",
+                "hls_src": f"{self.base_url}/hls/{room_id}/index.m3u8",
+            }})
+        if host == "www.youtube.com":
+            return self.json({"contents": {}})
+        if host == "live.nicovideo.jp":
+            return self.html(f'<html>"content_status":"ENDED"{HUYA_PADDING}</html>')
+        if host == "twitcasting.tv":
+            return self.json({})
+        if host == "live.afreecatv.com":
+            return self.json({"CHANNEL": {"RESULT": 0}})
+        if host == "api.pandalive.co.kr":
+            return self.json({"result": False})
+        if host == "sketch.pixiv.net":
+            initial_state = json.dumps({"live": {"lives": {}}})
+            next_data = json.dumps({"props": {"pageProps": {"initialState": initial_state}}})
+            return self.html(f'<html>{HUYA_PADDING}<script id="__NEXT_DATA__" type="application/json">{next_data}</script></html>')
+        if host == "chaturbate.com":
+            return self.json({"room_status": "offline"})
+        if host == "stripchat.com":
+            return self.json({})
+        return "404 Not Found", "text/plain", b"Not Found", ""
+
+    @staticmethod
+    def json(data):
+        return "200 OK", "application/json", json.dumps(data).encode(), ""
+
+    @staticmethod
+    def html(text):
+        return "200 OK", "text/html; charset=utf-8", text.encode(), ""
+
+    def twitch(self, login):
+        stream = {"id": login, "type": "live"} if self.detect(login) else None
+        return {"data": {"user": {"id": login, "stream": stream}}}
+
+    def douyin(self, room_id):
+        if not self.is_live(room_id):
+            return {"data": {"data": [{"status": 4}]}}
+        stream_data = {"data": {"origin": {"main": {"flv": f"{self.base_url}/flv/{room_id}.flv"}}}}
+        return {"data": {"data": [{
+            "status": 2,
+            "title": "bench",
+            "stream_url": {"live_core_sdk_data": {"pull_data": {"stream_data": json.dumps(stream_data)}}},
+        }]}}
+
+    async def handle_websocket(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter, path, headers):
+        accept = base64.b64encode(hashlib.sha1((headers["sec-websocket-key"] + WEBSOCKET_GUID).encode()).digest())
+        writer.write(
+            b"HTTP/1.1 101 Switching Protocols\r\nUpgrade: websocket\r\nConnection: Upgrade\r\n"
+            b"Sec-WebSocket-Accept: " + accept + b"\r\n\r\n"
+        )
+        tasks = []
+        try:
+            while True:
+                opcode, data = await read_frame(reader)
+                if opcode == 8:
+                    break
+                if opcode == 9:
+                    writer.write(websocket_frame(10, data))
+                elif path == "/sub":
+                    self.bilibili_push(writer, data, tasks)
+                elif path == "/pubsub":
+                    self.twitch_push(writer, json.loads(data), tasks)
+                await writer.drain()
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    def bilibili_push(self, writer, data, tasks):
+        operation = struct.unpack(">I", data[8:12])[0]
+        if operation == 7:
+            room_id = json.loads(data[16:])["roomid"]
+            writer.write(websocket_frame(2, bilibili_packet(8, 0, b'{"code":0}')))
+            message = bilibili_packet(5, 2, zlib.compress(bilibili_packet(5, 0, json.dumps({"cmd": "LIVE"}).encode())))
+            tasks.append(asyncio.create_task(self.push_live(room_id, writer, websocket_frame(2, message))))
+        elif operation == 2:
+            writer.write(websocket_frame(2, bilibili_packet(3, 0, b"\x00\x00\x00\x01")))
+
+    def twitch_push(self, writer, message, tasks):
+        if message["type"] == "PING":
+            writer.write(websocket_frame(1, b'{"type":"PONG"}'))
+        elif message["type"] == "LISTEN":
+            writer.write(websocket_frame(1, json.dumps({"type": "RESPONSE", "nonce": message["nonce"], "error": ""}).encode()))
+            for topic in message["data"]["topics"]:
+                event = {"type": "MESSAGE", "data": {"topic": topic, "message": json.dumps({"type": "stream-up"})}}
+                frame = websocket_frame(1, json.dumps(event).encode())
+                tasks.append(asyncio.create_task(self.push_live(topic.rsplit(".", 1)[-1], writer, frame)))
+
+    async def push_live(self, room_id, writer: asyncio.StreamWriter, frame):
+        if (live_at := self.live_at(room_id)) is None:
+            return
+        await asyncio.sleep(max(live_at - time.monotonic(), 0))
+        writer.write(frame)
+        await writer.drain()
+
+    def is_ended(self):
+        return self.live_duration and time.monotonic() - self.started > self.live_duration
+
+    async def send_flv(self, writer: asyncio.StreamWriter, path):
+        stats = self.stats[path]
+        writer.write(b"HTTP/1.1 200 OK\r\nContent-Type: video/x-flv\r\nConnection: close\r\n\r\n")
+        writer.write(b"FLV\x01\x05\x00\x00\x00\x09\x00\x00\x00\x00")
+        writer.write(flv_tag(9, 0, b"\x17\x00\x00\x00\x00\x01\x64\x00\x1f"))
+        writer.write(flv_tag(8, 0, b"\xaf\x00\x12\x10"))
+        # 每40毫秒发送一帧视频，每2秒一个关键帧
+        frame_size = int(self.bitrate / 8 * 0.04)
+        start = time.monotonic()
+        frame = 0
+        while not self.is_ended():
+            if self.drop_after and time.monotonic() - start > self.drop_after:
+                stats["drops"] += 1
+                break
+            keyframe = frame % 50 == 0
+            data = (b"\x17\x01" if keyframe else b"\x27\x01") + b"\x00" * 3 + bytes(frame_size)
+            chunk = flv_tag(9, frame * 40, data) + flv_tag(8, frame * 40, b"\xaf\x01" + bytes(64))
+            writer.write(chunk)
+            await writer.drain()
+            stats["bytes_sent"] += len(chunk)
+            frame += 1
+            if (delay := start + frame * 0.04 - time.monotonic()) > 0:
+                await asyncio.sleep(delay)
+
+    def route_hls(self, path):
+        _, _, room_id, name = path.split("/", 3)
+        stats = self.stats[room_id]
+        sequence = int((time.monotonic() - self.started) / self.segment_duration)
+        stats["segments_published"] = sequence + 1
+        if name == "index.m3u8":
+            if self.drop_after and (time.monotonic() - self.started) % self.drop_after < 2:
+                return "503 Service Unavailable", "text/plain", b"", ""
+            first = max(sequence - 2, 0)
+            lines = [
+                "#EXTM3U",
+                "#EXT-X-VERSION:3",
+                f"#EXT-X-TARGETDURATION:{self.segment_duration}",
+                f"#EXT-X-MEDIA-SEQUENCE:{first}",
+            ]
+            for index in range(first, sequence + 1):
+                lines += [f"#EXTINF:{self.segment_duration:.3f},", f"{index}.ts"]
+            if self.is_ended():
+                lines.append("#EXT-X-ENDLIST")
+            return "200 OK", "application/vnd.apple.mpegurl", "\n".join(lines).encode(), ""
+        segment = ts_segment(int(self.bitrate / 8 * self.segment_duration))
+        stats["segments_served"] += 1
+        stats["bytes_sent"] += len(segment)
+        return "200 OK", "video/mp2t", segment, ""
+
+
+def flv_tag(tag_type, timestamp, data):
+    header = (
+        bytes((tag_type,))
+        + len(data).to_bytes(3, "big")
+        + (timestamp & 0xFFFFFF).to_bytes(3, "big")
+        + bytes((timestamp >> 24 & 0xFF,))
+        + b"\x00\x00\x00"
+    )
+    return header + data + (len(header) + len(data)).to_bytes(4, "big")
+
+
+async def read_frame(reader: asyncio.StreamReader):
+    first, second = await reader.readexactly(2)
+    length = second & 0x7F
+    if length == 126:
+        length = int.from_bytes(await reader.readexactly(2), "big")
+    elif length == 127:
+        length = int.from_bytes(await reader.readexactly(8), "big")
+    mask = await reader.readexactly(4) if second & 0x80 else bytes(4)
+    data = await reader.readexactly(length)
+    return first & 0x0F, bytes(b ^ mask[i % 4] for i, b in enumerate(data))
+
+
+def websocket_frame(opcode, data):
+    if len(data) < 126:
+        header = bytes((0x80 | opcode, len(data)))
+    elif len(data) < 65536:
+        header = bytes((0x80 | opcode, 126)) + len(data).to_bytes(2, "big")
+    else:
+        header = bytes((0x80 | opcode, 127)) + len(data).to_bytes(8, "big")
+    return header + data
+
+
+def bilibili_packet(operation, version, body):
+    return struct.pack(">IHHII", 16 + len(body), 16, version, operation, 1) + body
+
+
+def ts_packet(pid, payload_unit_start=False):
+    flags = 0x40 if payload_unit_start else 0
+    return bytes((0x47, flags | pid >> 8, pid & 0xFF, 0x10)) + b"\xff" * 184
+
+
+def ts_segment(size):
+    packets = [ts_packet(0, True), ts_packet(4096, True), ts_packet(256, True)]
+    packets += [ts_packet(256)] * max(size // 188 - 3, 0)
+    return b"".join(packets)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="本地模拟直播平台")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=18080)
+    parser.add_argument("--bitrate", type=int, default=2_000_000, help="直播流码率（bit/s）")
+    parser.add_argument("--segment-duration", type=int, default=2, help="HLS分片时长（秒）")
+    parser.add_argument("--live-duration", type=int, default=0, help="直播时长（秒），为0时一直直播")
+    parser.add_argument("--push-after", type=float, default=10, help="push开头的直播间的开播时间（秒）")
+    parser.add_argument("--drop-after", type=float, default=0, help="每隔多少秒模拟一次直播流中断，为0时不中断")
+    args = parser.parse_args()
+    platform = FakePlatform(
+        args.host, args.port, args.bitrate, args.segment_duration, args.live_duration, args.push_after, args.drop_after
+    )
+    print(f"模拟直播平台已启动：{platform.base_url}", flush=True)
+    try:
+        asyncio.run(platform.serve())
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
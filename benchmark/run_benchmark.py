@@ -0,0 +1,238 @@
+"""
+离线压测，使用本地模拟直播平台运行live_recorder
+
+python benchmark/run_benchmark.py --rooms 500 --live 20 --duration 60
+python benchmark/run_benchmark.py --rooms 500 --live 20 --output result.json --compare baseline.json
+python benchmark/run_benchmark.py --rooms 100 --live 0 --push 10 --extra-config '{"push": true}'
+python benchmark/run_benchmark.py --rooms 20 --live 4 --drop-after 8 --extra-config '{"reconnect_window": 30}'
+python benchmark/run_benchmark.py --rooms 20 --live 4 --sinks 3 --extra-config '{"serve_port": 18090}'
+python benchmark/run_benchmark.py --rooms 40 --live 40 --extra-config '{"write_buffer": 4, "preallocate": 64, "fsync_interval": 10}'
+"""
+import argparse
+import asyncio
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+import httpx
+from loguru import logger
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+import live_recorder  # noqa: E402
+
+# 只检测直播状态的平台
+POLL_PLATFORMS = ["Bilibili", "Twitch", "Huya", "Douyu", "Douyin", "Youtube", "Niconico", "Afreeca", "Pixivsketch", "Chaturbate"]
+# 可以录制模拟直播流的平台，Douyin为FLV，Bigolive为HLS
+LIVE_PLATFORMS = ["Douyin", "Bigolive"]
+# 支持开播推送的平台，这些直播间在启动push_after秒后开播
+PUSH_PLATFORMS = ["Bilibili", "Twitch"]
+# 对比基准时允许的性能下降比例
+TOLERANCE = 0.2
+
+
+class RewriteTransport(httpx.AsyncBaseTransport):
+    """将所有请求转发到本地模拟平台，并记录请求耗时"""
+
+    def __init__(self, transport: httpx.AsyncBaseTransport, port):
+        self.transport = transport
+        self.port = port
+        self.latencies = []
+
+    async def handle_async_request(self, request):
+        host = request.url.host
+        # asyncio录制引擎直接请求本地直播流，不计入检测请求
+        if host == "127.0.0.1":
+            return await self.transport.handle_async_request(request)
+        request.url = request.url.copy_with(scheme="http", host="127.0.0.1", port=self.port)
+        request.headers["Host"] = host
+        start = time.perf_counter()
+        response = await self.transport.handle_async_request(request)
+        self.latencies.append(time.perf_counter() - start)
+        return response
+
+    async def aclose(self):
+        await self.transport.aclose()
+
+
+def percentile(values, percent):
+    if not values:
+        return 0
+    values = sorted(values)
+    return values[min(int(len(values) * percent / 100), len(values) - 1)]
+
+
+def get_rss():
+    # 当前常驻内存（MB）
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 1024 ** 2
+    except OSError:
+        try:
+            import resource
+        except ImportError:
+            return 0
+        rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return rss / 1024 ** 2 if sys.platform == "darwin" else rss / 1024
+
+
+def make_config(args, output):
+    users = []
+    for index in range(args.live):
+        # 每个直播间额外录制到sinks - 1个输出，共用一个下载
+        outputs = [{"output": f"{output}/sink{sink}"} for sink in range(1, args.sinks)]
+        users.append({
+            "platform": LIVE_PLATFORMS[index % len(LIVE_PLATFORMS)], "id": f"live{index}", "name": f"live{index}", "outputs": outputs,
+        })
+    for index in range(args.push):
+        users.append({"platform": PUSH_PLATFORMS[index % len(PUSH_PLATFORMS)], "id": f"push{index}", "name": f"push{index}"})
+    for index in range(args.rooms - args.live - args.push):
+        users.append({"platform": POLL_PLATFORMS[index % len(POLL_PLATFORMS)], "id": f"room{index}", "name": f"room{index}"})
+    config = {
+        "output": output,
+        "interval": args.interval,
+        "max_recordings": max(args.live, 1),
+        "Bilibili_push_url": f"ws://127.0.0.1:{args.port}/sub",
+        "Twitch_push_url": f"ws://127.0.0.1:{args.port}/pubsub",
+        "user": users,
+    }
+    config.update(json.loads(args.extra_config))
+    return config
+
+
+def sum_metric(name):
+    return sum(live_recorder.metrics.counters.get(name, {}).values())
+
+
+async def run_recorder(config_path, duration):
+    try:
+        await asyncio.wait_for(live_recorder.run(config_path), duration)
+    except asyncio.TimeoutError:
+        pass
+
+
+def run_benchmark(args):
+    workdir = tempfile.mkdtemp(prefix="liverecorder_bench_")
+    config = make_config(args, str(Path(workdir, "output")))
+    # 录制日志和ffmpeg封装队列保存到临时目录
+    config.setdefault("cache_dir", str(Path(workdir, "cache")))
+    config_path = Path(workdir, "config.json")
+    config_path.write_text(json.dumps(config), encoding="utf-8")
+
+    server = subprocess.Popen(
+        [
+            sys.executable, str(Path(__file__).with_name("fake_platform.py")),
+            "--port", str(args.port), "--bitrate", str(args.bitrate), "--push-after", str(args.push_after),
+            "--drop-after", str(args.drop_after),
+        ],
+        stdout=subprocess.PIPE,
+    )
+    try:
+        server.stdout.readline()
+        transports = []
+
+        def wrapper(transport):
+            transport = RewriteTransport(transport, args.port)
+            transports.append(transport)
+            return transport
+
+        live_recorder.client_pool.transport_wrapper = wrapper
+        rss_start = get_rss()
+        cpu_start = time.process_time()
+        start = time.monotonic()
+        asyncio.run(run_recorder(str(config_path), args.duration))
+        elapsed = time.monotonic() - start
+        cpu = time.process_time() - cpu_start
+        rss = get_rss() - rss_start
+        stream_stats = httpx.get(f"http://127.0.0.1:{args.port}/stats").json()["streams"]
+        output_files = sum(1 for path in Path(workdir, "output").rglob("*") if path.is_file())
+    finally:
+        server.terminate()
+        server.wait()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    latencies = [latency for transport in transports for latency in transport.latencies]
+    written = sum_metric("liverecorder_written_bytes_total")
+    published = sum(stats.get("segments_published", 0) for stats in stream_stats.values())
+    served = sum(stats.get("segments_served", 0) for stats in stream_stats.values())
+    live = max(args.live, 1)
+    detect_latencies = [stats["detect_latency"] for stats in stream_stats.values() if "detect_latency" in stats]
+    return {
+        "rooms": args.rooms,
+        "live": args.live,
+        "duration": round(elapsed, 2),
+        "polls": len(latencies),
+        "polls_per_second": round(len(latencies) / elapsed, 2),
+        "poll_mb": round(sum_metric("liverecorder_poll_bytes_total") / 1024 ** 2, 2),
+        "poll_mb_saved": round(sum_metric("liverecorder_poll_bytes_saved_total") / 1024 ** 2, 2),
+        "poll_early_exits": int(sum_metric("liverecorder_poll_early_exits_total")),
+        "poll_latency_p50_ms": round(percentile(latencies, 50) * 1000, 2),
+        "poll_latency_p95_ms": round(percentile(latencies, 95) * 1000, 2),
+        "poll_latency_p99_ms": round(percentile(latencies, 99) * 1000, 2),
+        "cpu_percent": round(cpu / elapsed * 100, 2),
+        "cpu_percent_per_stream": round(cpu / elapsed * 100 / live, 2),
+        "rss_mb": round(rss, 2),
+        "rss_mb_per_stream": round(rss / live, 2),
+        "write_mbps": round(written * 8 / elapsed / 1024 ** 2, 2),
+        "expected_write_mbps": round(args.bitrate * args.live / 1024 ** 2, 2),
+        "write_stalls": sum_metric("liverecorder_write_stalls_total"),
+        "disk_write_mb": round(sum_metric("liverecorder_disk_written_bytes_total") / 1024 ** 2, 2),
+        "hls_segments_dropped": max(published - served, 0),
+        "reconnects": sum_metric("liverecorder_reconnects_total"),
+        "output_files": output_files,
+        "sink_spilled_mb": round(sum_metric("liverecorder_sink_spilled_bytes_total") / 1024 ** 2, 2),
+        "push_detected": len(detect_latencies),
+        "push_detect_latency_s": round(sum(detect_latencies) / len(detect_latencies), 2) if detect_latencies else 0,
+    }
+
+
+def compare(result, baseline):
+    """与基准结果对比，返回超出允许范围的指标"""
+    regressions = []
+    for key in ("poll_latency_p95_ms", "cpu_percent_per_stream", "rss_mb_per_stream", "write_stalls", "hls_segments_dropped"):
+        if result[key] > baseline.get(key, 0) * (1 + TOLERANCE) and result[key] - baseline.get(key, 0) > 1:
+            regressions.append(f"{key}: {baseline.get(key)} -> {result[key]}")
+    if result["polls_per_second"] < baseline.get("polls_per_second", 0) * (1 - TOLERANCE):
+        regressions.append(f"polls_per_second: {baseline['polls_per_second']} -> {result['polls_per_second']}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="LiveRecorder离线压测")
+    parser.add_argument("--rooms", type=int, default=200, help="直播间总数")
+    parser.add_argument("--live", type=int, default=10, help="正在直播的直播间数量")
+    parser.add_argument("--push", type=int, default=0, help="启动后开播的哔哩哔哩和Twitch直播间数量")
+    parser.add_argument("--push-after", type=float, default=10, help="push直播间的开播时间（秒）")
+    parser.add_argument("--drop-after", type=float, default=0, help="每隔多少秒模拟一次直播流中断，为0时不中断")
+    parser.add_argument("--sinks", type=int, default=1, help="每个正在直播的直播间的输出数量")
+    parser.add_argument("--duration", type=float, default=60, help="压测时长（秒）")
+    parser.add_argument("--interval", type=float, default=5, help="检测间隔（秒）")
+    parser.add_argument("--bitrate", type=int, default=2_000_000, help="直播流码率（bit/s）")
+    parser.add_argument("--port", type=int, default=18080)
+    parser.add_argument("--extra-config", default="{}", help="额外的配置，JSON格式")
+    parser.add_argument("--output", help="保存压测结果的JSON文件")
+    parser.add_argument("--compare", help="用于对比的基准结果JSON文件")
+    args = parser.parse_args()
+    args.live = min(args.live, args.rooms)
+    args.push = min(args.push, args.rooms - args.live)
+
+    logger.remove()
+    logger.add(sys.stderr, level="WARNING")
+    result = run_benchmark(args)
+    for key, value in result.items():
+        print(f"{key:<24}{value}")
+    if args.output:
+        Path(args.output).write_text(json.dumps(result, indent=2), encoding="utf-8")
+    if args.compare:
+        regressions = compare(result, json.loads(Path(args.compare).read_text(encoding="utf-8")))
+        if regressions:
+            print("性能下降：\n" + "\n".join(regressions))
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
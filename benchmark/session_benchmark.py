@@ -0,0 +1,93 @@
+"""
+Streamlink会话缓存压测，对比每次检测新建会话和使用缓存会话时解析插件和请求本地服务器的耗时，并检查不同平台的会话互不影响
+
+python benchmark/session_benchmark.py --runs 50
+"""
+import argparse
+import statistics
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+import live_recorder  # noqa: E402
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    # 响应头和内容一次发送，避免保持连接时受Nagle算法和延迟确认影响
+    wbufsize = -1
+
+    def do_GET(self):
+        self.send_response(200)
+        self.send_header("Content-Length", "2")
+        self.end_headers()
+        self.wfile.write(b"ok")
+
+    def log_message(self, *args):
+        pass
+
+
+def new_recorder(platform, room_id):
+    config = {"user": [{"platform": platform, "id": room_id}]}
+    return live_recorder.platforms[platform](config, config["user"][0])
+
+
+def measure(get_session, url, runs):
+    """返回解析插件和请求本地服务器（含建立连接）耗时的中位数（毫秒）"""
+    resolve, request = [], []
+    for _ in range(runs):
+        start = time.perf_counter()
+        session = get_session()
+        session.resolve_url("https://live.bilibili.com/1")
+        resolved = time.perf_counter()
+        session.http.get(url)
+        requested = time.perf_counter()
+        resolve.append((resolved - start) * 1000)
+        request.append((requested - resolved) * 1000)
+    return round(statistics.median(resolve), 3), round(statistics.median(request), 3)
+
+
+def check_isolation():
+    """插件修改会话请求头后不影响其他平台，Afreeca每个直播间使用独立的会话"""
+    twitch, douyin = new_recorder("Twitch", "a"), new_recorder("Douyin", "1")
+    twitch.get_streamlink().http.headers.update({"Referer": "https://player.twitch.tv"})
+    afreeca = [new_recorder("Afreeca", room_id) for room_id in ("a", "b")]
+    return (
+        "Referer" not in douyin.get_streamlink().http.headers
+        and twitch.get_streamlink() is new_recorder("Twitch", "b").get_streamlink()
+        and afreeca[0].get_streamlink() is not afreeca[1].get_streamlink()
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Streamlink会话缓存压测")
+    parser.add_argument("--runs", type=int, default=50, help="运行次数，结果取中位数")
+    args = parser.parse_args()
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = f"http://127.0.0.1:{server.server_address[1]}/"
+    recorder = new_recorder("Bilibili", "1")
+    new_resolve, new_request = measure(recorder.new_streamlink, url, args.runs)
+    cached_resolve, cached_request = measure(recorder.get_streamlink, url, args.runs)
+    server.shutdown()
+    isolated = check_isolation()
+
+    for key, value in {
+        "new_resolve_ms": new_resolve,
+        "new_request_ms": new_request,
+        "cached_resolve_ms": cached_resolve,
+        "cached_request_ms": cached_request,
+        "sessions_isolated": isolated,
+    }.items():
+        print(f"{key:<24}{value}")
+    if not isolated:
+        print("不同平台的会话请求头互相影响")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
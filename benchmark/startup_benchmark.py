@@ -0,0 +1,98 @@
+"""
+启动耗时压测，在新的Python进程中导入live_recorder、检查配置并创建所有直播间
+
+python benchmark/startup_benchmark.py --rooms 500 --platform Bilibili
+python benchmark/startup_benchmark.py --output startup.json --compare startup_baseline.json
+"""
+import argparse
+import json
+import statistics
+import subprocess
+import sys
+import time
+from pathlib import Path
+
+# 只录制哔哩哔哩时启动阶段不应导入的模块
+LAZY_MODULES = ["streamlink", "streamlink_cli", "ffmpeg", "jsengine", "httpx_socks", "wsproto", "requests"]
+# 对比基准时允许的性能下降比例
+TOLERANCE = 0.2
+
+
+def measure(rooms, platform):
+    """在子进程中运行，输出各阶段耗时（毫秒）和已导入的模块"""
+    start = time.perf_counter()
+    sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+    import live_recorder
+
+    imported = time.perf_counter()
+    config = {"user": [{"platform": platform, "id": str(index), "name": f"room{index}"} for index in range(rooms)]}
+    live_recorder.validate_config(config)
+    validated = time.perf_counter()
+    recorders = [live_recorder.platforms[item["platform"]](config, item) for item in config["user"]]
+    created = time.perf_counter()
+    print(json.dumps({
+        "import_ms": (imported - start) * 1000,
+        "validate_ms": (validated - imported) * 1000,
+        "create_ms": (created - validated) * 1000,
+        "startup_ms": (created - start) * 1000,
+        "recorders": len(recorders),
+        "lazy_imported": [name for name in LAZY_MODULES if name in sys.modules],
+    }))
+
+
+def run_benchmark(args):
+    results = []
+    for _ in range(args.runs):
+        output = subprocess.run(
+            [sys.executable, __file__, "--child", "--rooms", str(args.rooms), "--platform", args.platform],
+            check=True,
+            capture_output=True,
+            text=True,
+        ).stdout
+        results.append(json.loads(output.splitlines()[-1]))
+    result = {"rooms": args.rooms, "platform": args.platform, "runs": args.runs}
+    for key in ("import_ms", "validate_ms", "create_ms", "startup_ms"):
+        result[key] = round(statistics.median(item[key] for item in results), 2)
+    result["lazy_imported"] = results[-1]["lazy_imported"]
+    return result
+
+
+def compare(result, baseline):
+    """与基准结果对比，返回超出允许范围的指标"""
+    regressions = []
+    for key in ("import_ms", "startup_ms"):
+        if result[key] > baseline.get(key, 0) * (1 + TOLERANCE) and result[key] - baseline.get(key, 0) > 20:
+            regressions.append(f"{key}: {baseline.get(key)} -> {result[key]}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="LiveRecorder启动耗时压测")
+    parser.add_argument("--rooms", type=int, default=500, help="直播间数量")
+    parser.add_argument("--platform", default="Bilibili", help="直播平台")
+    parser.add_argument("--runs", type=int, default=5, help="运行次数，结果取中位数")
+    parser.add_argument("--output", help="保存压测结果的JSON文件")
+    parser.add_argument("--compare", help="用于对比的基准结果JSON文件")
+    parser.add_argument("--child", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.child:
+        measure(args.rooms, args.platform)
+        return
+
+    result = run_benchmark(args)
+    for key, value in result.items():
+        print(f"{key:<24}{value}")
+    if args.output:
+        Path(args.output).write_text(json.dumps(result, indent=2), encoding="utf-8")
+    regressions = []
+    if args.platform == "Bilibili" and result["lazy_imported"]:
+        regressions.append(f"启动时导入了{', '.join(result['lazy_imported'])}")
+    if args.compare:
+        regressions += compare(result, json.loads(Path(args.compare).read_text(encoding="utf-8")))
+    if regressions:
+        print("性能下降：\n" + "\n".join(regressions))
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
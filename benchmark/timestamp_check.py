@@ -0,0 +1,117 @@
+"""
+TS时间戳修复检查，构造带B帧、时间戳跳变和33位回绕的TS包，检查修复后的PCR、PTS和DTS
+
+python benchmark/timestamp_check.py
+"""
+import sys
+from pathlib import Path
+from types import SimpleNamespace
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+from live_recorder import Output, TimestampFixOutput  # noqa: E402
+
+VIDEO_PID = 256
+# 33位时间戳的取值范围
+MODULO = 1 << 33
+
+
+class MemoryOutput(Output):
+    def __init__(self):
+        super().__init__()
+        self.data = bytearray()
+
+    def _open(self):
+        pass
+
+    def _close(self):
+        pass
+
+    def _write(self, data):
+        self.data += data
+
+
+def pes_packet(pts, dts=None, pcr=None):
+    """视频PID的负载单元起始TS包，dts为None时只有PTS，pcr不为None时带有自适应字段"""
+    header = bytearray((0x47, 0x40 | VIDEO_PID >> 8, VIDEO_PID & 0xFF, 0x10))
+    if pcr is not None:
+        header[3] = 0x30
+        header += bytes((7, 0x10)) + (pcr << 15 | 0x7E00).to_bytes(6, "big")
+    flags = 0xC0 if dts is not None else 0x80
+    pes = bytearray(b"\x00\x00\x01\xe0\x00\x00\x80" + bytes((flags, 10 if dts is not None else 5)))
+    pes += bytes(5)
+    TimestampFixOutput.write_pts(pes, 9, pts)
+    pes[9] = pes[9] & 0x0F | (0x30 if dts is not None else 0x20)
+    if dts is not None:
+        pes += bytes(5)
+        TimestampFixOutput.write_pts(pes, 14, dts)
+        pes[14] = pes[14] & 0x0F | 0x10
+    packet = header + pes
+    return bytes(packet + b"\xff" * (188 - len(packet)))
+
+
+def read_packet(packet):
+    """返回TS包中的(PTS, DTS, PCR)，没有的字段为None"""
+    payload = 4
+    pcr = None
+    if packet[3] & 0x20:
+        if packet[5] & 0x10:
+            pcr = int.from_bytes(packet[6:11], "big") >> 7
+        payload += 1 + packet[4]
+    pts = TimestampFixOutput.read_pts(packet, payload + 9)
+    dts = TimestampFixOutput.read_pts(packet, payload + 14) if packet[payload + 7] & 0x40 else None
+    return pts, dts, pcr
+
+
+def run(packets):
+    recorder = SimpleNamespace(flag="[检查]", platform="Check", id="0")
+    memory = MemoryOutput()
+    output = TimestampFixOutput(memory, Path("check.ts"), "ts", recorder)
+    output.open()
+    output.write(b"".join(packets))
+    output.close()
+    return [read_packet(memory.data[index:index + 188]) for index in range(0, len(memory.data), 188)]
+
+
+def check_bframes():
+    """B帧的PTS小于前一帧，DTS单调递增，时间戳不应被修改"""
+    frames = [(15015, 6006), (9009, None), (12012, 12012), (27027, 15015), (21021, None), (24024, 24024)]
+    result = run([pes_packet(pts, dts) for pts, dts in frames])
+    return result == [(pts, dts, None) for pts, dts in frames]
+
+
+def check_jump():
+    """DTS跳变后接在上一帧之后，PTS和DTS的差值不变"""
+    frames = [(index * 3003 + 6006, index * 3003) for index in range(5)]
+    frames += [(index * 3003 + 6006 + 900000000, index * 3003 + 900000000) for index in range(5)]
+    result = run([pes_packet(pts, dts) for pts, dts in frames])
+    dts = [item[1] for item in result]
+    return all(b - a == 3003 for a, b in zip(dts, dts[1:])) and all(pts - dts == 6006 for pts, dts, _ in result)
+
+
+def check_wrap():
+    """33位时间戳正常回绕时不视为跳变"""
+    frames = [((MODULO - 6006 + index * 3003) % MODULO, None) for index in range(5)]
+    result = run([pes_packet(pts, dts) for pts, dts in frames])
+    return result == [(pts, dts, None) for pts, dts in frames]
+
+
+def check_pcr():
+    """PCR先于PES跳变时按PCR修正，之后的PES使用同一个修正量，跳变处的间隔不超过1秒"""
+    packets = [pes_packet(index * 3003 + 9000, pcr=index * 3003) for index in range(5)]
+    packets += [pes_packet(index * 3003 + 9000 + 900000000, pcr=index * 3003 + 900000000) for index in range(5)]
+    result = run(packets)
+    pcr = [item[2] for item in result]
+    return all(0 < b - a <= 90000 for a, b in zip(pcr, pcr[1:])) and all(pts - pcr == 9000 for pts, _, pcr in result)
+
+
+def main():
+    failed = 0
+    for check in (check_bframes, check_jump, check_wrap, check_pcr):
+        ok = check()
+        failed += not ok
+        print(f"{check.__name__:<16}{'通过' if ok else '失败'}")
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
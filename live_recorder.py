@@ -1,79 +1,2831 @@
 import asyncio
+import copy
+import heapq
+import importlib.util
+import itertools
 import json
+import multiprocessing
 import os
+import random
+import platform
+import queue
 import re
+import shutil
+import signal
+import socket
+import struct
+import subprocess
+import tempfile
+import threading
 import time
 import uuid
+import zlib
+from abc import ABCMeta, abstractmethod
+from collections import defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager, contextmanager
+from functools import partial
 from http.cookies import SimpleCookie
 from pathlib import Path
-from typing import Dict, Tuple, Union
-from urllib.parse import parse_qs
+from typing import TYPE_CHECKING, Awaitable, Callable, Dict, List, Optional, Set, Tuple, Type, Union
+from urllib.parse import parse_qs, urljoin, urlsplit
 
 import anyio
-import ffmpeg
 import httpx
-import jsengine
-import streamlink
-from httpx_socks import AsyncProxyTransport
-from jsonpath_ng.ext import parse
 from loguru import logger
-from streamlink.options import Options
-from streamlink.stream import StreamIO, HTTPStream, HLSStream
-from streamlink_cli.main import open_stream
-from streamlink_cli.output import FileOutput
-from streamlink_cli.streamrunner import StreamRunner
 
-from icecream import ic
+# streamlink、ffmpeg-python、jsengine、httpx-socks和wsproto导入较慢，在用到时才导入
+if TYPE_CHECKING:
+    import streamlink.session
+    from streamlink.stream import StreamIO, HTTPStream, HLSStream
 
-recording: Dict[str, Tuple[StreamIO, FileOutput]] = {}
+recording: Dict[str, Tuple["StreamIO", "Output"]] = {}
+
+
+class Metrics:
+    """Prometheus文本格式的运行指标，可通过HTTP接口查看"""
+
+    buckets = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters: Dict[str, Dict[tuple, float]] = defaultdict(lambda: defaultdict(float))
+        self.gauges: Dict[str, Dict[tuple, float]] = defaultdict(dict)
+        self.histograms: Dict[str, Dict[tuple, list]] = defaultdict(dict)
+        self.collectors: List[Callable[[], None]] = []
+        self.server = None
+
+    @staticmethod
+    def get_labels(labels: dict) -> tuple:
+        return tuple(sorted(labels.items()))
+
+    def inc(self, name, value=1, **labels):
+        with self.lock:
+            self.counters[name][self.get_labels(labels)] += value
+
+    def set(self, name, value, **labels):
+        with self.lock:
+            self.gauges[name][self.get_labels(labels)] = value
+
+    def observe(self, name, value, **labels):
+        key = self.get_labels(labels)
+        with self.lock:
+            # 各分桶的计数、总和与总数
+            histogram = self.histograms[name].setdefault(key, [[0] * len(self.buckets), 0.0, 0])
+            for index, bucket in enumerate(self.buckets):
+                if value <= bucket:
+                    histogram[0][index] += 1
+            histogram[1] += value
+            histogram[2] += 1
+
+    def add_collector(self, collector: Callable[[], None]):
+        """注册在每次输出指标前调用的函数，用于更新全局状态的指标"""
+        self.collectors.append(collector)
+
+    @staticmethod
+    def format_labels(labels: tuple, extra=()):
+        items = []
+        for k, v in labels + extra:
+            v = str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+            items.append(f'{k}="{v}"')
+        return "{" + ",".join(items) + "}" if items else ""
+
+    def render(self) -> str:
+        for collector in self.collectors:
+            collector()
+        lines = []
+        with self.lock:
+            for name, values in self.counters.items():
+                lines.append(f"# TYPE {name} counter")
+                lines.extend(f"{name}{self.format_labels(k)} {v}" for k, v in values.items())
+            for name, values in self.gauges.items():
+                lines.append(f"# TYPE {name} gauge")
+                lines.extend(f"{name}{self.format_labels(k)} {v}" for k, v in values.items())
+            for name, values in self.histograms.items():
+                lines.append(f"# TYPE {name} histogram")
+                for k, (counts, total, count) in values.items():
+                    for bucket, bucket_count in zip(self.buckets, counts):
+                        lines.append(f"{name}_bucket{self.format_labels(k, (('le', bucket),))} {bucket_count}")
+                    lines.append(f'{name}_bucket{self.format_labels(k, (("le", "+Inf"),))} {count}')
+                    lines.append(f"{name}_sum{self.format_labels(k)} {total}")
+                    lines.append(f"{name}_count{self.format_labels(k)} {count}")
+        return "\n".join(lines) + "\n"
+
+    async def serve(self, host, port):
+        self.server = await asyncio.start_server(self.handle, host, port)
+        logger.info(f"运行指标接口已启动：http://{host}:{port}/metrics")
+
+    async def handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            request_line = await reader.readline()
+            # 忽略请求头
+            while (await reader.readline()).strip():
+                pass
+            if request_line.split(b" ")[1:2] == [b"/metrics"]:
+                status, body = "200 OK", self.render().encode()
+            else:
+                status, body = "404 Not Found", b"Not Found\n"
+            writer.write(
+                f"HTTP/1.1 {status}\r\nContent-Type: text/plain; version=0.0.4; charset=utf-8\r\n"
+                f"Content-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode() + body
+            )
+            await writer.drain()
+        except (ConnectionError, IndexError):
+            pass
+        finally:
+            writer.close()
+
+
+metrics = Metrics()
+
+
+class Profiler:
+    """按需开启的cProfile性能分析，只分析事件循环线程（直播检测和asyncio录制引擎），报告保存到logs目录"""
+
+    def __init__(self):
+        self.profile = None
+        self.output_dir = Path("logs")
+        self.timer: Optional[asyncio.TimerHandle] = None
+
+    def install(self, duration=0):
+        """收到SIGUSR1时开始或结束分析，duration大于0时立即开始并在该秒数后结束"""
+        loop = asyncio.get_running_loop()
+        if hasattr(signal, "SIGUSR1"):
+            loop.add_signal_handler(signal.SIGUSR1, self.toggle)
+        if duration:
+            self.start(duration)
+
+    def toggle(self):
+        if self.profile:
+            self.stop()
+        else:
+            self.start()
+
+    def start(self, duration=0):
+        import cProfile
+
+        self.profile = cProfile.Profile()
+        self.profile.enable()
+        if duration:
+            self.timer = asyncio.get_running_loop().call_later(duration, self.stop)
+        logger.info(f"开始性能分析{f'，{duration}秒后' if duration else '，再次发送SIGUSR1后'}保存报告")
+
+    def stop(self):
+        import io
+        import pstats
+
+        if not self.profile:
+            return
+        profile, self.profile = self.profile, None
+        profile.disable()
+        if self.timer:
+            self.timer.cancel()
+            self.timer = None
+        self.output_dir.mkdir(parents=True, exist_ok=True)
+        path = Path(self.output_dir, f"profile_{time.strftime('%Y-%m-%d_%H%M%S')}_{os.getpid()}")
+        # .prof文件可使用snakeviz等工具查看
+        profile.dump_stats(path.with_suffix(".prof"))
+        report = io.StringIO()
+        stats = pstats.Stats(profile, stream=report)
+        stats.sort_stats("cumulative").print_stats(40)
+        stats.sort_stats("tottime").print_stats(40)
+        path.with_suffix(".txt").write_text(report.getvalue(), encoding="utf-8")
+        logger.info(f"性能分析报告已保存：{path.with_suffix('.txt')}")
+
+
+profiler = Profiler()
+
+
+class HostLimitTransport(httpx.AsyncBaseTransport):
+    """限制同一主机的并发请求数，响应关闭后才释放名额"""
+
+    def __init__(self, transport: httpx.AsyncBaseTransport, max_per_host: int):
+        self.transport = transport
+        self.semaphores = defaultdict(lambda: asyncio.Semaphore(max_per_host))
+
+    async def handle_async_request(self, request):
+        semaphore = self.semaphores[request.url.host]
+        await semaphore.acquire()
+        try:
+            response = await self.transport.handle_async_request(request)
+        except BaseException:
+            semaphore.release()
+            raise
+        response.stream = HostLimitStream(response.stream, semaphore)
+        return response
+
+    async def aclose(self):
+        await self.transport.aclose()
+
+
+class HostLimitStream(httpx.AsyncByteStream):
+    def __init__(self, stream, semaphore: asyncio.Semaphore):
+        self.stream = stream
+        self.semaphore = semaphore
+        self.released = False
+
+    async def __aiter__(self):
+        async for chunk in self.stream:
+            yield chunk
+
+    async def aclose(self):
+        try:
+            await self.stream.aclose()
+        finally:
+            if not self.released:
+                self.released = True
+                self.semaphore.release()
+
+
+class ClientPool:
+    """所有直播间共享的httpx客户端池，按代理、请求头和Cookie区分"""
+
+    def __init__(self):
+        self.clients: Dict[tuple, httpx.AsyncClient] = {}
+        self.refs: Dict[tuple, int] = defaultdict(int)
+        # 每次重建客户端时加一，直播间按检测开始时的代数判断是否需要重建
+        self.generations: Dict[tuple, int] = defaultdict(int)
+        # 每个客户端上正在进行的请求数，被替换的客户端在请求全部结束后才关闭
+        self.active: Dict[httpx.AsyncClient, int] = defaultdict(int)
+        self.retired: Set[httpx.AsyncClient] = set()
+        self.hits = 0
+        self.misses = 0
+        self.max_per_host = 20
+        self.max_keepalive = 100
+        self.keepalive_expiry = 30
+        # 可替换底层transport，用于压测时将请求转发到本地模拟服务器
+        self.transport_wrapper: Optional[Callable[[httpx.AsyncBaseTransport], httpx.AsyncBaseTransport]] = None
+
+    def configure(self, config: dict):
+        self.max_per_host = config.get("http_max_connections_per_host", self.max_per_host)
+        self.max_keepalive = config.get("http_max_keepalive", self.max_keepalive)
+        self.keepalive_expiry = config.get("http_keepalive_expiry", self.keepalive_expiry)
+
+    @staticmethod
+    def get_key(proxy, headers, cookies, stream=False):
+        return (
+            proxy,
+            tuple(sorted((headers or {}).items())),
+            tuple(sorted((cookies or {}).items())),
+            stream,
+        )
+
+    def acquire(self, key) -> httpx.AsyncClient:
+        if key in self.clients:
+            self.hits += 1
+        else:
+            self.misses += 1
+            self.clients[key] = self.new_client(key)
+        self.refs[key] += 1
+        return self.clients[key]
+
+    async def release(self, key):
+        self.refs[key] -= 1
+        if self.refs[key] <= 0:
+            self.refs.pop(key)
+            self.generations.pop(key, None)
+            if client := self.clients.pop(key, None):
+                await self.retire(client)
+
+    async def reset(self, key, generation: int):
+        # 多个直播间同时报错时只重建一次
+        if key in self.clients and self.generations[key] == generation:
+            self.generations[key] += 1
+            client, self.clients[key] = self.clients[key], self.new_client(key)
+            await self.retire(client)
+
+    async def retire(self, client: httpx.AsyncClient):
+        if self.active.get(client):
+            self.retired.add(client)
+        else:
+            await client.aclose()
+
+    @asynccontextmanager
+    async def use(self, key):
+        """取出当前的客户端用于一次请求，请求期间客户端被替换时，等请求结束后再关闭"""
+        client = self.clients[key]
+        self.active[client] += 1
+        try:
+            yield client
+        finally:
+            self.active[client] -= 1
+            if self.active[client] <= 0:
+                self.active.pop(client)
+                if client in self.retired:
+                    self.retired.discard(client)
+                    await client.aclose()
+
+    def new_client(self, key) -> httpx.AsyncClient:
+        proxy, headers, cookies, stream = key
+        transport_kwargs = {
+            "http2": True,
+            "limits": httpx.Limits(
+                max_keepalive_connections=self.max_keepalive,
+                keepalive_expiry=self.keepalive_expiry,
+            ),
+        }
+        # 检查是否有设置代理
+        if proxy and "socks" in proxy:
+            from httpx_socks import AsyncProxyTransport
+
+            transport = AsyncProxyTransport.from_url(proxy, **transport_kwargs)
+        else:
+            transport = httpx.AsyncHTTPTransport(proxy=proxy, **transport_kwargs)
+        if self.transport_wrapper:
+            transport = self.transport_wrapper(transport)
+        # 下载直播流的连接会长时间占用，不限制同一主机的并发数
+        if not stream:
+            transport = HostLimitTransport(transport, self.max_per_host)
+        return httpx.AsyncClient(
+            transport=transport,
+            timeout=30 if stream else 15,
+            headers=dict(headers),
+            cookies=dict(cookies),
+        )
+
+    def stats(self):
+        return {
+            "clients": len(self.clients),
+            "hits": self.hits,
+            "misses": self.misses,
+        }
+
+
+client_pool = ClientPool()
+
+
+class BatchPoller(metaclass=ABCMeta):
+    """将同一平台、同一客户端下到期的直播间合并为一次状态请求"""
+
+    pollers: Dict[tuple, "BatchPoller"] = {}
+    max_batch_size = 50
+
+    def __init__(self, batch_size, delay):
+        self.batch_size = min(batch_size, self.max_batch_size)
+        self.delay = delay
+        self.pending: Dict[str, Tuple["LiveRecoder", asyncio.Future]] = {}
+        self.timer: Optional[asyncio.TimerHandle] = None
+        self.tasks = set()
+
+    @classmethod
+    def get(cls, recorder: "LiveRecoder") -> Optional["BatchPoller"]:
+        if recorder.batch_size <= 1:
+            return None
+        key = (recorder.platform, recorder.client_key)
+        if key not in cls.pollers:
+            cls.pollers[key] = cls(recorder.batch_size, recorder.batch_delay)
+        return cls.pollers[key]
+
+    async def query(self, recorder: "LiveRecoder"):
+        """返回直播间状态，批量结果中不存在该直播间时返回None"""
+        # 配置中的房间号可能是数字，统一按字符串与接口返回的结果对应
+        room_id = str(recorder.id)
+        if room_id in self.pending:
+            # 同一直播间重复配置时共用一个结果
+            future = self.pending[room_id][1]
+        else:
+            future = asyncio.get_running_loop().create_future()
+            self.pending[room_id] = (recorder, future)
+            if len(self.pending) >= self.batch_size:
+                self.flush()
+            elif self.timer is None:
+                self.timer = asyncio.get_running_loop().call_later(self.delay, self.flush)
+        return await asyncio.shield(future)
+
+    def flush(self):
+        if self.timer:
+            self.timer.cancel()
+            self.timer = None
+        batch, self.pending = self.pending, {}
+        task = asyncio.create_task(self.send(batch))
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    async def send(self, batch):
+        # 使用批次中第一个直播间的客户端发送请求
+        recorder = next(iter(batch.values()))[0]
+        try:
+            await scheduler.get_bucket(recorder.platform).acquire()
+            results = await self.fetch(recorder, list(batch))
+        except Exception as error:
+            for _, future in batch.values():
+                if not future.done():
+                    future.set_exception(error)
+            return
+        logger.debug(f"{recorder.platform} 批量检测{len(batch)}个直播间，返回{len(results)}个结果")
+        results = {str(room_id): result for room_id, result in results.items()}
+        for room_id, (_, future) in batch.items():
+            if not future.done():
+                future.set_result(results.get(room_id))
+
+    @abstractmethod
+    async def fetch(self, recorder: "LiveRecoder", ids: List[str]) -> dict:
+        """请求一批直播间的状态，返回以字符串房间号为键的结果"""
+        raise NotImplementedError
+
+
+class BilibiliBatchPoller(BatchPoller):
+    async def fetch(self, recorder, ids):
+        response = (
+            await recorder.request(
+                method="GET",
+                url="https://api.live.bilibili.com/xlive/web-room/v1/index/getRoomBaseInfo",
+                params={"req_biz": "web_room_componet", "room_ids": ids},
+            )
+        ).json()
+        results = {}
+        for data in (response["data"]["by_room_ids"] or {}).values():
+            results[str(data["room_id"])] = data
+            # 配置中可能填写的是短号
+            if data.get("short_id"):
+                results[str(data["short_id"])] = data
+        return results
+
+
+class TwitchBatchPoller(BatchPoller):
+    # Twitch GQL单次请求最多支持35个查询
+    max_batch_size = 35
+
+    async def fetch(self, recorder, ids):
+        response = (
+            await recorder.request(
+                method="POST",
+                url="https://gql.twitch.tv/gql",
+                headers={"Client-Id": Twitch.client_id},
+                json=[Twitch.stream_metadata_query(login) for login in ids],
+            )
+        ).json()
+        return dict(zip(ids, response))
+
+
+class TokenBucket:
+    """令牌桶，rate为每秒请求数，为0时不限速"""
+
+    def __init__(self, rate, burst=None):
+        self.rate = rate
+        self.capacity = max(burst or rate, 1)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+
+    def update(self, rate, burst=None):
+        """修改限速，保留已有的令牌，等待中的请求下次醒来时使用新的限速"""
+        self.rate = rate
+        self.capacity = max(burst or rate, 1)
+        self.tokens = min(self.tokens, self.capacity)
+
+    async def acquire(self):
+        while self.rate:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return
+            await asyncio.sleep((1 - self.tokens) / self.rate)
+
+
+class PollState:
+    def __init__(self, offset):
+        self.next_poll = time.monotonic() + offset
+        self.errors = 0
+        self.wakeup = asyncio.Event()
+
+
+class PollScheduler:
+    """统一调度所有直播间的检测时间，按平台限速并将检测均匀分散到检测间隔内"""
+
+    # 黄金分割序列，任意数量的直播间都能较均匀地分布
+    golden_ratio = 0.618033988749895
+
+    def __init__(self):
+        self.config = {}
+        self.states: Dict["LiveRecoder", PollState] = {}
+        self.buckets: Dict[str, TokenBucket] = {}
+        self.counts: Dict[str, int] = defaultdict(int)
+        self.lags: Dict[str, float] = defaultdict(float)
+        self.waiting = 0
+        self.started = time.time()
+
+    def configure(self, config: dict):
+        self.config = config
+        # 重新加载配置时已创建的令牌桶同样使用新的限速
+        for platform_name, bucket in self.buckets.items():
+            bucket.update(*self.get_rate(platform_name))
+
+    def get_rate(self, platform_name) -> Tuple[float, Optional[float]]:
+        rate = self.config.get(f"{platform_name}_rate_limit", self.config.get("rate_limit", 0))
+        burst = self.config.get(f"{platform_name}_rate_burst", self.config.get("rate_burst"))
+        return rate, burst
+
+    def get_bucket(self, platform) -> TokenBucket:
+        if platform not in self.buckets:
+            self.buckets[platform] = TokenBucket(*self.get_rate(platform))
+        return self.buckets[platform]
+
+    def register(self, recorder: "LiveRecoder"):
+        index = self.counts[recorder.platform]
+        self.counts[recorder.platform] += 1
+        offset = (index * self.golden_ratio) % 1 * recorder.interval
+        self.states[recorder] = PollState(offset)
+
+    def unregister(self, recorder: "LiveRecoder"):
+        self.states.pop(recorder, None)
+
+    def wake(self, recorder: "LiveRecoder"):
+        """立即检测该直播间，用于收到开播通知等场景"""
+        if state := self.states.get(recorder):
+            state.next_poll = time.monotonic()
+            state.wakeup.set()
+
+    async def wait(self, recorder: "LiveRecoder"):
+        state = self.states[recorder]
+        if (delay := state.next_poll - time.monotonic()) > 0:
+            try:
+                await asyncio.wait_for(state.wakeup.wait(), delay)
+            except asyncio.TimeoutError:
+                pass
+        state.wakeup.clear()
+        self.waiting += 1
+        try:
+            # 批量检测时每次批量请求占用一个令牌，不按直播间占用
+            if not recorder.get_batch_poller():
+                await self.get_bucket(recorder.platform).acquire()
+        finally:
+            self.waiting -= 1
+        lag = max(time.monotonic() - state.next_poll, 0)
+        self.lags[recorder.platform] = lag
+        if lag > recorder.interval:
+            logger.warning(f"{recorder.flag} 直播检测调度延迟{lag:.1f}秒，请调大检测间隔或限速")
+
+    def done(self, recorder: "LiveRecoder", error=False):
+        state = self.states[recorder]
+        state.errors = state.errors + 1 if error else 0
+        interval = self.next_interval(recorder, state)
+        jitter = self.config.get("poll_jitter", 0.1)
+        interval *= random.uniform(1 - jitter, 1 + jitter)
+        state.next_poll = time.monotonic() + interval
+
+    def next_interval(self, recorder: "LiveRecoder", state: PollState):
+        interval = recorder.interval
+        if state.errors:
+            # 出错后指数退避
+            return min(interval * 2 ** state.errors, self.config.get("max_backoff", 300))
+        if recorder.push_connected:
+            # 已订阅开播推送时检测只作为兜底
+            return max(interval, self.config.get("push_interval", 120))
+        if not self.config.get("adaptive_interval", False):
+            return interval
+        now = time.time()
+        # 接近主播常用开播时间时加快检测
+        local = time.localtime(now)
+        minutes = local.tm_hour * 60 + local.tm_min
+        for live_start in recorder.live_starts:
+            start = time.localtime(live_start)
+            distance = abs(minutes - start.tm_hour * 60 - start.tm_min)
+            if min(distance, 1440 - distance) <= 30:
+                return max(interval / 2, self.config.get("min_interval", 5))
+        # 长时间未开播时放慢检测，每多一天增加一倍间隔，最多4倍
+        offline_days = (now - (recorder.last_live or self.started)) / 86400
+        return interval * min(1 + int(offline_days), 4)
+
+    def stats(self):
+        return {
+            "rooms": len(self.states),
+            "waiting": self.waiting,
+            "lag": dict(self.lags),
+        }
+
+
+scheduler = PollScheduler()
+
+
+class RecordingSupervisor:
+    """录制专用线程池，超出线程数的录制按优先级排队，避免占用默认线程池"""
+
+    def __init__(self):
+        self.max_workers = 32
+        self.max_queued = 100
+        self.executor: Optional[ThreadPoolExecutor] = None
+        self.active = 0
+        self.queue: List[Tuple[int, int, asyncio.Future, "LiveRecoder"]] = []
+        self.counter = itertools.count()
+
+    def configure(self, config: dict):
+        self.max_workers = config.get("max_recordings", self.max_workers)
+        self.max_queued = config.get("max_queued_recordings", self.max_queued)
+
+    def get_executor(self) -> ThreadPoolExecutor:
+        if self.executor is None:
+            self.executor = ThreadPoolExecutor(self.max_workers, thread_name_prefix="recording")
+        return self.executor
+
+    async def run(self, recorder: "LiveRecoder", func, *args):
+        if self.active >= self.max_workers:
+            if len(self.queue) >= self.max_queued:
+                # 排队已满时挤掉优先级最低且最晚排队的录制，没有更低优先级的录制时放弃本次录制
+                lowest = max(self.queue) if self.queue else None
+                if lowest is None or lowest[0] <= -recorder.priority:
+                    logger.error(f"{recorder.flag} 录制排队已满（{len(self.queue)}），放弃本次录制")
+                    return
+                self.queue.remove(lowest)
+                heapq.heapify(self.queue)
+                lowest[2].set_result(False)
+                logger.error(f"{lowest[3].flag} 录制排队已满，被优先级更高的{recorder.flag}挤出，放弃本次录制")
+            future = asyncio.get_running_loop().create_future()
+            entry = (-recorder.priority, next(self.counter), future, recorder)
+            heapq.heappush(self.queue, entry)
+            logger.warning(
+                f"{recorder.flag} 录制线程已满（{self.active}/{self.max_workers}），排队等待，当前排队{len(self.queue)}"
+            )
+            try:
+                if not await future:
+                    return
+            except asyncio.CancelledError:
+                if entry in self.queue:
+                    self.queue.remove(entry)
+                    heapq.heapify(self.queue)
+                if future.done() and not future.cancelled() and future.result():
+                    # 已分配到线程但任务被取消，交给下一个排队的录制，被挤出排队的录制没有占用线程
+                    self.release()
+                raise
+        else:
+            self.active += 1
+        logger.info(f"{recorder.flag} 当前录制数：{self.active}，排队数：{len(self.queue)}")
+        try:
+            return await asyncio.get_running_loop().run_in_executor(self.get_executor(), func, *args)
+        finally:
+            self.release()
+
+    def release(self):
+        # 空出的线程直接交给优先级最高的排队录制
+        while self.queue:
+            future = heapq.heappop(self.queue)[2]
+            if not future.done():
+                future.set_result(True)
+                return
+        self.active -= 1
+
+    def stats(self):
+        return {
+            "active": self.active,
+            "queued": len(self.queue),
+            "max_workers": self.max_workers,
+        }
+
+
+supervisor = RecordingSupervisor()
+
+
+class SessionCache:
+    """按平台、代理、请求头和Cookie缓存Streamlink会话，复用已加载的插件和HTTP连接
+
+    streamlink插件会修改会话的请求头（如Referer、Origin和User-Agent），不同平台不能共用会话
+    """
+
+    def __init__(self):
+        self.sessions: Dict[tuple, "streamlink.session.Streamlink"] = {}
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, factory) -> "streamlink.session.Streamlink":
+        if key in self.sessions:
+            self.hits += 1
+        else:
+            self.misses += 1
+            self.sessions[key] = factory()
+        return self.sessions[key]
+
+    def invalidate(self, client_key):
+        # 删除使用该客户端配置的所有会话，正在录制的直播流仍持有旧会话，不主动关闭
+        for key in [key for key in self.sessions if key[-1] == client_key]:
+            del self.sessions[key]
+
+    def stats(self):
+        return {
+            "sessions": len(self.sessions),
+            "hits": self.hits,
+            "misses": self.misses,
+        }
+
+
+session_cache = SessionCache()
+
+
+class DnsCache:
+    """缓存DNS解析结果，替换socket.getaddrinfo后streamlink和httpx建立新连接时都无需重复解析，默认不开启
+
+    getaddrinfo不返回DNS记录的TTL，所有域名统一缓存ttl秒
+    """
+
+    def __init__(self):
+        self.ttl = 0
+        self.size = 1024
+        self.entries: Dict[tuple, Tuple[float, list]] = {}
+        self.lock = threading.Lock()
+        self.getaddrinfo = socket.getaddrinfo
+        self.installed = False
+        self.hits = 0
+        self.misses = 0
+
+    def configure(self, config: dict):
+        self.ttl = config.get("dns_cache_ttl", 0)
+        self.size = config.get("dns_cache_size", self.size)
+        if self.ttl and not self.installed:
+            socket.getaddrinfo = self.cached_getaddrinfo
+            self.installed = True
+        elif not self.ttl and self.installed:
+            socket.getaddrinfo = self.getaddrinfo
+            self.installed = False
+            with self.lock:
+                self.entries.clear()
+
+    def cached_getaddrinfo(self, host, port, family=0, type=0, proto=0, flags=0):
+        # anyio传入的域名为bytes
+        key = (host.decode() if isinstance(host, bytes) else host, port, family, type, proto, flags)
+        with self.lock:
+            entry = self.entries.get(key)
+        if entry and entry[0] > time.monotonic():
+            self.hits += 1
+            return entry[1]
+        self.misses += 1
+        # 解析失败时不缓存
+        result = self.getaddrinfo(host, port, family, type, proto, flags)
+        with self.lock:
+            self.entries.pop(key, None)
+            if len(self.entries) >= self.size:
+                self.evict()
+            self.entries[key] = (time.monotonic() + self.ttl, result)
+        return result
+
+    def evict(self):
+        """缓存已满时先删除过期的记录，仍然超过上限时删除最早加入的记录"""
+        now = time.monotonic()
+        for key in [key for key, (expires, _) in self.entries.items() if expires <= now]:
+            del self.entries[key]
+        while len(self.entries) >= self.size:
+            del self.entries[next(iter(self.entries))]
+
+    def stats(self):
+        return {
+            "hosts": len(self.entries),
+            "hits": self.hits,
+            "misses": self.misses,
+        }
+
+
+dns_cache = DnsCache()
+
+
+class WebSocket:
+    """基于wsproto的简易WebSocket客户端，用于订阅直播平台的开播推送"""
+
+    def __init__(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        self.reader = reader
+        self.writer = writer
+        from wsproto import ConnectionType, WSConnection
+
+        self.connection = WSConnection(ConnectionType.CLIENT)
+        self.events = deque()
+
+    @classmethod
+    async def connect(cls, url, headers: dict = None, timeout=10) -> "WebSocket":
+        from wsproto.events import AcceptConnection, RejectConnection, Request
+
+        parts = urlsplit(url)
+        secure = parts.scheme == "wss"
+        reader, writer = await asyncio.wait_for(
+            asyncio.open_connection(parts.hostname, parts.port or (443 if secure else 80), ssl=secure or None),
+            timeout,
+        )
+        websocket = cls(reader, writer)
+        target = parts.path or "/"
+        if parts.query:
+            target += f"?{parts.query}"
+        extra_headers = [(k.encode(), v.encode()) for k, v in (headers or {}).items()]
+        try:
+            await websocket.send_event(Request(host=parts.netloc, target=target, extra_headers=extra_headers))
+            event = await asyncio.wait_for(websocket.next_event(), timeout)
+        except BaseException:
+            websocket.close()
+            raise
+        if not isinstance(event, AcceptConnection):
+            websocket.close()
+            status = event.status_code if isinstance(event, RejectConnection) else event
+            raise ConnectionError(f"WebSocket连接被拒绝：{status}")
+        return websocket
+
+    async def send_event(self, event):
+        self.writer.write(self.connection.send(event))
+        await self.writer.drain()
+
+    async def next_event(self):
+        while not self.events:
+            data = await self.reader.read(65536)
+            self.connection.receive_data(data or None)
+            self.events.extend(self.connection.events())
+            if not data and not self.events:
+                raise ConnectionError("WebSocket连接已断开")
+        return self.events.popleft()
+
+    async def send(self, message: Union[str, bytes]):
+        from wsproto.events import BytesMessage, TextMessage
+
+        await self.send_event(TextMessage(message) if isinstance(message, str) else BytesMessage(message))
+
+    async def recv(self) -> Union[str, bytes]:
+        from wsproto.events import BytesMessage, CloseConnection, Ping, TextMessage
+
+        parts = []
+        while True:
+            event = await self.next_event()
+            if isinstance(event, Ping):
+                await self.send_event(event.response())
+            elif isinstance(event, CloseConnection):
+                raise ConnectionError(f"WebSocket连接已关闭：{event.code} {event.reason}")
+            elif isinstance(event, (TextMessage, BytesMessage)):
+                parts.append(event.data)
+                if event.message_finished:
+                    return "".join(parts) if isinstance(event, TextMessage) else b"".join(parts)
+
+    async def iter_messages(self, interval, heartbeat: Union[str, bytes]):
+        """持续接收消息，每隔interval秒发送一次心跳"""
+        last_heartbeat = 0
+        while True:
+            if (timeout := last_heartbeat + interval - time.monotonic()) <= 0:
+                await self.send(heartbeat)
+                last_heartbeat = time.monotonic()
+                continue
+            try:
+                yield await asyncio.wait_for(self.recv(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+    def close(self):
+        self.writer.close()
+
+
+class PubSubConnection:
+    def __init__(self):
+        self.topics: Dict[str, "LiveRecoder"] = {}
+        self.websocket: Optional[WebSocket] = None
+        self.task: Optional[asyncio.Task] = None
+
+
+class TwitchPubSub:
+    """所有Twitch直播间共用PubSub连接订阅开播通知，每个连接最多订阅50个主题"""
+
+    max_topics = 50
+
+    def __init__(self):
+        self.url = "wss://pubsub-edge.twitch.tv/v1"
+        self.connections: List[PubSubConnection] = []
+
+    def configure(self, config: dict):
+        self.url = config.get("Twitch_push_url", self.url)
+
+    async def listen(self, recorder: "LiveRecoder", channel_id):
+        topic = f"video-playback-by-id.{channel_id}"
+        connection = next((c for c in self.connections if len(c.topics) < self.max_topics), None)
+        if connection is None:
+            connection = PubSubConnection()
+            self.connections.append(connection)
+            connection.task = asyncio.create_task(self.run(connection))
+        connection.topics[topic] = recorder
+        if connection.websocket:
+            await self.send(connection, "LISTEN", [topic])
+            recorder.push_connected = True
+        try:
+            await asyncio.Event().wait()
+        finally:
+            recorder.push_connected = False
+            connection.topics.pop(topic, None)
+            if not connection.topics:
+                connection.task.cancel()
+                self.connections.remove(connection)
+
+    async def run(self, connection: PubSubConnection):
+        errors = 0
+        while connection.topics:
+            try:
+                connection.websocket = await WebSocket.connect(self.url)
+                await self.send(connection, "LISTEN", list(connection.topics))
+                errors = 0
+                for recorder in connection.topics.values():
+                    recorder.push_connected = True
+                # 至少每5分钟发送一次PING
+                async for message in connection.websocket.iter_messages(240, json.dumps({"type": "PING"})):
+                    if not self.handle(connection, json.loads(message)):
+                        break
+            except (OSError, ConnectionError, ValueError, asyncio.TimeoutError) as error:
+                logger.warning(f"Twitch开播推送连接断开\n{repr(error)}")
+            finally:
+                if connection.websocket:
+                    connection.websocket.close()
+                    connection.websocket = None
+                for recorder in connection.topics.values():
+                    recorder.push_connected = False
+            errors += 1
+            await asyncio.sleep(min(2 ** errors, 120))
+
+    @staticmethod
+    async def send(connection: PubSubConnection, message_type, topics):
+        await connection.websocket.send(json.dumps({"type": message_type, "nonce": uuid.uuid4().hex, "data": {"topics": topics}}))
+
+    @staticmethod
+    def handle(connection: PubSubConnection, message: dict) -> bool:
+        # 服务器要求重连时返回False
+        if message.get("type") == "RECONNECT":
+            return False
+        if message.get("type") == "MESSAGE":
+            data = message["data"]
+            if (recorder := connection.topics.get(data["topic"])) and json.loads(data["message"]).get("type") == "stream-up":
+                recorder.push_live()
+        return True
+
+
+twitch_pubsub = TwitchPubSub()
+
+
+class PostProcessQueue:
+    """ffmpeg封装任务队列，任务保存到本地文件，重启后继续执行"""
+
+    def __init__(self):
+        self.workers = 2
+        self.max_attempts = 3
+        self.retry_delay = 60
+        self.job_file = Path("cache", "postprocess.json")
+        self.jobs: Dict[str, dict] = {}
+        self.queue: "queue.Queue[str]" = queue.Queue()
+        self.lock = threading.Lock()
+        self.threads: List[threading.Thread] = []
+        self.running = 0
+        self.durations = deque(maxlen=100)
+
+    def configure(self, config: dict):
+        self.workers = config.get("ffmpeg_workers", self.workers)
+        self.max_attempts = config.get("ffmpeg_max_attempts", self.max_attempts)
+        self.job_file = Path(config.get("cache_dir", "cache"), "postprocess.json")
+        if self.job_file.exists():
+            with open(self.job_file, "r", encoding="utf-8") as f:
+                self.jobs = json.load(f)
+            if self.jobs:
+                logger.info(f"恢复{len(self.jobs)}个未完成的ffmpeg封装任务")
+            for job_id in self.jobs:
+                self.queue.put(job_id)
+        self.start()
+
+    def start(self):
+        while len(self.threads) < self.workers:
+            thread = threading.Thread(target=self.worker, name="ffmpeg", daemon=True)
+            thread.start()
+            self.threads.append(thread)
+
+    def submit(self, flag, source, target):
+        job_id = uuid.uuid4().hex
+        with self.lock:
+            self.jobs[job_id] = {"flag": flag, "source": source, "target": target, "attempts": 0}
+            self.save()
+        self.queue.put(job_id)
+        self.start()
+        logger.info(f"{flag} 加入ffmpeg封装队列：{source}，当前排队{self.queue.qsize()}")
+
+    def save(self):
+        self.job_file.parent.mkdir(parents=True, exist_ok=True)
+        temp_file = self.job_file.with_suffix(".tmp")
+        with open(temp_file, "w", encoding="utf-8") as f:
+            json.dump(self.jobs, f, ensure_ascii=False, indent=2)
+        os.replace(temp_file, self.job_file)
+
+    def worker(self):
+        while True:
+            job_id = self.queue.get()
+            job = self.jobs[job_id]
+            self.running += 1
+            start = time.monotonic()
+            try:
+                # 录制文件可能还在从临时目录移动到输出目录
+                disk_writer.wait_moved(job["source"])
+                self.run_ffmpeg(job)
+            except FileNotFoundError:
+                logger.error(f"{job['flag']} ffmpeg封装的原始文件不存在，跳过：{job['source']}")
+            except Exception as error:
+                job["attempts"] += 1
+                if job["attempts"] < self.max_attempts:
+                    logger.warning(f"{job['flag']} ffmpeg封装失败，{self.retry_delay}秒后重试：{job['source']}\n{error}")
+                    timer = threading.Timer(self.retry_delay, self.queue.put, (job_id,))
+                    timer.daemon = True
+                    timer.start()
+                    with self.lock:
+                        self.save()
+                    continue
+                logger.error(f"{job['flag']} ffmpeg封装失败，已保留原始文件：{job['source']}\n{error}")
+            else:
+                duration = time.monotonic() - start
+                self.durations.append(duration)
+                logger.info(
+                    f"{job['flag']} ffmpeg封装完成，耗时{duration:.1f}秒，剩余{self.queue.qsize()}个任务：{job['target']}"
+                )
+            finally:
+                self.running -= 1
+            with self.lock:
+                self.jobs.pop(job_id, None)
+                self.save()
+
+    @staticmethod
+    def run_ffmpeg(job):
+        if not os.path.exists(job["source"]):
+            raise FileNotFoundError(job["source"])
+        logger.info(f"{job['flag']} 开始ffmpeg封装：{job['source']}")
+        import ffmpeg
+
+        command = ffmpeg.input(job["source"], flags="global_header").output(
+            job["target"],
+            codec="copy",
+            map_metadata="-1",
+            movflags="faststart",
+        ).global_args("-hide_banner", "-loglevel", "error").overwrite_output().compile()
+        kwargs = {}
+        # 降低ffmpeg的CPU和磁盘IO优先级，避免影响正在录制的直播
+        if platform.system() == "Windows":
+            kwargs["creationflags"] = subprocess.BELOW_NORMAL_PRIORITY_CLASS
+        else:
+            if shutil.which("ionice"):
+                command = ["ionice", "-c", "3"] + command
+            if shutil.which("nice"):
+                command = ["nice", "-n", "10"] + command
+        result = subprocess.run(command, stdin=subprocess.DEVNULL, stderr=subprocess.PIPE, **kwargs)
+        if result.returncode:
+            raise RuntimeError(result.stderr.decode("utf-8", "replace").strip())
+        os.remove(job["source"])
+
+    def stats(self):
+        return {
+            "queued": self.queue.qsize(),
+            "running": self.running,
+            "jobs": len(self.jobs),
+            "avg_duration": sum(self.durations) / len(self.durations) if self.durations else 0,
+        }
+
+
+postprocessor = PostProcessQueue()
+
+
+class RecordingJournal:
+    """只追加写入的录制日志，记录开始、结束录制和文件大小，程序崩溃或被强制结束后重启时恢复"""
+
+    # 写入超过该行数后只保留未结束的记录重写日志
+    compact_lines = 10000
+
+    def __init__(self):
+        self.path = Path("cache", "recordings.jsonl")
+        self.interval = 60
+        self.lock = threading.Lock()
+        self.file = None
+        self.lines = 0
+        # 正在录制的直播间和文件，与日志内容一致
+        self.rooms: Dict[str, dict] = {}
+        self.files: Dict[str, dict] = {}
+        # 上次退出时仍在录制的直播间，启动后立即检测
+        self.live_rooms: set = set()
+        self.thread: Optional[threading.Thread] = None
+
+    def configure(self, config: dict):
+        self.path = Path(config.get("cache_dir", "cache"), "recordings.jsonl")
+        self.interval = config.get("journal_interval", self.interval)
+        self.restore()
+        if not self.thread:
+            self.thread = threading.Thread(target=self.run_checkpoint, name="journal", daemon=True)
+            self.thread.start()
+
+    def restore(self):
+        rooms: Dict[str, dict] = {}
+        files: Dict[str, dict] = {}
+        if self.path.exists():
+            with open(self.path, "r", encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        event = json.loads(line)
+                    except json.JSONDecodeError:
+                        # 崩溃时最后一行可能只写入了一部分
+                        continue
+                    self.replay(event, rooms, files)
+        self.live_rooms = set(rooms)
+        if rooms:
+            logger.info(f"上次退出时有{len(rooms)}个直播间正在录制，启动后立即检测：{'、'.join(rooms)}")
+        for path, item in files.items():
+            if (scratch := item.get("scratch")) and os.path.exists(scratch) and not os.path.exists(path):
+                try:
+                    shutil.move(scratch, path)
+                except OSError as error:
+                    logger.error(f"{item['flag']} 移动录制文件失败，文件保留在：{scratch}\n{error}")
+                    continue
+            if not os.path.exists(path):
+                continue
+            if item.get("preallocated"):
+                self.trim_padding(path)
+            logger.warning(f"{item['flag']} 上次退出时录制文件未正常结束，已写入{os.path.getsize(path)}字节：{path}")
+            # 结束录制前已加入ffmpeg封装队列的文件无需重复封装
+            if item.get("target") and all(job["source"] != path for job in postprocessor.jobs.values()):
+                postprocessor.submit(item["flag"], path, item["target"])
+        with self.lock:
+            self.rooms, self.files = {}, {}
+            self.rewrite()
+
+    @staticmethod
+    def trim_padding(path):
+        """去掉预分配后未写入的末尾空白，FLV以非零的标签长度结尾，TS补齐到完整的包"""
+        with open(path, "r+b") as f:
+            size = end = f.seek(0, os.SEEK_END)
+            while end > 0:
+                start = max(end - 1024 ** 2, 0)
+                f.seek(start)
+                if data := f.read(end - start).rstrip(b"\0"):
+                    end = start + len(data)
+                    break
+                end = start
+            if str(path).endswith(".ts"):
+                end = min(-(-end // 188) * 188, size)
+            f.truncate(end)
+
+    @staticmethod
+    def replay(event: dict, rooms: Dict[str, dict], files: Dict[str, dict]):
+        kind = event.get("event")
+        if kind == "start":
+            rooms[event["room"]] = event
+        elif kind == "end":
+            rooms.pop(event["room"], None)
+            for path in [path for path, item in files.items() if item["room"] == event["room"]]:
+                files.pop(path)
+        elif kind == "open":
+            files[event["file"]] = event
+        elif kind == "close":
+            files.pop(event["file"], None)
+        elif kind == "checkpoint":
+            for path, size in event["files"].items():
+                if path in files:
+                    files[path]["size"] = size
+
+    def rewrite(self):
+        """只保留未结束的记录重写日志，先写入临时文件再替换"""
+        if self.file:
+            self.file.close()
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        temp_file = self.path.with_suffix(".tmp")
+        with open(temp_file, "w", encoding="utf-8") as f:
+            for event in (*self.rooms.values(), *self.files.values()):
+                f.write(json.dumps(event, ensure_ascii=False) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp_file, self.path)
+        self.file = open(self.path, "a", encoding="utf-8")
+        self.lines = len(self.rooms) + len(self.files)
+
+    def append(self, event: dict, sync=True):
+        event["time"] = time.time()
+        with self.lock:
+            self.replay(event, self.rooms, self.files)
+            if self.file is None:
+                return
+            if self.lines >= self.compact_lines:
+                # 重写的内容已包含本次记录
+                self.rewrite()
+                return
+            self.file.write(json.dumps(event, ensure_ascii=False) + "\n")
+            self.file.flush()
+            self.lines += 1
+            # 开始和结束录制的记录需要写入磁盘，文件大小只需写入系统缓存
+            if sync:
+                os.fsync(self.file.fileno())
+
+    @staticmethod
+    def get_room(recorder: "LiveRecoder"):
+        return f"{recorder.platform}:{recorder.id}"
+
+    def start(self, recorder: "LiveRecoder", filename):
+        self.append({"event": "start", "room": self.get_room(recorder), "flag": recorder.flag, "file": filename})
+
+    def end(self, recorder: "LiveRecoder"):
+        if self.get_room(recorder) in self.rooms:
+            self.append({"event": "end", "room": self.get_room(recorder)})
+
+    def open_file(self, recorder: "LiveRecoder", path, target=None, scratch=None, preallocated=False):
+        """记录新的录制文件，target为录制结束后需要ffmpeg封装的目标文件，scratch为实际写入的临时文件"""
+        event = {
+            "event": "open",
+            "room": self.get_room(recorder),
+            "flag": recorder.flag,
+            "file": str(path),
+            "target": target and str(target),
+        }
+        if scratch and str(scratch) != str(path):
+            event["scratch"] = str(scratch)
+        if preallocated:
+            event["preallocated"] = True
+        self.append(event)
+
+    def close_file(self, path):
+        if str(path) in self.files:
+            self.append({"event": "close", "file": str(path)})
+
+    def was_live(self, recorder: "LiveRecoder") -> bool:
+        room = self.get_room(recorder)
+        if room in self.live_rooms:
+            self.live_rooms.discard(room)
+            return True
+        return False
+
+    def run_checkpoint(self):
+        while True:
+            time.sleep(self.interval)
+            files = {}
+            for path in list(self.files):
+                try:
+                    files[path] = os.path.getsize(path)
+                except OSError:
+                    continue
+            if files:
+                self.append({"event": "checkpoint", "files": files}, sync=False)
+
+    def stats(self) -> dict:
+        return {"rooms": len(self.rooms), "files": len(self.files), "lines": self.lines}
+
+
+journal = RecordingJournal()
+
+
+class Output(metaclass=ABCMeta):
+    """与streamlink_cli.output.Output接口相同的输出基类，避免启动时导入streamlink"""
+
+    def __init__(self):
+        self.opened = False
+
+    def open(self):
+        self._open()
+        self.opened = True
+
+    def close(self):
+        if self.opened:
+            self._close()
+        self.opened = False
+
+    def write(self, data):
+        if not self.opened:
+            raise OSError("Output is not opened")
+        return self._write(data)
+
+    @abstractmethod
+    def _open(self):
+        raise NotImplementedError
+
+    @abstractmethod
+    def _close(self):
+        raise NotImplementedError
+
+    @abstractmethod
+    def _write(self, data):
+        raise NotImplementedError
+
+
+class FFmpegOutput(Output):
+    """通过管道将直播流实时交给ffmpeg封装为目标格式，无需录制结束后再读写一遍整个文件"""
+
+    input_formats = {"flv": "flv", "ts": "mpegts"}
+
+    def __init__(self, filename: Path, input_format=None):
+        super().__init__()
+        self.filename = filename
+        self.input_format = input_format
+        self.process: Optional[subprocess.Popen] = None
+
+    def _open(self):
+        self.filename.parent.mkdir(parents=True, exist_ok=True)
+        input_kwargs = {}
+        if input_format := self.input_formats.get(self.input_format):
+            input_kwargs["format"] = input_format
+        output_kwargs = {"codec": "copy", "map_metadata": "-1"}
+        if self.filename.suffix in (".mp4", ".mov", ".m4a"):
+            # 使用分片mp4，进程被强制结束时已写入的部分仍可播放
+            output_kwargs["movflags"] = "frag_keyframe+empty_moov+default_base_moof"
+        import ffmpeg
+
+        command = ffmpeg.input("pipe:0", **input_kwargs).output(
+            str(self.filename), **output_kwargs
+        ).global_args("-hide_banner", "-loglevel", "error").overwrite_output().compile()
+        kwargs = {}
+        # ffmpeg不接收终端的中断信号，只在输入管道关闭后正常结束封装
+        if platform.system() == "Windows":
+            kwargs["creationflags"] = subprocess.CREATE_NEW_PROCESS_GROUP
+        else:
+            kwargs["start_new_session"] = True
+        self.process = subprocess.Popen(command, stdin=subprocess.PIPE, **kwargs)
+
+    def _write(self, data):
+        self.process.stdin.write(data)
+
+    def _close(self):
+        try:
+            self.process.stdin.close()
+        except OSError:
+            pass
+        try:
+            self.process.wait(timeout=60)
+        except subprocess.TimeoutExpired:
+            self.process.terminate()
+            self.process.wait()
+
+
+class FlvTag:
+    """FLV标签，包含标签头、数据和PreviousTagSize"""
+
+    def __init__(self, raw: bytes):
+        self.raw = raw
+        self.type = raw[0]
+        self.size = int.from_bytes(raw[1:4], "big")
+
+    @property
+    def timestamp(self):
+        return int.from_bytes(self.raw[4:7], "big") | self.raw[7] << 24
+
+    @property
+    def is_video(self):
+        return self.type == 9
+
+    @property
+    def is_audio(self):
+        return self.type == 8
+
+    @property
+    def is_script(self):
+        return self.type == 18
+
+    @property
+    def is_keyframe(self):
+        return self.is_video and self.size > 0 and self.raw[11] >> 4 == 1
+
+    @property
+    def is_sequence_header(self):
+        # AVC/HEVC的AVCPacketType或AAC的AACPacketType为0
+        if self.size < 2:
+            return False
+        if self.is_video:
+            return self.raw[11] & 0x0F in (7, 12) and self.raw[12] == 0
+        if self.is_audio:
+            return self.raw[11] >> 4 == 10 and self.raw[12] == 0
+        return False
+
+    def with_timestamp(self, timestamp) -> bytes:
+        timestamp &= 0xFFFFFFFF
+        return (
+            self.raw[:4]
+            + (timestamp & 0xFFFFFF).to_bytes(3, "big")
+            + bytes((timestamp >> 24,))
+            + self.raw[8:]
+        )
+
+
+class FlvParser:
+    """流式解析FLV，只缓存不完整的标签，内存占用恒定"""
+
+    def __init__(self):
+        self.buffer = bytearray()
+        self.header: Optional[bytes] = None
+        self.valid = True
+
+    def feed(self, data) -> List[FlvTag]:
+        self.buffer += data
+        tags = []
+        offset = 0
+        if self.header is None:
+            if len(self.buffer) < 13:
+                return tags
+            if self.buffer[:3] != b"FLV":
+                self.valid = False
+                return tags
+            offset = int.from_bytes(self.buffer[5:9], "big") + 4
+            self.header = bytes(self.buffer[:offset])
+        while len(self.buffer) - offset >= 11:
+            end = offset + 11 + int.from_bytes(self.buffer[offset + 1:offset + 4], "big") + 4
+            if len(self.buffer) < end:
+                break
+            tags.append(FlvTag(bytes(self.buffer[offset:end])))
+            offset = end
+        del self.buffer[:offset]
+        return tags
+
+
+def amf0_encode(value, ecma=False) -> bytes:
+    """编码FLV脚本标签使用的AMF0数据，数字统一编码为double，重写元数据时长度不变"""
+    if isinstance(value, bool):
+        return b"\x01" + bytes((value,))
+    if isinstance(value, (int, float)):
+        return b"\x00" + struct.pack(">d", value)
+    if isinstance(value, str):
+        data = value.encode()
+        return b"\x02" + struct.pack(">H", len(data)) + data
+    if isinstance(value, dict):
+        body = b"".join(
+            struct.pack(">H", len(key.encode())) + key.encode() + amf0_encode(item) for key, item in value.items()
+        )
+        head = b"\x08" + struct.pack(">I", len(value)) if ecma else b"\x03"
+        return head + body + b"\x00\x00\x09"
+    if isinstance(value, (list, tuple)):
+        return b"\x0a" + struct.pack(">I", len(value)) + b"".join(amf0_encode(item) for item in value)
+    return b"\x05"
+
+
+def amf0_decode(data: bytes, offset=0) -> Tuple[object, int]:
+    """解码一个AMF0值，返回值和结束位置，不支持的类型抛出ValueError"""
+    marker = data[offset]
+    offset += 1
+    if marker == 0x00:
+        return struct.unpack_from(">d", data, offset)[0], offset + 8
+    if marker == 0x01:
+        return bool(data[offset]), offset + 1
+    if marker in (0x02, 0x0C):
+        size_length = 2 if marker == 0x02 else 4
+        size = int.from_bytes(data[offset:offset + size_length], "big")
+        offset += size_length
+        return data[offset:offset + size].decode(errors="replace"), offset + size
+    if marker in (0x03, 0x08):
+        if marker == 0x08:
+            offset += 4
+        value = {}
+        while offset + 3 <= len(data) and data[offset:offset + 3] != b"\x00\x00\x09":
+            size = int.from_bytes(data[offset:offset + 2], "big")
+            key = data[offset + 2:offset + 2 + size].decode(errors="replace")
+            value[key], offset = amf0_decode(data, offset + 2 + size)
+        return value, offset + 3
+    if marker == 0x0A:
+        count = int.from_bytes(data[offset:offset + 4], "big")
+        offset += 4
+        items = []
+        for _ in range(count):
+            item, offset = amf0_decode(data, offset)
+            items.append(item)
+        return items, offset
+    if marker == 0x0B:
+        return struct.unpack_from(">d", data, offset)[0], offset + 10
+    if marker in (0x05, 0x06):
+        return None, offset
+    raise ValueError(f"不支持的AMF0类型：{marker}")
+
+
+class TimestampFixOutput(Output):
+    """录制时修复FLV和TS的时间戳跳变，FLV在文件开头预留onMetaData，关闭时写入时长和关键帧索引，无需ffmpeg再处理一遍"""
+
+    # 同类数据相邻时间戳倒退或前进超过该毫秒数时视为跳变
+    jump_threshold = 1000
+    # onMetaData中预留的关键帧数量，用完后隔一个删除一个，内存和文件头大小恒定
+    keyframe_slots = 2048
+
+    def __init__(self, output: Output, filename: Path, format, recorder: "LiveRecoder"):
+        super().__init__()
+        self.output = output
+        self.filename = filename
+        self.flag = recorder.flag
+        self.labels = {"platform": recorder.platform, "room": recorder.id}
+        self.flv = FlvParser() if format == "flv" else None
+        self.ts = format == "ts"
+        # 时间戳修正量，FLV为毫秒，TS为90kHz
+        self.offset = 0
+        # 各类数据修正后的最后时间戳和正常的时间戳间隔，FLV按标签类型，TS按PID和PCR区分
+        self.last: Dict[Union[int, str], int] = {}
+        self.intervals: Dict[Union[int, str], int] = {}
+        self.position = 0
+        self.metadata: Optional[dict] = None
+        self.metadata_position = 0
+        self.metadata_size = 0
+        self.keyframes: List[Tuple[float, int]] = []
+        self.keyframe_spacing = 0
+        self.ts_buffer = b""
+
+    def _open(self):
+        self.output.open()
+
+    def _close(self):
+        # 末尾不完整的标签或TS包无法播放，直接丢弃
+        # 缓冲文件输出在关闭前写入文件头，之后文件可能被移动到输出目录
+        patch = self.metadata_size and getattr(self.output, "patch", None)
+        if patch:
+            patch(self.metadata_position, self.metadata_tag())
+        self.output.close()
+        if self.metadata_size and not patch:
+            try:
+                with open(self.filename, "r+b") as f:
+                    f.seek(self.metadata_position)
+                    f.write(self.metadata_tag())
+            except OSError as error:
+                logger.warning(f"{self.flag} 写入关键帧索引失败：{self.filename}\n{error}")
+
+    def _write(self, data):
+        if self.flv and self.flv.valid:
+            self.write_flv(data)
+        elif self.ts:
+            self.write_ts(data)
+        else:
+            self.write_raw(data)
+
+    def write_raw(self, data):
+        self.output.write(data)
+        self.position += len(data)
+
+    def fix_timestamp(self, kind, timestamp, threshold, modulo=None, monotonic=True) -> int:
+        """timestamp须为解码时间戳，monotonic为True时轻微倒退的时间戳改为上一个时间戳"""
+        fixed = timestamp + self.offset
+        if modulo:
+            fixed %= modulo
+        if (last := self.last.get(kind)) is None:
+            self.last[kind] = fixed
+            return fixed
+        delta = fixed - last
+        if modulo:
+            # TS时间戳为33位，回绕时按有符号差值计算
+            delta = (delta + modulo // 2) % modulo - modulo // 2
+        if -threshold <= delta < 0:
+            # 轻微倒退时保持单调递增，TS的PTS和DTS须一起修正，只加上修正量
+            if monotonic:
+                return last
+            self.last[kind] = fixed
+            return fixed
+        if delta > threshold or delta < 0:
+            # 跳变后接在所有数据最后的时间戳之后，使用该类数据正常的间隔
+            fixed = max(self.last.values()) + self.intervals.get(kind, 0)
+            self.offset = fixed - timestamp
+            if modulo:
+                fixed %= modulo
+            metrics.inc("liverecorder_timestamp_jumps_total", **self.labels)
+            logger.debug(f"{self.flag} 修复时间戳跳变：{self.filename}")
+        else:
+            self.intervals[kind] = delta
+        self.last[kind] = fixed
+        return fixed
+
+    def write_flv(self, data):
+        tags = self.flv.feed(data)
+        if not self.flv.valid:
+            self.write_raw(bytes(self.flv.buffer))
+            return
+        if self.position == 0 and self.flv.header:
+            self.write_raw(self.flv.header)
+        chunks = []
+        position = self.position
+        for tag in tags:
+            if tag.is_script and (metadata := self.parse_metadata(tag)) is not None:
+                # 只保留第一个onMetaData，中途重复的会使播放器重置
+                if self.metadata is None:
+                    self.write_metadata(metadata)
+                    position = self.position
+                continue
+            if self.metadata is None:
+                self.write_metadata({})
+                position = self.position
+            if tag.is_script or tag.is_sequence_header:
+                # 编码信息和脚本数据的时间戳常为0，不参与跳变检测
+                timestamp = self.last.get(tag.type, max(self.last.values(), default=0))
+            else:
+                timestamp = self.fix_timestamp(tag.type, tag.timestamp, self.jump_threshold)
+            if tag.is_keyframe and not tag.is_sequence_header:
+                self.add_keyframe(timestamp, position)
+            chunks.append(tag.with_timestamp(timestamp) if timestamp != tag.timestamp else tag.raw)
+            position += len(tag.raw)
+        self.write_raw(b"".join(chunks))
+
+    @staticmethod
+    def parse_metadata(tag: FlvTag) -> Optional[dict]:
+        """返回onMetaData的内容，其他脚本标签返回None"""
+        payload = tag.raw[11:11 + tag.size]
+        try:
+            name, offset = amf0_decode(payload)
+            if name != "onMetaData":
+                return None
+            metadata, _ = amf0_decode(payload, offset)
+        except (ValueError, IndexError, struct.error):
+            return {}
+        return metadata if isinstance(metadata, dict) else {}
+
+    def write_metadata(self, metadata: dict):
+        keys = ("duration", "filesize", "hasKeyframes", "keyframes", "lastkeyframetimestamp", "lastkeyframelocation")
+        self.metadata = {key: value for key, value in metadata.items() if key not in keys}
+        self.metadata_position = self.position
+        tag = self.metadata_tag()
+        self.metadata_size = len(tag)
+        self.write_raw(tag)
+
+    def metadata_tag(self) -> bytes:
+        times = [timestamp for timestamp, _ in self.keyframes]
+        positions = [position for _, position in self.keyframes]
+        last_time, last_position = self.keyframes[-1] if self.keyframes else (0, 0)
+        metadata = {
+            **self.metadata,
+            "duration": max(self.last.values(), default=0) / 1000,
+            "filesize": self.position,
+            "hasKeyframes": True,
+            "lastkeyframetimestamp": last_time,
+            "lastkeyframelocation": last_position,
+            # spacer填充未使用的位置，关闭时重写的标签与预留的长度相同
+            "keyframes": {
+                "times": times,
+                "filepositions": positions,
+                "spacer": [0] * (self.keyframe_slots - len(self.keyframes)) * 2,
+            },
+        }
+        payload = amf0_encode("onMetaData") + amf0_encode(metadata, ecma=True)
+        header = b"\x12" + len(payload).to_bytes(3, "big") + bytes(7)
+        return header + payload + (len(payload) + 11).to_bytes(4, "big")
+
+    def add_keyframe(self, timestamp, position):
+        if self.keyframes and timestamp - self.keyframes[-1][0] * 1000 < self.keyframe_spacing:
+            return
+        if len(self.keyframes) >= self.keyframe_slots:
+            self.keyframes = self.keyframes[::2]
+            self.keyframe_spacing = (self.keyframes[-1][0] - self.keyframes[0][0]) * 1000 / len(self.keyframes)
+        self.keyframes.append((timestamp / 1000, position))
+
+    def write_ts(self, data):
+        data = bytearray(self.ts_buffer + data)
+        end = len(data) - len(data) % 188
+        self.ts_buffer = bytes(data[end:])
+        for position in range(0, end, 188):
+            if data[position] != 0x47:
+                break
+            self.fix_ts_packet(data, position)
+        self.write_raw(data[:end])
+
+    def fix_ts_packet(self, data: bytearray, position):
+        pid = (data[position + 1] & 0x1F) << 8 | data[position + 2]
+        control = data[position + 3] >> 4 & 0x03
+        payload = position + 4
+        if control & 0x02:
+            length = data[position + 4]
+            # 自适应字段中的PCR
+            if length >= 7 and data[position + 5] & 0x10:
+                base = int.from_bytes(data[position + 6:position + 11], "big") >> 7
+                fixed = self.fix_timestamp("pcr", base, self.jump_threshold * 90, 1 << 33, monotonic=False)
+                if fixed != base:
+                    data[position + 6:position + 10] = (fixed >> 1).to_bytes(4, "big")
+                    data[position + 10] = (fixed & 1) << 7 | data[position + 10] & 0x7F
+            payload += 1 + length
+        # 负载单元起始处的PES头中的PTS和DTS
+        if not (control & 0x01 and data[position + 1] & 0x40) or payload + 19 > position + 188:
+            return
+        if data[payload:payload + 3] != b"\x00\x00\x01" or not data[payload + 7] & 0x80:
+            return
+        # 有B帧时PTS不是单调的，按DTS检测跳变，没有DTS时DTS与PTS相同
+        # PTS和DTS加上同一个修正量，保持两者的差值不变
+        pts = self.read_pts(data, payload + 9)
+        has_dts = data[payload + 7] & 0x40
+        dts = self.read_pts(data, payload + 14) if has_dts else pts
+        fixed = self.fix_timestamp(pid, dts, self.jump_threshold * 90, 1 << 33, monotonic=False)
+        if fixed == dts:
+            return
+        self.write_pts(data, payload + 9, (pts + fixed - dts) % (1 << 33))
+        if has_dts:
+            self.write_pts(data, payload + 14, fixed)
+
+    @staticmethod
+    def read_pts(data, offset) -> int:
+        return (
+            (data[offset] >> 1 & 0x07) << 30
+            | data[offset + 1] << 22
+            | (data[offset + 2] >> 1) << 15
+            | data[offset + 3] << 7
+            | data[offset + 4] >> 1
+        )
+
+    @staticmethod
+    def write_pts(data, offset, value):
+        data[offset] = data[offset] & 0xF0 | (value >> 29 & 0x0E) | 1
+        data[offset + 1] = value >> 22 & 0xFF
+        data[offset + 2] = (value >> 14 & 0xFE) | 1
+        data[offset + 3] = value >> 7 & 0xFF
+        data[offset + 4] = (value << 1 & 0xFE) | 1
+
+
+class SegmentedOutput(Output):
+    """按时长或大小切分录制文件，在关键帧或TS的PAT处切换输出文件，直播流不中断"""
+
+    def __init__(
+        self,
+        filename: Path,
+        format,
+        new_part: Callable[[Path], Output],
+        next_filename: Callable[[], Path],
+        on_rotate: Callable[[Path], None],
+        segment_time=0,
+        segment_size=0,
+    ):
+        super().__init__()
+        self.filename = filename
+        self.format = format
+        self.new_part = new_part
+        self.next_filename = next_filename
+        self.on_rotate = on_rotate
+        self.segment_time = segment_time * 60
+        self.segment_size = segment_size * 1024 ** 3
+        self.part: Optional[Output] = None
+        self.part_start = 0
+        self.part_size = 0
+        self.flv = FlvParser() if format == "flv" else None
+        self.flv_config: Dict[str, FlvTag] = {}
+        self.flv_base = 0
+        self.ts_buffer = b""
+
+    def _open(self):
+        self.open_part()
+
+    def _close(self):
+        if self.flv and self.flv.buffer:
+            self.write_part(bytes(self.flv.buffer))
+        if self.ts_buffer:
+            self.write_part(self.ts_buffer)
+        self.part.close()
+
+    def open_part(self):
+        self.part = self.new_part(self.filename)
+        self.part.open()
+        self.part_start = time.monotonic()
+        self.part_size = 0
+
+    def rotate(self):
+        self.part.close()
+        self.on_rotate(self.filename)
+        self.filename = self.next_filename()
+        self.open_part()
+
+    def should_rotate(self):
+        if self.segment_time and time.monotonic() - self.part_start >= self.segment_time:
+            return True
+        return bool(self.segment_size) and self.part_size >= self.segment_size
+
+    def write_part(self, data):
+        self.part.write(data)
+        self.part_size += len(data)
+
+    def _write(self, data):
+        if self.flv and self.flv.valid:
+            self.write_flv(data)
+        elif self.format == "ts":
+            self.write_ts(data)
+        else:
+            # 无法确定切分位置的格式不切分
+            self.write_part(data)
+
+    def write_flv(self, data):
+        tags = self.flv.feed(data)
+        if not self.flv.valid:
+            self.write_part(bytes(self.flv.buffer))
+            return
+        if self.part_size == 0 and self.flv.header:
+            self.write_part(self.flv.header)
+        for tag in tags:
+            # 保存新文件开头需要的元数据和音视频编码信息
+            if tag.is_script and "script" not in self.flv_config:
+                self.flv_config["script"] = tag
+            elif tag.is_sequence_header:
+                self.flv_config["video" if tag.is_video else "audio"] = tag
+            elif tag.is_keyframe and self.should_rotate():
+                self.rotate()
+                self.write_part(self.flv.header)
+                for config_tag in self.flv_config.values():
+                    self.write_part(config_tag.with_timestamp(0))
+                self.flv_base = tag.timestamp
+            self.write_part(tag.with_timestamp(max(tag.timestamp - self.flv_base, 0)) if self.flv_base else tag.raw)
+
+    def write_ts(self, data):
+        data = self.ts_buffer + data
+        end = len(data) - len(data) % 188
+        self.ts_buffer = data[end:]
+        offset = 0
+        if self.should_rotate():
+            # 在PAT包处切分，保证新文件以PAT/PMT开头
+            for position in range(0, end, 188):
+                if data[position] != 0x47:
+                    break
+                pid = (data[position + 1] & 0x1F) << 8 | data[position + 2]
+                if pid == 0 and data[position + 1] & 0x40:
+                    self.write_part(data[:position])
+                    self.rotate()
+                    offset = position
+                    break
+        self.write_part(data[offset:end])
+
+
+class ResumableOutput(Output):
+    """直播流断开重连后继续写入同一个输出，FLV去掉重复的文件头并接续时间戳，TS丢弃断开时不完整的包"""
+
+    def __init__(self, output: Output, format):
+        super().__init__()
+        self.output = output
+        self.flv = FlvParser() if format == "flv" else None
+        self.flv_offset = 0
+        self.flv_last = 0
+        self.flv_gap = None
+        self.ts_buffer = b""
+
+    @property
+    def filename(self):
+        return self.output.filename
+
+    def _open(self):
+        self.output.open()
+
+    def _close(self):
+        self.output.close()
+
+    def resume(self, gap):
+        """重连成功后调用，之后写入的数据来自新的连接"""
+        self.ts_buffer = b""
+        if self.flv and self.flv.valid:
+            self.flv = FlvParser()
+            self.flv_gap = int(gap * 1000)
+
+    def _write(self, data):
+        if self.flv and self.flv.valid:
+            self.write_flv(data)
+        elif self.flv is None:
+            data = self.ts_buffer + data
+            end = len(data) - len(data) % 188
+            self.ts_buffer = data[end:]
+            self.output.write(data[:end])
+        else:
+            self.output.write(data)
+
+    def write_flv(self, data):
+        # 重连前的文件头已经写入
+        first = self.flv.header is None and self.flv_gap is None
+        tags = self.flv.feed(data)
+        if not self.flv.valid:
+            self.output.write(bytes(self.flv.buffer))
+            return
+        if first and self.flv.header:
+            self.output.write(self.flv.header)
+        for tag in tags:
+            if self.flv_gap is not None:
+                # 新连接的时间戳从0开始，接在断开前的时间戳加上中断时长之后
+                self.flv_offset = self.flv_last + self.flv_gap - tag.timestamp
+                self.flv_gap = None
+            timestamp = tag.timestamp + self.flv_offset
+            self.flv_last = max(self.flv_last, timestamp)
+            self.output.write(tag.with_timestamp(timestamp) if self.flv_offset else tag.raw)
+
+
+class MeteredOutput(Output):
+    """统计录制写入的字节数、速度和卡顿次数"""
+
+    # 两次写入间隔超过该秒数视为一次卡顿
+    stall_threshold = 10
+
+    def __init__(self, output: Output, recorder: "LiveRecoder"):
+        super().__init__()
+        self.output = output
+        self.labels = {"platform": recorder.platform, "room": recorder.id}
+        self.last_write = time.monotonic()
+        self.window_start = self.last_write
+        self.window_bytes = 0
+        self.opened = output.opened
+
+    @property
+    def filename(self):
+        return self.output.filename
+
+    def _open(self):
+        self.output.open()
+
+    def _close(self):
+        self.output.close()
+
+    def _write(self, data):
+        self.output.write(data)
+        now = time.monotonic()
+        if now - self.last_write > self.stall_threshold:
+            metrics.inc("liverecorder_write_stalls_total", **self.labels)
+        self.last_write = now
+        metrics.inc("liverecorder_written_bytes_total", len(data), **self.labels)
+        self.window_bytes += len(data)
+        if now - self.window_start >= 5:
+            metrics.set("liverecorder_write_bytes_per_second", self.window_bytes / (now - self.window_start), **self.labels)
+            self.window_start = now
+            self.window_bytes = 0
+
+
+class DiskWriter:
+    """缓冲文件输出共用的写入线程，各文件轮流写入整块数据，减少大量录制同时写入机械硬盘时的寻道"""
+
+    def __init__(self):
+        self.workers = 2
+        self.queue: "queue.Queue[BufferedFileOutput]" = queue.Queue()
+        self.threads: List[threading.Thread] = []
+        self.lock = threading.Lock()
+        # 正在从临时目录移动到输出目录的文件
+        self.moving: Dict[str, threading.Event] = {}
+
+    def configure(self, config: dict):
+        self.workers = config.get("disk_writers", self.workers)
+
+    def start(self):
+        while len(self.threads) < self.workers:
+            thread = threading.Thread(target=self.worker, name="disk_writer", daemon=True)
+            thread.start()
+            self.threads.append(thread)
+
+    def schedule(self, output: "BufferedFileOutput"):
+        self.start()
+        self.queue.put(output)
+
+    def worker(self):
+        while True:
+            self.queue.get().flush_chunk()
+
+    def move(self, source: Path, target: Path, flag):
+        """在后台将临时目录中的录制文件移动到输出目录，跨磁盘移动时需要复制整个文件"""
+        event = threading.Event()
+        with self.lock:
+            self.moving[str(target)] = event
+
+        def run():
+            start = time.monotonic()
+            try:
+                target.parent.mkdir(parents=True, exist_ok=True)
+                shutil.move(source, target)
+                logger.info(f"{flag} 录制文件已移动到输出目录，耗时{time.monotonic() - start:.1f}秒：{target}")
+            except OSError as error:
+                logger.error(f"{flag} 移动录制文件失败，文件保留在：{source}\n{error}")
+            finally:
+                with self.lock:
+                    self.moving.pop(str(target), None)
+                event.set()
+
+        threading.Thread(target=run, name="move", daemon=True).start()
+
+    def wait_moved(self, path=None):
+        """等待该文件（为None时等待所有文件）移动完成"""
+        with self.lock:
+            events = list(self.moving.values()) if path is None else [self.moving.get(str(path))]
+        for event in events:
+            if event:
+                event.wait()
+
+    def stats(self) -> dict:
+        return {"workers": len(self.threads), "queued": self.queue.qsize(), "moving": len(self.moving)}
+
+
+disk_writer = DiskWriter()
+
+
+class BufferedFileOutput(Output):
+    """大块缓冲写入文件，按4KB对齐写入并分块预分配空间，由共用的写入线程写入磁盘，可先写入临时目录，关闭后移动到输出目录"""
+
+    block_size = 4096
+    # 等待写入的数据超过该缓冲块数时阻塞录制线程
+    max_pending = 4
+
+    def __init__(self, filename: Path, recorder: "LiveRecoder"):
+        super().__init__()
+        self.filename = filename
+        self.flag = recorder.flag
+        self.labels = {"platform": recorder.platform, "room": recorder.id}
+        self.buffer_size = max(int(recorder.write_buffer * 1024 ** 2) // self.block_size, 1) * self.block_size
+        self.preallocate = int(recorder.preallocate * 1024 ** 2) if hasattr(os, "posix_fallocate") else 0
+        self.fsync_interval = recorder.fsync_interval
+        if recorder.scratch_dir:
+            self.write_path = Path(recorder.scratch_dir, f"{uuid.uuid4().hex[:8]}_{filename.name}")
+        else:
+            self.write_path = filename
+        self.fd = None
+        self.buffer = bytearray()
+        # 等待写入线程写入的数据块
+        self.pending = deque()
+        self.pending_size = 0
+        self.scheduled = False
+        self.condition = threading.Condition()
+        self.close_lock = threading.Lock()
+        self.error: Optional[OSError] = None
+        self.written = 0
+        self.allocated = 0
+        self.synced = time.monotonic()
+        # 关闭前写入指定位置的数据，用于更新文件头
+        self.patches: List[Tuple[int, bytes]] = []
+
+    def _open(self):
+        self.write_path.parent.mkdir(parents=True, exist_ok=True)
+        self.fd = os.open(self.write_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC | getattr(os, "O_BINARY", 0), 0o644)
+
+    def _write(self, data):
+        self.buffer += data
+        if len(self.buffer) >= self.buffer_size:
+            # 只写入4KB的整数倍，文件偏移始终对齐，剩余部分留到下次写入
+            size = len(self.buffer) - len(self.buffer) % self.block_size
+            chunk, self.buffer = self.buffer, self.buffer[size:]
+            del chunk[size:]
+            self.submit(chunk)
+
+    def submit(self, chunk):
+        with self.condition:
+            while self.pending_size >= self.max_pending * self.buffer_size and not self.error:
+                self.condition.wait()
+            if self.error:
+                raise OSError(f"写入文件失败：{self.error}")
+            self.pending.append(chunk)
+            self.pending_size += len(chunk)
+            metrics.set("liverecorder_disk_queue_bytes", self.pending_size, **self.labels)
+            if not self.scheduled:
+                self.scheduled = True
+                disk_writer.schedule(self)
+
+    def flush_chunk(self):
+        """由写入线程调用，每次只写入一块后重新排队，各文件轮流写入"""
+        with self.condition:
+            chunk = self.pending[0]
+        try:
+            self.write_chunk(chunk)
+        except OSError as error:
+            logger.error(f"{self.flag} 写入文件失败：{self.write_path}\n{error}")
+            with self.condition:
+                self.error = error
+                self.pending.clear()
+                self.pending_size = 0
+                self.scheduled = False
+                self.condition.notify_all()
+            return
+        with self.condition:
+            self.pending.popleft()
+            self.pending_size -= len(chunk)
+            metrics.set("liverecorder_disk_queue_bytes", self.pending_size, **self.labels)
+            self.condition.notify_all()
+            if self.pending:
+                disk_writer.schedule(self)
+            else:
+                self.scheduled = False
+
+    def write_chunk(self, chunk):
+        if self.preallocate and self.written + len(chunk) > self.allocated:
+            size = max(self.preallocate, self.written + len(chunk) - self.allocated)
+            try:
+                os.posix_fallocate(self.fd, self.allocated, size)
+                self.allocated += size
+            except OSError as error:
+                # 文件系统不支持时不再预分配
+                logger.debug(f"{self.flag} 预分配文件空间失败：{self.write_path}\n{error}")
+                self.preallocate = 0
+        start = time.perf_counter()
+        view = memoryview(chunk)
+        while view:
+            view = view[os.write(self.fd, view):]
+        self.written += len(chunk)
+        metrics.observe("liverecorder_disk_write_seconds", time.perf_counter() - start, platform=self.labels["platform"])
+        metrics.inc("liverecorder_disk_written_bytes_total", len(chunk), **self.labels)
+        if self.fsync_interval and time.monotonic() - self.synced >= self.fsync_interval:
+            self.sync()
+
+    def sync(self):
+        start = time.perf_counter()
+        os.fsync(self.fd)
+        self.synced = time.monotonic()
+        metrics.observe("liverecorder_disk_fsync_seconds", time.perf_counter() - start, platform=self.labels["platform"])
+
+    def patch(self, position, data: bytes):
+        self.patches.append((position, data))
+
+    def _close(self):
+        # 停止录制时录制线程和主线程可能同时关闭
+        with self.close_lock:
+            if self.fd is None:
+                return
+            try:
+                if self.buffer and not self.error:
+                    self.submit(self.buffer)
+                    self.buffer = bytearray()
+                with self.condition:
+                    while self.pending and not self.error:
+                        self.condition.wait()
+                for position, data in self.patches:
+                    os.lseek(self.fd, position, os.SEEK_SET)
+                    os.write(self.fd, data)
+                # 去掉预分配后未写入的空间
+                if self.allocated > self.written:
+                    os.ftruncate(self.fd, self.written)
+                if self.fsync_interval:
+                    self.sync()
+            finally:
+                os.close(self.fd)
+                self.fd = None
+                metrics.set("liverecorder_disk_queue_bytes", 0, **self.labels)
+            if self.write_path != self.filename:
+                disk_writer.move(self.write_path, self.filename, self.flag)
+
+
+class SinkWriter:
+    """扇出的一个输出，使用独立线程写入，内存缓冲超过上限时暂存到磁盘，不阻塞下载和其他输出"""
+
+    def __init__(self, output: Output, limit, spill_dir, labels: dict):
+        self.output = output
+        self.limit = limit
+        self.spill_dir = spill_dir
+        self.labels = labels
+        self.chunks = deque()
+        self.size = 0
+        # 开始暂存后新数据都写入暂存文件，直到写入线程读完，保证顺序
+        self.spill = None
+        self.spill_read = 0
+        self.spill_size = 0
+        self.spilled = False
+        self.failed = False
+        self.closed = False
+        self.condition = threading.Condition()
+        self.thread = threading.Thread(target=self.run, name="sink_writer", daemon=True)
+
+    @property
+    def filename(self):
+        return self.output.filename
+
+    def open(self):
+        self.output.open()
+        self.thread.start()
+
+    def put(self, data):
+        with self.condition:
+            if self.failed:
+                return
+            if self.spill is None and self.size + len(data) > self.limit:
+                Path(self.spill_dir).mkdir(parents=True, exist_ok=True)
+                self.spill = tempfile.TemporaryFile(dir=self.spill_dir)
+                self.spill_read = self.spill_size = 0
+                if not self.spilled:
+                    self.spilled = True
+                    logger.warning(f"输出写入过慢，缓冲已满，暂存到磁盘：{self.filename}")
+            if self.spill is not None:
+                # 写入线程不持有锁读取暂存文件，写入后立即刷新
+                self.spill.seek(self.spill_size)
+                self.spill.write(data)
+                self.spill.flush()
+                self.spill_size += len(data)
+                metrics.inc("liverecorder_sink_spilled_bytes_total", len(data), **self.labels)
+            else:
+                self.chunks.append(data)
+                self.size += len(data)
+            self.condition.notify()
+
+    def next_chunk(self) -> Optional[bytes]:
+        with self.condition:
+            while not self.chunks and self.spill is None and not self.closed:
+                self.condition.wait()
+            if self.chunks:
+                data = self.chunks.popleft()
+                self.size -= len(data)
+                return data
+            if self.spill is None:
+                return None
+            # 持有锁时只记录读取位置，读取暂存文件时不阻塞下载线程写入
+            # 暂存文件只由写入线程关闭，读取期间不会被关闭
+            spill, offset = self.spill, self.spill_read
+            length = min(self.spill_size - offset, 1024 ** 2)
+        data = os.pread(spill.fileno(), length, offset)
+        with self.condition:
+            self.spill_read += len(data)
+            if self.spill_read >= self.spill_size:
+                self.spill.close()
+                self.spill = None
+        return data
+
+    def run(self):
+        while (data := self.next_chunk()) is not None:
+            try:
+                self.output.write(data)
+            except Exception as error:
+                logger.error(f"输出写入失败，停止写入该输出：{self.filename}\n{repr(error)}")
+                with self.condition:
+                    self.failed = True
+                    self.chunks.clear()
+                    if self.spill is not None:
+                        self.spill.close()
+                        self.spill = None
+                return
+
+    def close(self):
+        # 等待缓冲和暂存的数据全部写入后再关闭输出
+        with self.condition:
+            self.closed = True
+            self.condition.notify()
+        if self.thread.is_alive():
+            self.thread.join()
+        self.output.close()
+
+
+class FanoutOutput(Output):
+    """一个上游下载同时写入多个输出和本地转发，各输出使用独立的有界缓冲"""
+
+    def __init__(self, outputs: List[Output], recorder: "LiveRecoder", format):
+        super().__init__()
+        labels = {"platform": recorder.platform, "room": recorder.id}
+        limit = recorder.sink_buffer * 1024 ** 2
+        self.sinks = [SinkWriter(output, limit, recorder.spill_dir, labels) for output in outputs]
+        self.path = f"/live/{recorder.platform}/{recorder.id}"
+        self.format = format
+        self.channel: Optional[LiveChannel] = None
+
+    @property
+    def filename(self):
+        return self.sinks[0].filename
+
+    def _open(self):
+        for sink in self.sinks:
+            sink.open()
+        if live_server.server:
+            self.channel = live_server.publish(self.path, self.format)
+
+    def _close(self):
+        if self.channel:
+            live_server.unpublish(self.channel)
+        for sink in self.sinks:
+            sink.close()
+
+    def _write(self, data):
+        if all(sink.failed for sink in self.sinks):
+            raise OSError("所有输出均写入失败")
+        for sink in self.sinks:
+            sink.put(data)
+        if self.channel:
+            self.channel.feed(data)
+
+
+class LiveClient:
+    """转发直播流的一个观看端，未发送的数据超过上限时断开，不影响录制"""
+
+    def __init__(self, limit):
+        self.limit = limit
+        self.queue: asyncio.Queue = asyncio.Queue()
+        self.pending = 0
+        self.started = False
+        self.dropped = False
+
+    def put(self, data: Optional[bytes]):
+        if self.dropped:
+            return
+        if data is not None and self.pending + len(data) > self.limit:
+            self.dropped = True
+            metrics.inc("liverecorder_serve_dropped_clients_total")
+            data = None
+        if data is None:
+            self.queue.put_nowait(None)
+            return
+        self.pending += len(data)
+        self.queue.put_nowait(data)
+
+
+class LiveChannel:
+    """一个正在录制的直播流，新的观看端从FLV关键帧或TS的PAT开始接收"""
+
+    def __init__(self, server: "LiveServer", path, format):
+        self.server = server
+        self.path = path
+        self.flv = FlvParser() if format == "flv" else None
+        self.ts = format == "ts"
+        self.flv_config: Dict[str, bytes] = {}
+        self.ts_buffer = b""
+        # 观看端列表只在事件循环中替换，录制线程读取
+        self.clients: Tuple[LiveClient, ...] = ()
+
+    @property
+    def content_type(self):
+        if self.flv:
+            return "video/x-flv"
+        return "video/mp2t" if self.ts else "application/octet-stream"
+
+    def add(self, client: LiveClient):
+        self.clients += (client,)
+
+    def remove(self, client: LiveClient):
+        self.clients = tuple(item for item in self.clients if item is not client)
+
+    def send(self, client: LiveClient, data: bytes):
+        if data:
+            self.server.loop.call_soon_threadsafe(client.put, data)
+
+    def feed(self, data):
+        if self.flv and self.flv.valid:
+            self.feed_flv(data)
+        elif self.ts:
+            self.feed_ts(data)
+        else:
+            for client in self.clients:
+                client.started = True
+                self.send(client, data)
+
+    def feed_flv(self, data):
+        tags = self.flv.feed(data)
+        if not self.flv.valid:
+            return
+        for tag in tags:
+            # 保存新观看端开头需要的元数据和音视频编码信息
+            if tag.is_script and "script" not in self.flv_config:
+                self.flv_config["script"] = tag.raw
+            elif tag.is_sequence_header:
+                self.flv_config["video" if tag.is_video else "audio"] = tag.raw
+        if not self.clients or not tags:
+            return
+        chunk = b"".join(tag.raw for tag in tags)
+        for client in self.clients:
+            if client.started:
+                self.send(client, chunk)
+                continue
+            for index, tag in enumerate(tags):
+                if tag.is_keyframe and not tag.is_sequence_header:
+                    client.started = True
+                    head = self.flv.header + b"".join(self.flv_config.values())
+                    self.send(client, head + b"".join(item.raw for item in tags[index:]))
+                    break
+
+    def feed_ts(self, data):
+        data = self.ts_buffer + data
+        end = len(data) - len(data) % 188
+        self.ts_buffer = data[end:]
+        for client in self.clients:
+            if client.started:
+                self.send(client, data[:end])
+                continue
+            for position in range(0, end, 188):
+                if data[position + 1] & 0x40 and (data[position + 1] & 0x1F) << 8 | data[position + 2] == 0:
+                    client.started = True
+                    self.send(client, data[position:end])
+                    break
+
+    def close(self):
+        for client in self.clients:
+            self.server.loop.call_soon_threadsafe(client.put, None)
+
+
+class LiveServer:
+    """转发正在录制的直播流，播放器访问http://地址:端口/live/平台/直播间id即可观看，不额外占用上游带宽"""
+
+    def __init__(self):
+        self.server = None
+        self.loop: Optional[asyncio.AbstractEventLoop] = None
+        self.client_buffer = 4 * 1024 ** 2
+        self.channels: Dict[str, LiveChannel] = {}
+
+    def configure(self, config: dict):
+        self.client_buffer = config.get("serve_buffer", 4) * 1024 ** 2
+
+    async def serve(self, host, port):
+        self.loop = asyncio.get_running_loop()
+        self.server = await asyncio.start_server(self.handle, host, port)
+        logger.info(f"直播转发接口已启动：http://{host}:{port}/live/平台/直播间id")
+
+    def publish(self, path, format) -> LiveChannel:
+        channel = LiveChannel(self, path, format)
+        self.channels[path] = channel
+        return channel
+
+    def unpublish(self, channel: LiveChannel):
+        if self.channels.get(channel.path) is channel:
+            self.channels.pop(channel.path)
+        channel.close()
+
+    def stats(self) -> dict:
+        return {
+            "channels": len(self.channels),
+            "clients": sum(len(channel.clients) for channel in list(self.channels.values())),
+        }
+
+    async def handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        client = None
+        channel = None
+        try:
+            request_line = await reader.readline()
+            while (await reader.readline()).strip():
+                pass
+            path = request_line.split(b" ")[1].decode().split("?")[0]
+            if not (channel := self.channels.get(path)):
+                writer.write(
+                    b"HTTP/1.1 404 Not Found\r\nContent-Type: text/plain\r\nContent-Length: 10\r\n"
+                    b"Connection: close\r\n\r\nNot Found\n"
+                )
+                await writer.drain()
+                return
+            writer.write(
+                f"HTTP/1.1 200 OK\r\nContent-Type: {channel.content_type}\r\nCache-Control: no-cache\r\n"
+                f"Access-Control-Allow-Origin: *\r\nConnection: close\r\n\r\n".encode()
+            )
+            client = LiveClient(self.client_buffer)
+            channel.add(client)
+            while (data := await client.queue.get()) is not None:
+                client.pending -= len(data)
+                writer.write(data)
+                await writer.drain()
+            if client.dropped:
+                logger.warning(f"转发观看端接收过慢，已断开：{path}")
+        except (ConnectionError, IndexError, UnicodeDecodeError):
+            pass
+        finally:
+            if client and channel:
+                channel.remove(client)
+            writer.close()
+
+
+live_server = LiveServer()
+
+
+class UnsupportedStreamError(Exception):
+    pass
+
+
+class AsyncStreamEngine:
+    """基于asyncio下载HTTP-FLV和普通HLS直播流，不占用录制线程，写文件使用有界缓冲"""
+
+    # 所有录制共用的写文件线程池
+    file_executor = ThreadPoolExecutor(4, thread_name_prefix="writer")
+    chunk_size = 64 * 1024
+
+    def __init__(self, recorder: "LiveRecoder", stream: Union["HTTPStream", "HLSStream"], output: Output, filename):
+        self.recorder = recorder
+        self.flag = recorder.flag
+        self.stream = stream
+        self.output = output
+        self.filename = filename
+        self.queue: asyncio.Queue = asyncio.Queue(recorder.stream_buffer)
+        self.error: Optional[BaseException] = None
+        self.task: Optional[asyncio.Task] = None
+        self.closed = False
+        self.loop = asyncio.get_running_loop()
+        self.resumable = isinstance(output, ResumableOutput)
+        # 收到过数据后断开才重连，断开的时间用于计算中断时长
+        self.received = False
+        self.dropped_at: Optional[float] = None
+        self.last_sequence: Optional[int] = None
+
+    def close(self):
+        # 可能在其他线程调用
+        self.closed = True
+        if self.task:
+            self.loop.call_soon_threadsafe(self.task.cancel)
+
+    async def run(self):
+        self.task = asyncio.current_task()
+        headers = dict(self.stream.session.http.headers)
+        headers.update(self.stream.args.get("headers") or {})
+        key = client_pool.get_key(self.recorder.proxy, headers, self.recorder.cookies, stream=True)
+        client = client_pool.acquire(key)
+        writer = asyncio.create_task(self.write_loop())
+        try:
+            await self.read(client)
+            return True
+        except UnsupportedStreamError:
+            raise
+        except asyncio.CancelledError:
+            # 仅处理主动停止录制，程序退出时继续向上抛出
+            if not self.closed:
+                raise
+            logger.info(f"{self.flag} 录制已停止：{self.filename}")
+        except httpx.TimeoutException as error:
+            logger.warning(f"{self.flag} 直播录制超时，请检查主播是否正常开播或网络连接是否正常：{self.filename}\n{repr(error)}")
+        except (httpx.HTTPError, ConnectionError) as error:
+            logger.warning(f"{self.flag} 直播流打开错误，请检查主播是否正常开播：{self.filename}\n{repr(error)}")
+        except Exception as error:
+            logger.exception(f"{self.flag} 直播录制错误：{self.filename}\n{error}")
+        finally:
+            await self.queue.put(None)
+            await writer
+            await client_pool.release(key)
+
+    async def read(self, client: httpx.AsyncClient):
+        from streamlink.stream import HLSStream
+
+        hls = isinstance(self.stream, HLSStream)
+        delays = None
+        while True:
+            try:
+                if hls:
+                    await self.read_hls(client, self.stream.url)
+                else:
+                    await self.read_http(client, self.stream.url)
+                # HLS播放列表结束表示直播已结束
+                if hls or not (self.resumable and self.received):
+                    return
+            except (httpx.HTTPError, ConnectionError) as error:
+                invalid = isinstance(error, httpx.HTTPStatusError) and error.response.status_code in (403, 404, 410)
+                if not (self.resumable and self.received) or self.error or invalid:
+                    raise
+                logger.info(f"{self.flag} 直播流读取错误：{self.filename}\n{repr(error)}")
+            if self.dropped_at is None:
+                self.dropped_at = time.monotonic()
+                delays = self.recorder.reconnect_delays()
+            if (delay := next(delays, None)) is None:
+                return
+            await asyncio.sleep(delay)
+
+    async def put(self, chunk):
+        if self.error:
+            raise ConnectionError(f"写入录制文件错误：{self.error}")
+        self.recorder.count_first_byte()
+        if self.dropped_at is not None:
+            gap = time.monotonic() - self.dropped_at
+            self.dropped_at = None
+            await self.queue.put(partial(self.recorder.count_reconnect, self.output, self.filename, gap))
+        self.received = True
+        await self.queue.put(chunk)
+
+    async def write_loop(self):
+        output = None
+        try:
+            while (chunk := await self.queue.get()) is not None:
+                if self.error:
+                    continue
+                try:
+                    # 重连成功后在写入新连接的数据前通知输出
+                    if callable(chunk):
+                        await self.loop.run_in_executor(self.file_executor, chunk)
+                        continue
+                    if output is None:
+                        await self.loop.run_in_executor(self.file_executor, self.output.open)
+                        output = MeteredOutput(self.output, self.recorder)
+                        logger.info(f"{self.flag} 正在录制：{self.filename}")
+                    await self.loop.run_in_executor(self.file_executor, output.write, chunk)
+                except Exception as error:
+                    # 继续取出数据，避免读取端阻塞
+                    self.error = error
+        finally:
+            await self.loop.run_in_executor(self.file_executor, self.output.close)
+
+    async def read_http(self, client: httpx.AsyncClient, url):
+        async with client.stream("GET", url) as response:
+            response.raise_for_status()
+            async for chunk in response.aiter_bytes(self.chunk_size):
+                await self.put(chunk)
+
+    async def read_hls(self, client: httpx.AsyncClient, url):
+        while True:
+            response = await client.get(url)
+            response.raise_for_status()
+            playlist = response.text
+            if "#EXT-X-STREAM-INF" in playlist:
+                url = self.select_variant(url, playlist)
+                continue
+            if re.search(r"#EXT-X-KEY:(?!METHOD=NONE)|#EXT-X-MAP", playlist):
+                raise UnsupportedStreamError("直播流使用加密或fMP4分片")
+            target_duration, segments, ended = self.parse_playlist(url, playlist)
+            new_segments = [(sequence, uri) for sequence, uri in segments if self.last_sequence is None or sequence > self.last_sequence]
+            if self.last_sequence is not None and new_segments and new_segments[0][0] > self.last_sequence + 1:
+                dropped = new_segments[0][0] - self.last_sequence - 1
+                logger.warning(f"{self.flag} 直播流丢失{dropped}个分片：{self.filename}")
+                metrics.inc("liverecorder_dropped_segments_total", dropped, platform=self.recorder.platform, room=self.recorder.id)
+            for sequence, uri in new_segments:
+                async with client.stream("GET", uri) as segment:
+                    segment.raise_for_status()
+                    async for chunk in segment.aiter_bytes(self.chunk_size):
+                        await self.put(chunk)
+                self.last_sequence = sequence
+            if ended:
+                return
+            # 播放列表没有更新时按一半的分片时长重新获取
+            await asyncio.sleep(target_duration if new_segments else target_duration / 2)
+
+    @staticmethod
+    def select_variant(url, playlist):
+        variants = re.findall(r"#EXT-X-STREAM-INF:(.*)\s+(\S+)", playlist)
+        bandwidth = lambda variant: int(re.search(r"BANDWIDTH=(\d+)", variant[0]).group(1)) if "BANDWIDTH=" in variant[0] else 0
+        return urljoin(url, max(variants, key=bandwidth)[1])
+
+    @staticmethod
+    def parse_playlist(url, playlist):
+        target_duration = 2
+        sequence = 0
+        segments = []
+        for line in playlist.splitlines():
+            line = line.strip()
+            if line.startswith("#EXT-X-TARGETDURATION:"):
+                target_duration = float(line.split(":", 1)[1])
+            elif line.startswith("#EXT-X-MEDIA-SEQUENCE:"):
+                sequence = int(line.split(":", 1)[1])
+            elif line and not line.startswith("#"):
+                segments.append((sequence, urljoin(url, line)))
+                sequence += 1
+        return target_duration, segments, "#EXT-X-ENDLIST" in playlist
+
+
+# 直播平台名称到录制类的映射，定义LiveRecoder的子类时自动注册
+platforms: Dict[str, Type["LiveRecoder"]] = {}
+
+
+class TextMarkers:
+    """流式读取网页时按顺序查找的字符串，每次只从上次的位置继续查找新读取的内容，总耗时与网页大小成正比"""
+
+    def __init__(self, *markers: str):
+        self.markers = markers
+        # 已找到的标记的位置和下一个标记的查找起点
+        self.found: List[int] = []
+        self.position = 0
+
+    def feed(self, text: str) -> bool:
+        """text为目前读取的全部内容，所有标记都按顺序找到后返回True"""
+        while len(self.found) < len(self.markers):
+            marker = self.markers[len(self.found)]
+            index = text.find(marker, self.position)
+            if index < 0:
+                # 保留标记长度减一的重叠部分，标记跨越两次读取的内容时也能找到
+                self.position = max(self.position, len(text) - len(marker) + 1)
+                return False
+            self.found.append(index)
+            self.position = index + len(marker)
+        return True
+
+    def value(self, text: str) -> str:
+        """第一个标记和最后一个标记之间的内容"""
+        return text[self.found[0] + len(self.markers[0]):self.found[-1]]
 
 
 class LiveRecoder:
+    # 录制该平台需要的第三方库，在用到时才导入，启动前只检查是否已安装
+    requires: Tuple[str, ...] = ("streamlink", "streamlink_cli")
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        platforms[cls.__name__] = cls
+
     def __init__(self, config: dict, user: dict):
         self.id = user["id"]
         
-        self.name = user.get("name", "").strip()
-        
         self.platform = user["platform"]
+
+        self.load_config(config, user)
+
+        # 最近的开播时间和最后一次直播时间，用于自适应检测间隔
+        self.live_starts = deque(maxlen=10)
+        self.last_live = None
+
+        self.client_key = client_pool.get_key(self.proxy, self.headers, self.cookies)
+        client_pool.acquire(self.client_key)
+        # 检测开始时客户端的代数，检测出错时只重建这一代客户端
+        self.client_generation = 0
+
+        # 检测到开播的时间，用于统计开播至首字节的耗时
+        self.detected_at = None
+
+        # 正在录制的直播流链接
+        self.url = None
+
+        # 已从配置文件中删除，当前录制结束后停止检测
+        self.stopping = False
+
+        # 录制期间修改的配置，录制结束后再加载，结束录制时的封装、分段和日志使用录制开始时的配置
+        self.pending_update: Optional[Tuple[dict, dict]] = None
+
+        # 开播推送连接是否正常，正常时检测只作为兜底
+        self.push_connected = False
+
+        # 上次最快返回直播源的CDN域名，下次获取直播源时优先请求
+        self.cdn_host = None
+
+        # 本次检测的开始时间和各阶段耗时
+        self.poll_started = None
+        self.phase_times: Dict[str, float] = defaultdict(float)
+
+    def load_config(self, config: dict, user: dict):
+        self.name = user.get("name", "").strip()
         
         self.flag = f"{self.platform} {self.name}"
 
-        self.interval = user.get("interval", config.get("interval", 15))
+        self.interval = user.get("interval", config.get("interval", 15))
+
+        self.headers = user.get("headers", {"User-Agent": "Mozilla/5.0 (Windows NT 6.1; WOW64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/39.0.2171.71 Safari/537.36"})
+
+        self.cookies = user.get("cookies",config.get("Pandalive_cookies"))
+
+        self.proxy = user.get("proxy", config.get(f"{self.platform}_proxy", config.get("proxy")))
+        
+        self.format = user.get("format")
+
+        self.priority = user.get("priority", 0)
+
+        self.live_remux = user.get("live_remux", config.get("live_remux", False))
+
+        # 按时长（分钟）或大小（GB）切分录制文件
+        self.segment_time = user.get("segment_time", config.get("segment_time", 0))
+
+        self.segment_size = user.get("segment_size", config.get("segment_size", 0))
+
+        # 直播流意外断开后在该时长（秒）内重连并继续写入同一个文件，仅支持FLV和TS
+        self.reconnect_window = user.get("reconnect_window", config.get("reconnect_window", 0))
+
+        # 录制时修复FLV和TS的时间戳跳变，FLV写入关键帧索引
+        self.fix_timestamps = user.get("fix_timestamps", config.get("fix_timestamps", False))
+
+        # 录制引擎，asyncio引擎仅支持HTTP-FLV和普通HLS直播流，其他直播流仍使用streamlink
+        self.engine = user.get("engine", config.get("engine", "streamlink"))
+
+        self.stream_buffer = config.get("stream_buffer", 64)
+
+        self.output = user.get("output", config.get(f"{self.platform}_output", config.get("output", "output")))
+
+        self.batch_size = config.get(f"{self.platform}_batch_size", config.get("batch_size", 0))
+
+        self.batch_delay = config.get("batch_delay", 1)
+
+        # 订阅直播平台的开播推送，目前支持哔哩哔哩和Twitch
+        self.push = user.get("push", config.get("push", False))
+
+        # HLS多码率直播流的清晰度，best、worst或最高分辨率（例如720p）
+        self.quality = user.get("quality", config.get("quality", "best"))
+
+        # 每个输出的内存缓冲上限（MB），超过后暂存到磁盘
+        self.sink_buffer = config.get("sink_buffer", 16)
+
+        self.spill_dir = Path(config.get("cache_dir", "cache"), "spill")
+
+        # 缓冲写入文件的缓冲大小（MB），为0时使用streamlink的文件输出
+        self.write_buffer = user.get("write_buffer", config.get("write_buffer", 0))
+
+        # 预分配文件空间的大小（MB）、同步到磁盘的间隔（秒）和临时目录
+        self.preallocate = user.get("preallocate", config.get("preallocate", 0))
+
+        self.fsync_interval = user.get("fsync_interval", config.get("fsync_interval", 0))
+
+        self.scratch_dir = user.get("scratch_dir", config.get("scratch_dir"))
+
+        self.get_cookies()
 
-        self.headers = user.get("headers", {"User-Agent": "Mozilla/5.0 (Windows NT 6.1; WOW64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/39.0.2171.71 Safari/537.36"})
+        # 同一直播间的其他输出共用一个下载，只使用输出相关的配置
+        self.sinks = [self.new_sink(config, {**user, **extra}) for extra in user.get("outputs", [])]
 
-        self.cookies = user.get("cookies",config.get("Pandalive_cookies"))
+    def new_sink(self, config: dict, user: dict) -> "LiveRecoder":
+        sink = copy.copy(self)
+        user.pop("outputs")
+        sink.load_config(config, user)
+        return sink
 
-        self.proxy = user.get("proxy", config.get(f"{self.platform}_proxy", config.get("proxy")))
-        
-        self.format = user.get("format")
+    async def update(self, config: dict, user: dict):
+        """重新加载配置，正在录制时等录制结束后再加载，新配置从下次检测开始生效"""
+        if self.url is not None:
+            self.pending_update = (config, user)
+            logger.info(f"{self.flag} 配置已修改，当前录制结束后生效")
+            return
+        self.pending_update = None
+        self.load_config(config, user)
+        client_key = client_pool.get_key(self.proxy, self.headers, self.cookies)
+        if client_key != self.client_key:
+            old_key, self.client_key = self.client_key, client_key
+            client_pool.acquire(client_key)
+            await client_pool.release(old_key)
+        logger.info(f"{self.flag} 配置已更新")
 
-        self.output = user.get("output", config.get(f"{self.platform}_output", config.get("output", "output")))
+    def stop(self) -> bool:
+        """标记为停止检测，未在录制时返回True，可以直接取消任务"""
+        self.stopping = True
+        return self.url is None
 
-        self.get_cookies()
+    # 订阅开播推送，连接断开时返回或抛出异常，支持开播推送的平台需要实现
+    watch: Optional[Callable[[], Awaitable]] = None
+
+    # 支持批量检测的平台使用的批量检测类
+    batch_poller: Optional[Type[BatchPoller]] = None
 
-        self.client = self.get_client()
+    def get_batch_poller(self) -> Optional[BatchPoller]:
+        return self.batch_poller.get(self) if self.batch_poller else None
 
     async def start(self):
         logger.info(f"{self.flag} 正在检测直播状态")
+        scheduler.register(self)
+        # 上次退出时正在录制，不等待调度立即检测
+        if journal.was_live(self):
+            scheduler.wake(self)
+        watcher = asyncio.create_task(self.run_watch()) if self.push and self.watch else None
         try:
-            while True:
+            while not self.stopping:
+                if self.pending_update:
+                    await self.update(*self.pending_update)
+                await scheduler.wait(self)
                 try:
-                    await self.run()
-                    await asyncio.sleep(self.interval)
+                    self.poll_started = time.perf_counter()
+                    self.client_generation = client_pool.generations[self.client_key]
+                    try:
+                        await self.run()
+                    finally:
+                        # 检测失败时同样记录，便于找出超时的阶段
+                        self.observe_poll()
+                    scheduler.done(self)
                 except ConnectionError as error:
                     if "直播检测请求协议错误" not in str(error):
                         logger.error(error)
-                    await self.client.aclose()
-                    self.client = self.get_client()
+                    # 被限流时无需重建客户端
+                    if "直播检测请求被限流" not in str(error):
+                        await client_pool.reset(self.client_key, self.client_generation)
+                        session_cache.invalidate(self.client_key)
+                    self.detected_at = None
+                    scheduler.done(self, error=True)
                 except Exception as error:
                     logger.exception(f"{self.flag} 直播检测错误\n{repr(error)}")
+                    self.count_error("other")
+                    self.detected_at = None
+                    scheduler.done(self, error=True)
         except (SystemExit, KeyboardInterrupt, asyncio.CancelledError):
             logger.info(f"{self.flag} 接收到终止信号，正在关闭")
         finally:
-            await self.client.aclose()
-            for url in list(recording.keys()):
-                stream_fd, output = recording.pop(url)
+            if watcher:
+                watcher.cancel()
+            scheduler.unregister(self)
+            await client_pool.release(self.client_key)
+            # 只关闭自己的直播流，其他直播间的录制不受影响
+            if self.url in recording:
+                stream_fd, output = recording.pop(self.url)
                 stream_fd.close()
                 output.close()
             logger.info(f"{self.flag} 直播监控结束，资源已清理")
@@ -81,34 +2833,128 @@ class LiveRecoder:
     async def run(self):
         pass
 
+    async def run_watch(self):
+        if self.proxy:
+            logger.warning(f"{self.flag} 使用代理时不支持开播推送，仅轮询检测")
+            return
+        errors = 0
+        while True:
+            try:
+                await self.watch()
+            except (OSError, ConnectionError, ValueError, KeyError, TypeError, asyncio.TimeoutError) as error:
+                logger.warning(f"{self.flag} 开播推送连接断开\n{repr(error)}")
+            # 连接成功过则重新计算退避时间
+            errors = 1 if self.push_connected else errors + 1
+            self.push_connected = False
+            await asyncio.sleep(min(2 ** errors, 120))
+
+    def push_live(self):
+        logger.info(f"{self.flag} 收到开播推送，立即检测直播状态")
+        metrics.inc("liverecorder_push_events_total", platform=self.platform, room=self.id)
+        scheduler.wake(self)
+
     async def request(self, method, url, **kwargs):
+        kwargs.setdefault("timeout", self.interval)
+        start = time.monotonic()
+        with self.request_errors(), self.phase("request"):
+            async with client_pool.use(self.client_key) as client:
+                response = await client.request(method, url, **kwargs)
+        metrics.observe("liverecorder_poll_seconds", time.monotonic() - start, platform=self.platform, room=self.id)
+        self.check_status(response)
+        return response
+
+    async def request_text(self, method, url, done: Callable[[str], bool], **kwargs) -> str:
+        """流式读取网页，done返回True时停止读取并关闭连接，不再下载和解析剩余内容
+
+        done每读取一次都会被调用，传入目前读取的全部内容，应使用TextMarkers只查找新读取的部分
+        """
+        kwargs.setdefault("timeout", self.interval)
+        start = time.monotonic()
+        text = ""
+        with self.request_errors(), self.phase("request"):
+            async with client_pool.use(self.client_key) as client, client.stream(method, url, **kwargs) as response:
+                self.check_status(response)
+                stopped = False
+                async for chunk in response.aiter_text():
+                    text += chunk
+                    if done(text):
+                        stopped = True
+                        break
+                downloaded = response.num_bytes_downloaded
+                length = int(response.headers.get("Content-Length", 0))
+        metrics.observe("liverecorder_poll_seconds", time.monotonic() - start, platform=self.platform, room=self.id)
+        metrics.inc("liverecorder_poll_bytes_total", downloaded, platform=self.platform, room=self.id)
+        # 分块传输时无法得知网页大小，只统计提前停止的次数，节省的字节数只在有Content-Length时统计
+        if stopped:
+            metrics.inc("liverecorder_poll_early_exits_total", platform=self.platform, room=self.id)
+        if stopped and length > downloaded:
+            metrics.inc("liverecorder_poll_bytes_saved_total", length - downloaded, platform=self.platform, room=self.id)
+        return text
+
+    @contextmanager
+    def phase(self, name):
+        """统计本次检测中该阶段的耗时"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.phase_times[name] += time.perf_counter() - start
+
+    def observe_poll(self):
+        """记录本次检测各阶段的耗时，其余时间计为平台检测代码（解析网页和JSON等）的耗时"""
+        if self.poll_started is None:
+            return
+        total = time.perf_counter() - self.poll_started
+        phases, self.phase_times = self.phase_times, defaultdict(float)
+        self.poll_started = None
+        phases["handler"] = max(total - sum(phases.values()), 0)
+        for name, value in phases.items():
+            metrics.observe("liverecorder_phase_seconds", value, platform=self.platform, phase=name)
+
+    def resolve_streams(self, url, options=None) -> dict:
+        """使用streamlink插件解析直播流，在事件循环中同步执行，计入本次检测的耗时"""
+        with self.phase("resolve"):
+            return self.get_streamlink().streams(url, options)
+
+    @contextmanager
+    def request_errors(self):
         try:
-            response = await self.client.request(method, url, **kwargs)
-            return response
+            yield
         except httpx.ProtocolError as error:
+            self.count_error("protocol")
             raise ConnectionError(f"{self.flag} 直播检测请求协议错误\n{error}")
         except httpx.HTTPError as error:
+            self.count_error("http")
             raise ConnectionError(f"{self.flag} 直播检测请求错误\n{repr(error)}")
         except anyio.EndOfStream as error:
+            self.count_error("proxy")
             raise ConnectionError(f"{self.flag} 直播检测代理错误\n{error}")
+        except RuntimeError as error:
+            # 客户端已被关闭时按连接错误处理，重建客户端后下次检测即可恢复
+            if "client has been closed" not in str(error):
+                raise
+            self.count_error("closed")
+            raise ConnectionError(f"{self.flag} 直播检测客户端已关闭\n{error}")
 
-    def get_client(self):
-        client_kwargs = {
-            "http2": True,
-            "timeout": self.interval,
-            "limits": httpx.Limits(
-                max_keepalive_connections=100, keepalive_expiry=self.interval * 2
-            ),
-            "headers": self.headers,
-            "cookies": self.cookies,
-        }
-        # 检查是否有设置代理
-        if self.proxy:
-            if "socks" in self.proxy:
-                client_kwargs["transport"] = AsyncProxyTransport.from_url(self.proxy)
-            else:
-                client_kwargs["proxies"] = self.proxy
-        return httpx.AsyncClient(**client_kwargs)
+    def check_status(self, response: httpx.Response):
+        if response.status_code in (412, 429):
+            self.count_error("rate_limit")
+            raise ConnectionError(f"{self.flag} 直播检测请求被限流：{response.status_code}")
+
+    def count_error(self, kind):
+        metrics.inc("liverecorder_poll_errors_total", platform=self.platform, room=self.id, kind=kind)
+
+    def count_first_byte(self):
+        if self.detected_at is not None:
+            elapsed = time.monotonic() - self.detected_at
+            logger.info(f"{self.flag} 开播至首字节耗时：{elapsed:.2f}秒")
+            metrics.observe("liverecorder_first_byte_seconds", elapsed, platform=self.platform, room=self.id)
+            self.detected_at = None
+
+    @property
+    def client(self) -> httpx.AsyncClient:
+        """每次使用时从连接池取出当前的客户端，客户端被重建后自动切换"""
+        return client_pool.clients[self.client_key]
 
     def get_cookies(self):
         if self.cookies:
@@ -136,6 +2982,127 @@ class LiveRecoder:
         return filename
 
     def get_streamlink(self):
+        if self.detected_at is None:
+            self.detected_at = time.monotonic()
+        return session_cache.get(self.session_key, self.new_streamlink)
+
+    # streamlink插件将请求头设置为直播间链接时，每个直播间使用独立的会话
+    session_per_room = False
+
+    @property
+    def session_key(self) -> tuple:
+        return self.platform, self.id if self.session_per_room else None, self.client_key
+
+    async def preconnect(self, *urls):
+        """提前解析CDN域名并建立连接放入streamlink会话的连接池，录制时直接复用"""
+        session = self.get_streamlink()
+        loop = asyncio.get_running_loop()
+        start = time.monotonic()
+
+        def resolve(url):
+            # 未开启DNS缓存时提前解析的结果不会被复用
+            if dns_cache.installed:
+                parts = urlsplit(url)
+                socket.getaddrinfo(parts.hostname, parts.port or 443, type=socket.SOCK_STREAM)
+
+        def connect(url):
+            # asyncio引擎不使用streamlink的连接池，只提前解析域名
+            if self.engine == "asyncio":
+                return resolve(url)
+            import urllib3
+
+            # 放入连接池需要使用urllib3的私有方法，只在已验证的1.x和2.x版本上使用，其他版本只提前解析域名
+            if urllib3.__version__.split(".")[0] not in ("1", "2"):
+                return resolve(url)
+            adapter = session.http.get_adapter(url)
+            # 使用与requests发送请求时相同的连接池
+            settings = session.http.merge_environment_settings(url, {}, None, None, None)
+            if hasattr(adapter, "get_connection_with_tls_context"):
+                import requests
+
+                request = requests.Request("GET", url).prepare()
+                pool = adapter.get_connection_with_tls_context(request, settings["verify"], settings["proxies"])
+            else:
+                pool = adapter.get_connection(url, settings["proxies"])
+            connection = pool._get_conn()
+            try:
+                connection.connect()
+            except Exception:
+                connection.close()
+                raise
+            pool._put_conn(connection)
+
+        results = await asyncio.gather(
+            *(asyncio.wait_for(loop.run_in_executor(None, connect, url), 5) for url in dict.fromkeys(urls)),
+            return_exceptions=True,
+        )
+        for url, result in zip(dict.fromkeys(urls), results):
+            if isinstance(result, BaseException):
+                logger.debug(f"{self.flag} 预连接失败：{urlsplit(url).hostname}\n{repr(result)}")
+        logger.debug(f"{self.flag} 预连接{len(results)}个CDN域名耗时：{time.monotonic() - start:.2f}秒")
+
+    # 优先请求上次最快的CDN，其他候选链接延迟该秒数后再请求
+    race_delay = 0.3
+
+    async def race_playlists(self, urls: List[str], **kwargs) -> Optional[Tuple[str, str]]:
+        """同时请求所有候选CDN的HLS播放列表，返回最先成功的链接和内容，全部失败时返回None"""
+        urls = list(dict.fromkeys(urls))
+        preferred = self.cdn_host if self.cdn_host in (urlsplit(url).hostname for url in urls) else None
+        kwargs.setdefault("timeout", self.interval)
+        start = time.monotonic()
+
+        async def fetch(url):
+            if preferred and urlsplit(url).hostname != preferred:
+                await asyncio.sleep(self.race_delay)
+            async with client_pool.use(self.client_key) as client:
+                response = await client.get(url, **kwargs)
+            response.raise_for_status()
+            if not response.text.startswith("#EXTM3U"):
+                raise ValueError("不是有效的HLS播放列表")
+            return url, response.text
+
+        tasks = [asyncio.create_task(fetch(url)) for url in urls]
+        try:
+            for future in asyncio.as_completed(tasks):
+                try:
+                    url, text = await future
+                except (httpx.HTTPError, ValueError) as error:
+                    logger.debug(f"{self.flag} 直播源获取失败\n{repr(error)}")
+                    continue
+                self.cdn_host = urlsplit(url).hostname
+                metrics.observe("liverecorder_cdn_race_seconds", time.monotonic() - start, platform=self.platform)
+                logger.debug(f"{self.flag} 最快的直播源：{url}，耗时{time.monotonic() - start:.2f}秒")
+                return url, text
+        finally:
+            for task in tasks:
+                task.cancel()
+        return None
+
+    def select_variant(self, url, text, **kwargs) -> "HLSStream":
+        """按quality配置从已下载的主播放列表中选择清晰度，无需streamlink再次请求"""
+        from streamlink.stream.hls import HLSStream, parse_m3u8
+
+        variants = [playlist for playlist in parse_m3u8(text, url).playlists if not playlist.is_iframe]
+        # 不是主播放列表时直接录制
+        if not variants:
+            return HLSStream(self.get_streamlink(), url, **kwargs)
+
+        def rank(playlist):
+            resolution = playlist.stream_info.resolution
+            return (resolution.height if resolution else 0), playlist.stream_info.bandwidth or 0
+
+        variants.sort(key=rank)
+        if self.quality == "worst":
+            variant = variants[0]
+        elif match := re.fullmatch(r"(\d+)p", self.quality):
+            variant = ([item for item in variants if rank(item)[0] <= int(match[1])] or variants[:1])[-1]
+        else:
+            variant = variants[-1]
+        return HLSStream(self.get_streamlink(), variant.uri, url_master=url, **kwargs)
+
+    def new_streamlink(self):
+        import streamlink.session
+
         session = streamlink.session.Streamlink(
             {"stream-segment-timeout": 60, "hls-segment-queue-threshold": 10}
         )
@@ -151,37 +3118,236 @@ class LiveRecoder:
             session.set_option("http-cookies", self.cookies)
         return session
 
-    def run_record(self, stream: Union[StreamIO, HTTPStream], url, modelname, format):
+    async def record(self, stream, url, modelname, format):
+        metrics.set("liverecorder_live", 1, platform=self.platform, room=self.id)
+        self.url = url
+        # 检测到开播后的录制时间不计入检测耗时
+        self.observe_poll()
+        from streamlink.stream import HTTPStream, HLSStream
+
+        # streamlink_cli导入时会将SIGINT和SIGTERM替换为直接退出，只能在主线程导入，导入后恢复原来的处理，由asyncio取消任务后正常关闭
+        handlers = {signum: signal.getsignal(signum) for signum in (signal.SIGINT, signal.SIGTERM)}
+        # 在主线程提前导入，录制线程中再导入FileOutput和StreamRunner时不会修改信号处理
+        import streamlink_cli.output  # noqa: F401
+        import streamlink_cli.streamrunner  # noqa: F401
+
+        for signum, handler in handlers.items():
+            # 由非Python代码设置的处理无法恢复
+            if handler is not None:
+                signal.signal(signum, handler)
+        try:
+            if self.engine == "asyncio" and type(stream) in (HTTPStream, HLSStream):
+                try:
+                    return await self.run_record_async(stream, url, modelname, format)
+                except UnsupportedStreamError as error:
+                    logger.info(f"{self.flag} {error}，使用streamlink录制")
+            return await supervisor.run(self, self.run_record, stream, url, modelname, format)
+        finally:
+            self.url = None
+            metrics.set("liverecorder_live", 0, platform=self.platform, room=self.id)
+
+    def get_record_filename(self, modelname, format):
         # 如果不存在则创建，否则不创建
         if not os.path.exists(os.path.join(self.output, modelname)):
             os.makedirs(os.path.join(self.output, modelname))
+        # 开启实时封装时直接输出为目标格式
+        live_remux = self.live_remux and self.format and self.format != format
         # 获取输出文件名
-        filename = f"{modelname}/" + self.get_filename(modelname, format)
-        # filename = self.get_filename(modelname, format)
+        filename = f"{modelname}/" + self.get_filename(modelname, self.format if live_remux else format)
+        return filename, live_remux
+
+    def run_record(self, stream: Union["StreamIO", "HTTPStream"], url, modelname, format):
+        filename, live_remux = self.get_record_filename(modelname, format)
         try:
             if stream:
+                self.live_starts.append(time.time())
                 logger.info(f"{self.flag} 开始录制：{filename}")
+                output, finish = self.get_record_output(modelname, filename, live_remux, format)
+                journal.start(self, filename)
                 # 调用streamlink录制直播
-                result = self.stream_writer(stream, url, filename)
-                # 录制成功、format配置存在且不等于直播平台默认格式时运行ffmpeg封装
-                if result and self.format and self.format != format:
-                    self.run_ffmpeg(filename, format)
+                result = self.stream_writer(stream, url, filename, output)
+                if result:
+                    finish()
                 logger.info(f"{self.flag} 停止录制：{filename}")
             else:
                 logger.error(f"{self.flag} 无可用直播源：{filename}")
         finally:
+            journal.end(self)
+            self.detected_at = None
+            self.last_live = time.time()
+            recording.pop(url, None)
+            logger.info(f"{self.flag} 停止录制：{filename}")
+
+    async def run_record_async(self, stream: Union["HTTPStream", "HLSStream"], url, modelname, format):
+        filename, live_remux = self.get_record_filename(modelname, format)
+        try:
+            self.live_starts.append(time.time())
+            logger.info(f"{self.flag} 开始录制：{filename}")
+            logger.info(f"{self.flag} 获取到直播流链接：{filename}\n{stream.url}")
+            output, finish = self.get_record_output(modelname, filename, live_remux, format)
+            engine = AsyncStreamEngine(self, stream, output, filename)
+            journal.start(self, filename)
+            recording[url] = (engine, output)
+            metrics.set("liverecorder_recording", 1, platform=self.platform, room=self.id)
+            if await engine.run():
+                finish()
+        finally:
+            journal.end(self)
+            metrics.set("liverecorder_recording", 0, platform=self.platform, room=self.id)
+            self.detected_at = None
+            self.last_live = time.time()
             recording.pop(url, None)
             logger.info(f"{self.flag} 停止录制：{filename}")
 
-    def stream_writer(self, stream, url, filename):
+    def get_record_output(self, modelname, filename, live_remux, format) -> Tuple[Output, Callable[[], None]]:
+        """创建录制输出和录制成功后的封装回调，配置了多个输出或开启直播转发时由一个下载扇出到所有输出"""
+        outputs = [(self, live_remux, self.get_output(modelname, filename, format))]
+        for sink in self.sinks:
+            # 与第一个输出同名时使用相同的文件名，否则使用该输出的名称
+            sink_modelname = modelname if sink.name == self.name else sink.name or modelname
+            sink_filename, sink_live_remux = sink.get_record_filename(sink_modelname, format)
+            logger.info(f"{self.flag} 同时录制到：{sink.output}/{sink_filename}")
+            outputs.append((sink, sink_live_remux, sink.get_output(sink_modelname, sink_filename, format)))
+        if len(outputs) > 1 or live_server.server:
+            output = FanoutOutput([item[2] for item in outputs], self, format)
+        else:
+            output = outputs[0][2]
+        if self.reconnect_window and format in ("flv", "ts"):
+            output = ResumableOutput(output, format)
+
+        def finish():
+            # 录制成功、format配置存在且不等于直播平台默认格式时运行ffmpeg封装
+            for recorder, remuxed, part in outputs:
+                if recorder.format and recorder.format != format and not remuxed:
+                    recorder.run_ffmpeg(part.filename, format)
+
+        return output, finish
+
+    def get_output(self, modelname, filename, format):
+        path = Path(f"{self.output}/{filename}")
+        extension = path.suffix[1:]
+        live_remux = extension != format
+
+        def new_part(part_path):
+            if live_remux:
+                journal.open_file(self, part_path)
+                return FFmpegOutput(part_path, format)
+            # 录制结束后需要ffmpeg封装时记录目标文件，崩溃后重启可以继续封装
+            target = part_path.with_suffix(f".{self.format}") if self.format and self.format != format else None
+            if self.write_buffer:
+                output = BufferedFileOutput(part_path, self)
+                journal.open_file(self, part_path, target, output.write_path, bool(output.preallocate))
+            else:
+                from streamlink_cli.output import FileOutput
+
+                output = FileOutput(part_path)
+                journal.open_file(self, part_path, target)
+            if self.fix_timestamps and format in ("flv", "ts"):
+                return TimestampFixOutput(output, part_path, format, self)
+            return output
+
+        def on_rotate(part_path):
+            logger.info(f"{self.flag} 录制文件已切分：{part_path}")
+            journal.close_file(part_path)
+            # 切分出的文件无需等待录制结束即可封装
+            if self.format and self.format != format and not live_remux:
+                self.run_ffmpeg(part_path, format)
+
+        if self.segment_time or self.segment_size:
+            return SegmentedOutput(
+                path,
+                format,
+                new_part,
+                lambda: Path(f"{self.output}/{modelname}/{self.get_filename(modelname, extension)}"),
+                on_rotate,
+                self.segment_time,
+                self.segment_size,
+            )
+        return new_part(path)
+
+    def reconnect_delays(self):
+        """重连前的等待时间，按指数退避直到超出reconnect_window"""
+        deadline = time.monotonic() + self.reconnect_window
+        # 第一次立即重连
+        delay = 0
+        while (remaining := deadline - time.monotonic()) > 0:
+            yield min(delay, remaining)
+            delay = min(max(delay * 2, 1), 10)
+
+    def count_reconnect(self, output: ResumableOutput, filename, gap):
+        output.resume(gap)
+        logger.warning(f"{self.flag} 直播流中断{gap:.1f}秒后重新连接，继续写入：{filename}")
+        metrics.inc("liverecorder_reconnects_total", platform=self.platform, room=self.id)
+        metrics.observe("liverecorder_stream_gap_seconds", gap, platform=self.platform, room=self.id)
+
+    @staticmethod
+    def open_stream(stream):
+        """打开直播流并预读8192字节，streamlink_cli的open_stream使用全局变量保存直播流，多个录制线程同时打开时会互相覆盖"""
+        from streamlink.exceptions import StreamError
+
+        try:
+            stream_fd = stream.open()
+        except StreamError as error:
+            raise StreamError(f"Could not open stream: {error}") from error
+        try:
+            prebuffer = stream_fd.read(8192)
+        except OSError as error:
+            stream_fd.close()
+            raise StreamError(f"Failed to read data from stream: {error}") from error
+        if not prebuffer:
+            stream_fd.close()
+            raise StreamError("No data returned from stream")
+        return stream_fd, prebuffer
+
+    def reopen_stream(self, stream, url, filename, output: ResumableOutput):
+        """使用已获取的直播流链接重新打开直播流，链接失效、超出重连时长或停止录制时返回None"""
+        ended = time.monotonic()
+        for delay in self.reconnect_delays():
+            time.sleep(delay)
+            if url not in recording or not output.opened:
+                return None
+            try:
+                stream_fd, prebuffer = self.open_stream(stream)
+            except Exception as error:
+                if re.search(r"\b(403|404|410)\b", str(error)):
+                    logger.warning(f"{self.flag} 直播流链接已失效，停止重连：{filename}\n{error}")
+                    return None
+                logger.info(f"{self.flag} 直播流重连失败：{filename}\n{error}")
+                continue
+            if url not in recording or not output.opened:
+                stream_fd.close()
+                return None
+            recording[url] = (stream_fd, output)
+            self.count_reconnect(output, filename, time.monotonic() - ended)
+            return stream_fd, prebuffer
+        return None
+
+    def stream_writer(self, stream, url, filename, output):
+        from streamlink_cli.streamrunner import StreamRunner
+
         logger.info(f"{self.flag} 获取到直播流链接：{filename}\n{stream.url}")
-        output = FileOutput(Path(f"{self.output}/{filename}"))
         try:
-            stream_fd, prebuffer = open_stream(stream)
+            start = time.perf_counter()
+            stream_fd, prebuffer = self.open_stream(stream)
+            metrics.observe("liverecorder_phase_seconds", time.perf_counter() - start, platform=self.platform, phase="open")
+            self.count_first_byte()
             output.open()
             recording[url] = (stream_fd, output)
             logger.info(f"{self.flag} 正在录制：{filename}")
-            StreamRunner(stream_fd, output, show_progress=True).run(prebuffer)
+            metrics.set("liverecorder_recording", 1, platform=self.platform, room=self.id)
+            while True:
+                try:
+                    StreamRunner(stream_fd, MeteredOutput(output, self), show_progress=True).run(prebuffer)
+                except OSError as error:
+                    # 写入文件出错时不重连
+                    if not isinstance(output, ResumableOutput) or "Error when writing to output" in str(error):
+                        raise
+                    logger.warning(f"{self.flag} 直播流读取错误：{filename}\n{error}")
+                if not isinstance(output, ResumableOutput):
+                    break
+                if not (reopened := self.reopen_stream(stream, url, filename, output)):
+                    break
+                stream_fd, prebuffer = reopened
             return True
         except Exception as error:
             if "timeout" in str(error):
@@ -197,40 +3363,101 @@ class LiveRecoder:
             else:
                 logger.exception(f"{self.flag} 直播录制错误：{filename}\n{error}")
         finally:
+            metrics.set("liverecorder_recording", 0, platform=self.platform, room=self.id)
             output.close()
 
-    def run_ffmpeg(self, filename, format):
-        logger.info(f"{self.flag}开始ffmpeg封装：{filename}")
-        new_filename = filename.replace(f".{format}", f".{self.format}")
-        ffmpeg.input(f"{self.output}/{filename}", flags="global_header").output(
-            f"{self.output}/{new_filename}",
-            codec="copy",
-            map_metadata="-1",
-            movflags="faststart",
-        ).global_args("-hide_banner").run()
-        os.remove(f"{self.output}/{filename}")
+    def run_ffmpeg(self, path: Path, format):
+        postprocessor.submit(self.flag, str(path), str(path.with_suffix(f".{self.format}")))
 
 
 class Bilibili(LiveRecoder):
+    batch_poller = BilibiliBatchPoller
+
+    def __init__(self, config: dict, user: dict):
+        super().__init__(config, user)
+        self.push_url = config.get("Bilibili_push_url", "wss://broadcastlv.chat.bilibili.com/sub")
+        self.room_id = None
+
     async def run(self):
         url = f"https://live.bilibili.com/{self.id}"
         if url not in recording:
-            response = (
-                await self.request(
-                    method="GET",
-                    url="https://api.live.bilibili.com/room/v1/Room/get_info",
-                    params={"room_id": self.id},
-                )
-            ).json()
-            if response["data"]["live_status"] == 1:
-                title = response["data"]["title"]
+            data = await self.get_room_info()
+            if data["live_status"] == 1:
+                title = data["title"]
                 stream = (
-                    self.get_streamlink().streams(url).get("best")
+                    self.resolve_streams(url).get("best")
                 )  # HTTPStream[flv]
-                await asyncio.to_thread(self.run_record, stream, url, title, "flv")
+                await self.record(stream, url, title, "flv")
+
+    async def get_room_info(self):
+        if poller := self.get_batch_poller():
+            if data := await poller.query(self):
+                return data
+            # 批量检测时未占用限速令牌，单独请求前补上
+            await scheduler.get_bucket(self.platform).acquire()
+        # 未开启批量检测或批量结果中没有该直播间时单独请求
+        response = (
+            await self.request(
+                method="GET",
+                url="https://api.live.bilibili.com/room/v1/Room/get_info",
+                params={"room_id": self.id},
+            )
+        ).json()
+        return response["data"]
+
+    async def watch(self):
+        # 弹幕服务器需要使用长房间号
+        if self.room_id is None:
+            self.room_id = (await self.get_room_info())["room_id"]
+        websocket = await WebSocket.connect(self.push_url)
+        try:
+            auth = {"uid": 0, "roomid": self.room_id, "protover": 2, "platform": "web", "type": 2}
+            await websocket.send(self.danmaku_packet(7, json.dumps(auth).encode()))
+            self.push_connected = True
+            async for data in websocket.iter_messages(30, self.danmaku_packet(2, b"")):
+                for command in self.parse_danmaku(data):
+                    if command.get("cmd") == "LIVE":
+                        self.push_live()
+        finally:
+            websocket.close()
+
+    @staticmethod
+    def danmaku_packet(operation, body: bytes):
+        # 包长度、头部长度、协议版本、操作码、序号
+        return struct.pack(">IHHII", 16 + len(body), 16, 1, operation, 1) + body
+
+    @classmethod
+    def parse_danmaku(cls, data: bytes):
+        while len(data) >= 16:
+            length, header_length, version, operation, _ = struct.unpack(">IHHII", data[:16])
+            body = data[header_length:length]
+            data = data[length:]
+            # 操作码5为通知消息，协议版本2为zlib压缩的多条消息
+            if operation != 5:
+                continue
+            if version == 2:
+                yield from cls.parse_danmaku(zlib.decompress(body))
+            elif version in (0, 1):
+                yield json.loads(body)
 
 
 class Douyu(LiveRecoder):
+    requires = LiveRecoder.requires + ("jsengine",)
+    crypto_js_urls = (
+        "https://cdn.staticfile.org/crypto-js/4.1.1/crypto-js.min.js",
+        "https://cdnjs.cloudflare.com/ajax/libs/crypto-js/4.1.1/crypto-js.min.js",
+    )
+    # 所有斗鱼直播间共用的crypto-js代码
+    crypto_js: Optional[str] = None
+
+    def __init__(self, config: dict, user: dict):
+        super().__init__(config, user)
+        self.cache_dir = config.get("cache_dir", "cache")
+        self.js_ttl = config.get("Douyu_js_ttl", 3600)
+        self.js_enc = None
+        self.js = None
+        self.js_expires = 0
+
     async def run(self):
         url = f"https://www.douyu.com/{self.id}"
         if url not in recording:
@@ -244,63 +3471,109 @@ class Douyu(LiveRecoder):
                 modelname = response["data"]["owner_name"]
                 if self.name:
                     modelname = self.name
+                from streamlink.stream import HTTPStream
+
                 stream = HTTPStream(
                     self.get_streamlink(), await self.get_live()
                 )  # HTTPStream[flv]
-                await asyncio.to_thread(self.run_record, stream, url, modelname, "flv")
+                await self.record(stream, url, modelname, "flv")
 
-    async def get_js(self):
-        response = (
-            await self.request(
-                method="POST",
-                url=f"https://www.douyu.com/swf_api/homeH5Enc?rids={self.id}",
-            )
-        ).json()
-        js_enc = response["data"][f"room{self.id}"]
-        crypto_js = (
-            await self.request(
-                method="GET",
-                url="https://cdn.staticfile.org/crypto-js/4.1.1/crypto-js.min.js",
-            )
-        ).text
-        return jsengine.JSEngine(js_enc + crypto_js)
+    async def get_crypto_js(self):
+        # 依次使用内存缓存、本地缓存和CDN下载，CDN无法访问时仍可签名
+        if Douyu.crypto_js:
+            return Douyu.crypto_js
+        cache_file = Path(self.cache_dir, "crypto-js.min.js")
+        if cache_file.exists():
+            Douyu.crypto_js = cache_file.read_text(encoding="utf-8")
+            return Douyu.crypto_js
+        for crypto_js_url in self.crypto_js_urls:
+            try:
+                response = await self.request(method="GET", url=crypto_js_url)
+            except ConnectionError as error:
+                logger.warning(error)
+                continue
+            if response.status_code == 200:
+                cache_file.parent.mkdir(parents=True, exist_ok=True)
+                cache_file.write_text(response.text, encoding="utf-8")
+                Douyu.crypto_js = response.text
+                return Douyu.crypto_js
+        raise ConnectionError(f"{self.flag} crypto-js下载失败")
+
+    async def get_js(self, refresh=False):
+        # 加密代码仅在签名失败时重新获取，js引擎超过有效期后重建
+        if refresh or not self.js_enc:
+            response = (
+                await self.request(
+                    method="POST",
+                    url=f"https://www.douyu.com/swf_api/homeH5Enc?rids={self.id}",
+                )
+            ).json()
+            self.js_enc = response["data"][f"room{self.id}"]
+            self.js = None
+        if not self.js or time.monotonic() > self.js_expires:
+            import jsengine
+
+            self.js = jsengine.JSEngine(self.js_enc + await self.get_crypto_js())
+            self.js_expires = time.monotonic() + self.js_ttl
+        return self.js
 
     async def get_live(self):
-        did = uuid.uuid4().hex
-        tt = str(int(time.time()))
-        params = {"cdn": "tct-h5", "did": did, "tt": tt, "rate": 0}
-        js = await self.get_js()
-        query = js.call("ub98484234", self.id, did, tt)
-        params.update({k: v[0] for k, v in parse_qs(query).items()})
-        response = (
-            await self.request(
-                method="POST",
-                url=f"https://www.douyu.com/lapi/live/getH5Play/{self.id}",
-                params=params,
-            )
-        ).json()
-        return f"{response['data']['rtmp_url']}/{response['data']['rtmp_live']}"
+        for refresh in (False, True):
+            did = uuid.uuid4().hex
+            tt = str(int(time.time()))
+            params = {"cdn": "tct-h5", "did": did, "tt": tt, "rate": 0}
+            js = await self.get_js(refresh)
+            try:
+                query = js.call("ub98484234", self.id, did, tt)
+            except Exception as error:
+                if refresh:
+                    raise
+                logger.warning(f"{self.flag} 斗鱼签名错误，重新获取加密代码\n{repr(error)}")
+                continue
+            params.update({k: v[0] for k, v in parse_qs(query).items()})
+            response = (
+                await self.request(
+                    method="POST",
+                    url=f"https://www.douyu.com/lapi/live/getH5Play/{self.id}",
+                    params=params,
+                )
+            ).json()
+            if response["error"] == 0:
+                return f"{response['data']['rtmp_url']}/{response['data']['rtmp_live']}"
+            if refresh:
+                break
+            logger.warning(f"{self.flag} 斗鱼签名校验失败，重新获取加密代码\n{response['msg']}")
+        raise ValueError(f"{self.flag} 斗鱼直播流获取失败\n{response}")
 
 
 class Huya(LiveRecoder):
+    @staticmethod
+    def page_done() -> Callable[[str], bool]:
+        # 未开播或已找到开播状态和标题时停止读取网页
+        offline, live, title = TextMarkers('"isOn":false'), TextMarkers('"isOn":true'), TextMarkers('"introduction":"', '"')
+        return lambda text: offline.feed(text) or (live.feed(text) and title.feed(text))
+
     async def run(self):
         url = f"https://www.huya.com/{self.id}"
         if url not in recording:
-            response = (await self.request(method="GET", url=url)).text
+            response = await self.request_text(method="GET", url=url, done=self.page_done())
             if '"isOn":true' in response:
                 title = re.search('"introduction":"(.*?)"', response).group(1)
                 stream = (
-                    self.get_streamlink().streams(url).get("best")
+                    self.resolve_streams(url).get("best")
                 )  # HTTPStream[flv]
-                await asyncio.to_thread(self.run_record, stream, url, title, "flv")
+                await self.record(stream, url, title, "flv")
 
 
 class Douyin(LiveRecoder):
     async def run(self):
         url = f"https://live.douyin.com/{self.id}"
         if url not in recording:
-            if not self.client.cookies:
-                await self.client.get(url="https://live.douyin.com/")  # 获取ttwid
+            # 所有平台共用客户端和Cookie，只检查抖音需要的ttwid
+            if "ttwid" not in self.client.cookies:
+                with self.request_errors():
+                    async with client_pool.use(self.client_key) as client:
+                        await client.get(url="https://live.douyin.com/")  # 获取ttwid
             response = (
                 await self.request(
                     method="GET",
@@ -326,14 +3599,38 @@ class Douyin(LiveRecoder):
                         if quality_data := stream_data['data'].get(quality_code):
                             live_url = quality_data['main']['flv']
                             break
+                    await self.preconnect(live_url)
+                    from streamlink.stream import HTTPStream
+
                     stream = HTTPStream(
                         self.get_streamlink(),
                         live_url
                     )  # HTTPStream[flv]
-                    await asyncio.to_thread(self.run_record, stream, url, title, "flv")
+                    await self.record(stream, url, title, "flv")
 
 
 class Youtube(LiveRecoder):
+    @staticmethod
+    def find_key(value, key):
+        """递归查找任意层级的key，结果与jsonpath的$..key相同，但不需要为每个节点创建匹配对象"""
+        if isinstance(value, dict):
+            for name, item in value.items():
+                if name == key:
+                    yield item
+                yield from Youtube.find_key(item, key)
+        elif isinstance(value, list):
+            for item in value:
+                yield from Youtube.find_key(item, key)
+
+    @staticmethod
+    def is_live(value) -> bool:
+        """在任意层级查找"style": "LIVE"，找到后立即返回，无需序列化整个视频信息"""
+        if isinstance(value, dict):
+            return value.get("style") == "LIVE" or any(Youtube.is_live(item) for item in value.values())
+        if isinstance(value, list):
+            return any(Youtube.is_live(item) for item in value)
+        return False
+
     async def run(self):
         response = (
             await self.request(
@@ -357,62 +3654,87 @@ class Youtube(LiveRecoder):
                 },
             )
         ).json()
-        jsonpath = parse("$..videoWithContextRenderer").find(response)
-        for match in jsonpath:
-            video = match.value
-            if '"style": "LIVE"' in json.dumps(video):
+        for video in self.find_key(response, "videoWithContextRenderer"):
+            if self.is_live(video):
                 url = f"https://www.youtube.com/watch?v={video['videoId']}"
                 title = video["headline"]["runs"][0]["text"]
                 if url not in recording:
                     stream = (
-                        self.get_streamlink().streams(url).get("best")
+                        self.resolve_streams(url).get("best")
                     )  # HLSStream[mpegts]
                     # FIXME:多开直播间中断
                     asyncio.create_task(
-                        asyncio.to_thread(self.run_record, stream, url, title, "ts")
+                        self.record(stream, url, title, "ts")
                     )
 
 
 class Twitch(LiveRecoder):
+    client_id = "kimne78kx3ncx6brgo4mv6wki5h1ko"
+    batch_poller = TwitchBatchPoller
+
     async def run(self):
         url = f"https://www.twitch.tv/{self.id}"
         if url not in recording:
-            response = (
-                await self.request(
-                    method="POST",
-                    url="https://gql.twitch.tv/gql",
-                    headers={"Client-Id": "kimne78kx3ncx6brgo4mv6wki5h1ko"},
-                    json=[
-                        {
-                            "operationName": "StreamMetadata",
-                            "variables": {"channelLogin": self.id},
-                            "extensions": {
-                                "persistedQuery": {
-                                    "version": 1,
-                                    "sha256Hash": "a647c2a13599e5991e175155f798ca7f1ecddde73f7f341f39009c14dbf59962",
-                                }
-                            },
-                        }
-                    ],
-                )
-            ).json()
-            if response[0]["data"]["user"]["stream"]:
+            response = await self.get_stream_metadata()
+            if response["data"]["user"]["stream"]:
                 modelname = self.id
                 if self.name:
                     modelname = self.name
+                from streamlink.options import Options
+
                 options = Options()
                 options.set("disable-ads", True)
                 stream = (
-                    self.get_streamlink().streams(url, options).get("best")
+                    self.resolve_streams(url, options).get("best")
                 )  # HLSStream[mpegts]
-                await asyncio.to_thread(self.run_record, stream, url, modelname, "ts")
+                await self.record(stream, url, modelname, "ts")
+
+    @staticmethod
+    def stream_metadata_query(login):
+        return {
+            "operationName": "StreamMetadata",
+            "variables": {"channelLogin": login},
+            "extensions": {
+                "persistedQuery": {
+                    "version": 1,
+                    "sha256Hash": "a647c2a13599e5991e175155f798ca7f1ecddde73f7f341f39009c14dbf59962",
+                }
+            },
+        }
+
+    async def get_stream_metadata(self):
+        if poller := self.get_batch_poller():
+            if data := await poller.query(self):
+                return data
+            # 批量检测时未占用限速令牌，单独请求前补上
+            await scheduler.get_bucket(self.platform).acquire()
+        response = (
+            await self.request(
+                method="POST",
+                url="https://gql.twitch.tv/gql",
+                headers={"Client-Id": self.client_id},
+                json=[self.stream_metadata_query(self.id)],
+            )
+        ).json()
+        return response[0]
+
+    async def watch(self):
+        user = (await self.get_stream_metadata())["data"]["user"]
+        await twitch_pubsub.listen(self, user["id"])
 
 
 class Niconico(LiveRecoder):
+    @staticmethod
+    def page_done() -> Callable[[str], bool]:
+        # 未开播或已找到开播状态和标题时停止读取网页
+        status = TextMarkers('"content_status":"', '"')
+        script = TextMarkers('<script type="application/ld+json">', "</script>")
+        return lambda text: status.feed(text) and (status.value(text) != "ON_AIR" or script.feed(text))
+
     async def run(self):
         url = f"https://live.nicovideo.jp/watch/{self.id}"
         if url not in recording:
-            response = (await self.request(method="GET", url=url)).text
+            response = await self.request_text(method="GET", url=url, done=self.page_done())
             if '"content_status":"ON_AIR"' in response:
                 title = json.loads(
                     re.search(
@@ -420,9 +3742,9 @@ class Niconico(LiveRecoder):
                     ).group(1)
                 )["name"]
                 stream = (
-                    self.get_streamlink().streams(url).get("best")
+                    self.resolve_streams(url).get("best")
                 )  # HLSStream[mpegts]
-                await asyncio.to_thread(self.run_record, stream, url, title, "ts")
+                await self.record(stream, url, title, "ts")
 
 
 class Twitcasting(LiveRecoder):
@@ -437,15 +3759,23 @@ class Twitcasting(LiveRecoder):
                 )
             ).json()
             if response:
-                response = (await self.request(method="GET", url=url)).text
+                # 标题在网页开头，找到后停止读取网页
+                response = await self.request_text(
+                    method="GET",
+                    url=url,
+                    done=TextMarkers('<meta name="twitter:title" content="', '">').feed,
+                )
                 title = re.search(
                     '<meta name="twitter:title" content="(.*?)">', response
                 ).group(1)
-                stream = self.get_streamlink().streams(url).get("best")  # Stream[mp4]
-                await asyncio.to_thread(self.run_record, stream, url, title, "mp4")
+                stream = self.resolve_streams(url).get("best")  # Stream[mp4]
+                await self.record(stream, url, title, "mp4")
 
 
 class Afreeca(LiveRecoder):
+    # 插件将Referer设置为直播间链接
+    session_per_room = True
+
     async def run(self):
         url = f"https://play.afreecatv.com/{self.id}"
         if url not in recording:
@@ -462,9 +3792,9 @@ class Afreeca(LiveRecoder):
                 if self.name:
                     modelname = self.name
                 stream = (
-                    self.get_streamlink().streams(url).get("best")
+                    self.resolve_streams(url).get("best")
                 )  # HLSStream[mpegts]
-                await asyncio.to_thread(self.run_record, stream, url, modelname, "ts")
+                await self.record(stream, url, modelname, "ts")
 
 
 class Pandalive(LiveRecoder):
@@ -486,9 +3816,9 @@ class Pandalive(LiveRecoder):
                 if self.name:
                     modelname = self.name
                 stream = (
-                    self.get_streamlink().streams(url).get("best")
+                    self.resolve_streams(url).get("best")
                 )  # HLSStream[mpegts]
-                await asyncio.to_thread(self.run_record, stream, url, modelname, "ts")
+                await self.record(stream, url, modelname, "ts")
 
 
 class Bigolive(LiveRecoder):
@@ -508,31 +3838,36 @@ class Bigolive(LiveRecoder):
                 modelname = f"{country_code}_{clientBigoId}"
                 if self.name:
                     modelname = self.name
+                from streamlink.stream import HLSStream
+
                 stream = HLSStream(
                     session=self.get_streamlink(), url=response["data"]["hls_src"]
                 )  # HLSStream[mpegts]
-                await asyncio.to_thread(self.run_record, stream, url, modelname, "ts")
+                await self.record(stream, url, modelname, "ts")
 
 
 class Pixivsketch(LiveRecoder):
     async def run(self):
         url = f'https://sketch.pixiv.net/{self.id}'
         if url not in recording:
-            response = (await self.request(
+            response = await self.request_text(
                 method='GET',
-                url=url
-            )).text
+                url=url,
+                done=TextMarkers('<script id="__NEXT_DATA__"', '</script>').feed
+            )
             next_data = json.loads(re.search(r'<script id="__NEXT_DATA__".*?>(.*?)</script>', response)[1])
             initial_state = json.loads(next_data['props']['pageProps']['initialState'])
             if lives := initial_state['live']['lives']:
                 live = list(lives.values())[0]
                 title = live['name']
+                from streamlink.stream import HLSStream
+
                 streams = HLSStream.parse_variant_playlist(
                     session=self.get_streamlink(),
                     url=live['owner']['hls_movie']
                 )
                 stream = list(streams.values())[0]  # HLSStream[mpegts]
-                await asyncio.to_thread(self.run_record, stream, url, title, 'ts')
+                await self.record(stream, url, title, 'ts')
 
 
 class Chaturbate(LiveRecoder):
@@ -557,12 +3892,8 @@ class Chaturbate(LiveRecoder):
                 modelname = self.id
                 if self.name:
                     modelname = self.name
-                streams = HLSStream.parse_variant_playlist(
-                    session=self.get_streamlink(),
-                    url=response['url']
-                )
-                stream = list(streams.values())[2]
-                await asyncio.to_thread(self.run_record, stream, url, modelname, 'ts')
+                if result := await self.race_playlists([response['url']]):
+                    await self.record(self.select_variant(*result), url, modelname, 'ts')
 
 
 class Stripchat(LiveRecoder):
@@ -599,55 +3930,484 @@ class Stripchat(LiveRecoder):
             # logger.info(f"Stream status: {response['user']['user']['status']}")  # 记录流媒体状态
 
             if response["user"]["user"]["isLive"] and response["user"]["user"]["status"] == "public" and server:
-                try:
-                    logger.info(f"trying server {server}")  # 尝试第一个服务器
-                    streams = HLSStream.parse_variant_playlist(self.get_streamlink(), server, headers={'Referer': url})
-                    for s in streams.items():
-                        await asyncio.to_thread(self.run_record, s[1], url, self.id, 'ts')
-                    streams_src = HLSStream.parse_variant_playlist(self.get_streamlink(), server_src, headers={'Referer': url})
-                    for s in streams_src.items():
-                        await asyncio.to_thread(self.run_record, s[1], url, self.id, 'ts')
-                except IOError as err:
-                    try:
-                        logger.info(f"trying fallback server {server0}")  # 尝试备用服务器0
-                        streams0 = HLSStream.parse_variant_playlist(self.get_streamlink(), server0, headers={'Referer': url})
-                        for s in streams0.items():
-                            await asyncio.to_thread(self.run_record, s[1], url, self.id, 'ts')
-                    except IOError as err:
-                        try:
-                            logger.info(f"trying another fallback server {server1}")  # 尝试备用服务器1
-                            streams1 = HLSStream.parse_variant_playlist(self.get_streamlink(), server1, headers={'Referer': url})
-                            for s in streams1.items():
-                                await asyncio.to_thread(self.run_record, s[1], url, self.id, 'ts')
-                        except IOError as err:
-                            logger.info(f"fallback to default stream : {server2}")  # 尝试备用服务器2
-                            stream = HLSStream(self.get_streamlink(), server2)
-                            await asyncio.to_thread(self.run_record, stream, url, self.id, 'ts')
+                # 同时请求所有服务器，使用最先返回的直播源，server2不是主播放列表时直接录制
+                candidates = [server, server_src, server0, server1, server2]
+                if result := await self.race_playlists(candidates, headers={'Referer': url}):
+                    # 录制前连接最快的服务器放入streamlink会话的连接池
+                    await self.preconnect(result[0])
+                    await self.record(self.select_variant(*result, headers={'Referer': url}), url, self.id, 'ts')
+                else:
+                    logger.error(f"{self.flag} 所有直播服务器均无法访问")
 
 
-async def run(config_path):
+def collect_metrics():
+    metrics.set("liverecorder_threads", threading.active_count())
+    metrics.set("liverecorder_recording_streams", len(recording))
+    for name, stats in (
+        ("http_pool", client_pool.stats()),
+        ("scheduler", {k: v for k, v in scheduler.stats().items() if k != "lag"}),
+        ("supervisor", supervisor.stats()),
+        ("streamlink_sessions", session_cache.stats()),
+        ("dns_cache", dns_cache.stats()),
+        ("postprocess", postprocessor.stats()),
+        ("journal", journal.stats()),
+        ("disk_writer", disk_writer.stats()),
+        ("serve", live_server.stats()),
+    ):
+        for key, value in stats.items():
+            metrics.set(f"liverecorder_{name}_{key}", value)
+    for platform_name, lag in scheduler.stats()["lag"].items():
+        metrics.set("liverecorder_scheduler_lag_seconds", lag, platform=platform_name)
+
+
+def group_users(users: List[dict]) -> Dict[Tuple[str, str], dict]:
+    """同一直播间重复出现时合并为一个直播间，之后的配置作为额外的输出，共用一个下载"""
+    grouped = {}
+    for item in users:
+        key = (item["platform"], str(item["id"]))
+        if key in grouped:
+            first = grouped[key]
+            extra = {k: v for k, v in item.items() if k not in ("platform", "id", "outputs")}
+            grouped[key] = {**first, "outputs": [*first.get("outputs", []), extra, *item.get("outputs", [])]}
+        else:
+            grouped[key] = item
+    return grouped
+
+
+class RoomManager:
+    """管理所有直播间的检测任务，配置文件修改或收到SIGHUP信号时只增删改有变化的直播间，不影响正在录制的直播流"""
+
+    def __init__(self, config_path=None, transform: Callable[[dict], dict] = None):
+        self.config_path = config_path
+        # 分片模式下从完整配置中取出当前分片的配置
+        self.transform = transform
+        self.config = {}
+        self.users: Dict[Tuple[str, str], dict] = {}
+        self.tasks: Dict[Tuple[str, str], Tuple[LiveRecoder, asyncio.Task]] = {}
+        self.mtime = self.get_mtime()
+        self.reload_event = asyncio.Event()
+        self.finished = asyncio.Event()
+
+    def get_mtime(self):
+        try:
+            return os.stat(self.config_path).st_mtime_ns if self.config_path else None
+        except OSError:
+            return None
+
+    async def run(self, config: dict):
+        await self.apply(config)
+        watcher = asyncio.create_task(self.watch()) if self.config_path else None
+        try:
+            await self.finished.wait()
+        finally:
+            if watcher:
+                watcher.cancel()
+
+    async def watch(self):
+        if hasattr(signal, "SIGHUP"):
+            asyncio.get_running_loop().add_signal_handler(signal.SIGHUP, self.reload_event.set)
+        while True:
+            interval = self.config.get("config_reload_interval", 10)
+            try:
+                await asyncio.wait_for(self.reload_event.wait(), interval or None)
+            except asyncio.TimeoutError:
+                if self.get_mtime() == self.mtime:
+                    continue
+            self.reload_event.clear()
+            await self.reload()
+
+    async def reload(self):
+        self.mtime = self.get_mtime()
+        try:
+            config = read_config(self.config_path)
+        except (OSError, ValueError) as error:
+            logger.error(f"配置文件加载失败，继续使用当前配置\n{error}")
+            return
+        logger.info("正在重新加载配置文件")
+        try:
+            if self.transform:
+                config = self.transform(config)
+            await self.apply(config)
+        except Exception as error:
+            logger.exception(f"配置文件应用失败\n{repr(error)}")
+
+    async def apply(self, config: dict):
+        users = group_users(config["user"])
+        # 全局配置修改时所有直播间都需要更新
+        global_changed = {k: v for k, v in config.items() if k != "user"} != {
+            k: v for k, v in self.config.items() if k != "user"
+        }
+        self.config = config
+        scheduler.configure(config)
+
+        for key in self.tasks.keys() - users.keys():
+            recorder, task = self.tasks[key]
+            if recorder.stopping:
+                continue
+            if recorder.stop():
+                self.tasks.pop(key)
+                task.cancel()
+                logger.info(f"{recorder.flag} 已从配置文件中删除，停止检测")
+            else:
+                logger.info(f"{recorder.flag} 已从配置文件中删除，当前录制结束后停止检测")
+
+        for key, item in users.items():
+            if key in self.tasks:
+                recorder, _ = self.tasks[key]
+                if recorder.stopping:
+                    recorder.stopping = False
+                    logger.info(f"{recorder.flag} 已重新添加到配置文件，继续检测")
+                if global_changed or item != self.users.get(key):
+                    await recorder.update(config, item)
+            else:
+                recorder = platforms[item["platform"]](config, item)
+                task = asyncio.create_task(recorder.start())
+                task.add_done_callback(lambda task, key=key: self.on_done(key, task))
+                self.tasks[key] = (recorder, task)
+                if self.users:
+                    logger.info(f"{recorder.flag} 已添加到配置文件，开始检测")
+        self.users = users
+
+    def on_done(self, key, task: asyncio.Task):
+        if key in self.tasks and self.tasks[key][1] is task:
+            self.tasks.pop(key)
+        # 监听配置文件时即使没有直播间也继续运行，等待添加新的直播间
+        if not self.tasks and not self.config_path:
+            self.finished.set()
+
+
+class ConfigError(ValueError):
+    pass
+
+
+# 需要检查的配置字段类型，直播间配置中的同名字段使用相同的类型
+config_types = {
+    **dict.fromkeys(
+        (
+            "interval", "segment_time", "segment_size", "reconnect_window", "push_interval", "config_reload_interval",
+            "dns_cache_ttl", "batch_delay", "rate_limit", "rate_burst", "poll_jitter", "min_interval", "max_backoff",
+            "http_keepalive_expiry", "Douyu_js_ttl", "sink_buffer", "serve_buffer", "journal_interval", "write_buffer", "preallocate",
+            "fsync_interval",
+        ),
+        (int, float),
+    ),
+    **dict.fromkeys(
+        (
+            "priority", "max_recordings", "max_queued_recordings", "stream_buffer", "ffmpeg_workers",
+            "ffmpeg_max_attempts", "http_max_keepalive", "http_max_connections_per_host", "batch_size", "metrics_port",
+            "shards", "serve_port", "disk_writers", "dns_cache_size",
+        ),
+        int,
+    ),
+    **dict.fromkeys(("live_remux", "push", "adaptive_interval", "fix_timestamps"), bool),
+    **dict.fromkeys(
+        ("name", "format", "output", "proxy", "cookies", "cache_dir", "metrics_host", "serve_host", "quality", "scratch_dir", "Bilibili_push_url", "Twitch_push_url"),
+        str,
+    ),
+    "headers": dict,
+}
+config_choices = {"engine": ("streamlink", "asyncio"), "shard_by": ("hash", "platform")}
+# 模块名与pip安装包名不同的依赖
+package_names = {"streamlink_cli": "streamlink", "httpx_socks": "httpx-socks[asyncio]"}
+
+
+def check_fields(config: dict, flag) -> List[str]:
+    errors = []
+    for key, value in config.items():
+        if value is None:
+            continue
+        if expected := config_types.get(key):
+            # bool是int的子类，数字字段不接受true/false
+            if not isinstance(value, expected) or (expected is not bool and isinstance(value, bool)):
+                errors.append(f"{flag}配置{key}的类型错误：{value!r}")
+            elif expected in (int, (int, float)) and key != "priority" and value < 0:
+                errors.append(f"{flag}配置{key}不能为负数：{value!r}")
+        if key in config_choices and value not in config_choices[key]:
+            errors.append(f"{flag}配置{key}只能为{'、'.join(config_choices[key])}：{value!r}")
+        if key == "quality" and isinstance(value, str) and not re.fullmatch(r"best|worst|\d+p", value):
+            errors.append(f"{flag}配置quality只能为best、worst或最高分辨率（例如720p）：{value!r}")
+    return errors
+
+
+def validate_config(config: dict):
+    """启动和重新加载配置前检查配置文件，一次性列出所有错误"""
+    if not isinstance(config, dict) or not isinstance(config.get("user"), list):
+        raise ConfigError("配置文件错误：缺少user列表")
+    errors = check_fields({k: v for k, v in config.items() if k != "user"}, "全局")
+    requires = set()
+    seen = set()
+    for index, item in enumerate(config["user"], 1):
+        flag = f"第{index}个直播间"
+        if not isinstance(item, dict):
+            errors.append(f"{flag}配置格式错误：{item!r}")
+            continue
+        platform_name = item.get("platform")
+        if platform_name not in platforms:
+            similar = [name for name in platforms if name.lower() == str(platform_name).lower()]
+            hint = f"，是否为{similar[0]}" if similar else f"，支持的平台：{'、'.join(platforms)}"
+            errors.append(f"{flag}的直播平台{platform_name!r}不存在{hint}")
+            continue
+        if item.get("id") in (None, ""):
+            errors.append(f"{flag}（{platform_name}）缺少id")
+            continue
+        flag = f"{platform_name} {item.get('name') or item['id']} "
+        # 同一直播间可以配置多次以录制到不同的输出，完全相同的配置会写入同一个文件
+        if (key := json.dumps(item, sort_keys=True)) in seen:
+            errors.append(f"{flag}在配置文件中重复")
+        seen.add(key)
+        errors += check_fields(item, flag)
+        outputs = item.get("outputs", [])
+        if not isinstance(outputs, list) or not all(isinstance(extra, dict) for extra in outputs):
+            errors.append(f"{flag}配置outputs的格式错误：{outputs!r}")
+            outputs = []
+        for extra in outputs:
+            errors += check_fields(extra, f"{flag}outputs中")
+        requires.update(platforms[platform_name].requires)
+        proxy = item.get("proxy", config.get(f"{platform_name}_proxy", config.get("proxy")))
+        if isinstance(proxy, str) and "socks" in proxy:
+            requires.add("httpx_socks")
+        # 设置了输出格式时需要ffmpeg封装
+        if any(extra.get("format") or extra.get("live_remux", config.get("live_remux")) for extra in (item, *outputs)):
+            requires.add("ffmpeg")
+    for module in sorted(requires):
+        if importlib.util.find_spec(module) is None:
+            errors.append(f"缺少依赖{module}，请运行pip install {package_names.get(module, module)}")
+    if errors:
+        raise ConfigError("配置文件错误：\n" + "\n".join(errors))
+
+
+def read_config(config_path) -> dict:
     with open(config_path, "r", encoding="utf-8") as f:
         config = json.load(f)
+    validate_config(config)
+    return config
+
+
+async def run(config_path):
+    await run_config(read_config(config_path), config_path)
+
+
+async def run_config(config, config_path=None, transform: Callable[[dict], dict] = None, profile=0):
+    profiler.install(profile)
+    client_pool.configure(config)
+    scheduler.configure(config)
+    supervisor.configure(config)
+    postprocessor.configure(config)
+    disk_writer.configure(config)
+    journal.configure(config)
+    twitch_pubsub.configure(config)
+    dns_cache.configure(config)
+    if metrics_port := config.get("metrics_port"):
+        metrics.add_collector(collect_metrics)
+        await metrics.serve(config.get("metrics_host", "127.0.0.1"), metrics_port)
+    if serve_port := config.get("serve_port"):
+        live_server.configure(config)
+        await live_server.serve(config.get("serve_host", "127.0.0.1"), serve_port)
     try:
-        tasks = []
-        for item in config["user"]:
-            platform_class = globals()[item["platform"]]
-            coro = platform_class(config, item).start()
-            tasks.append(asyncio.create_task(coro))
-        await asyncio.wait(tasks)
+        await RoomManager(config_path, transform).run(config)
+        logger.info(f"HTTP客户端池统计：{client_pool.stats()}")
+        logger.info(f"直播检测调度统计：{scheduler.stats()}")
+        logger.info(f"录制线程池统计：{supervisor.stats()}")
+        logger.info(f"Streamlink会话缓存统计：{session_cache.stats()}")
+        logger.info(f"ffmpeg封装队列统计：{postprocessor.stats()}")
     except (asyncio.CancelledError, KeyboardInterrupt, SystemExit):
         logger.warning("用户中断录制，正在关闭直播流")
         for stream_fd, output in recording.copy().values():
             stream_fd.close()
             output.close()
+    finally:
+        profiler.stop()
+        # 等待录制文件从临时目录移动到输出目录，避免退出时只复制了一部分
+        disk_writer.wait_moved()
+
+
+class ShardSupervisor:
+    """将直播间分配到多个子进程运行，子进程异常退出时自动重启，并汇总日志和状态"""
+
+    restart_delay = 10
+    status_interval = 60
+
+    def __init__(self, config: dict, config_path=None):
+        self.config = config
+        self.config_path = config_path
+        self.shards = config["shards"]
+        self.context = multiprocessing.get_context("spawn")
+        self.queue = self.context.Queue()
+        self.processes: Dict[int, multiprocessing.Process] = {}
+        self.started: Dict[int, float] = {}
+        self.restarts: Dict[int, int] = defaultdict(int)
+        self.status: Dict[int, dict] = {}
+
+    @staticmethod
+    def split(config: dict) -> List[List[dict]]:
+        users = [[] for _ in range(config["shards"])]
+        if config.get("shard_by", "hash") == "platform":
+            groups = defaultdict(list)
+            for item in config["user"]:
+                groups[item["platform"]].append(item)
+            # 直播间多的平台优先分配到直播间最少的分片
+            for group in sorted(groups.values(), key=len, reverse=True):
+                min(users, key=len).extend(group)
+        else:
+            for item in config["user"]:
+                # 使用稳定的哈希，重启和重新加载配置后分配结果不变
+                users[zlib.crc32(f"{item['platform']}:{item['id']}".encode()) % config["shards"]].append(item)
+        return users
+
+    @staticmethod
+    def get_shard_config(config: dict, index) -> dict:
+        shards = ShardSupervisor.split(config)
+        shard_config = dict(config, user=shards[index])
+        # 限速按平台计算，各分片的限速和突发请求数按检测该平台的分片数平分，总限速不随分片数增加
+        for platform_name in {item["platform"] for item in shards[index]}:
+            count = sum(any(item["platform"] == platform_name for item in users) for users in shards)
+            if rate := config.get(f"{platform_name}_rate_limit", config.get("rate_limit")):
+                shard_config[f"{platform_name}_rate_limit"] = rate / count
+            if burst := config.get(f"{platform_name}_rate_burst", config.get("rate_burst")):
+                shard_config[f"{platform_name}_rate_burst"] = burst / count
+        # 各分片使用独立的缓存目录、指标端口和直播转发端口
+        shard_config["cache_dir"] = f"{config.get('cache_dir', 'cache')}/shard{index}"
+        if metrics_port := config.get("metrics_port"):
+            shard_config["metrics_port"] = metrics_port + index + 1
+        # 主进程不录制，直播转发端口从serve_port开始依次分配给各分片
+        if serve_port := config.get("serve_port"):
+            shard_config["serve_port"] = serve_port + index
+        return shard_config
+
+    def start(self, index):
+        # 重启时使用最新的配置文件
+        if self.config_path and index in self.processes:
+            try:
+                self.config = dict(read_config(self.config_path), shards=self.shards)
+            except (OSError, ValueError) as error:
+                logger.error(f"配置文件加载失败，使用之前的配置\n{error}")
+        config = self.get_shard_config(self.config, index)
+        process = self.context.Process(
+            target=run_shard,
+            args=(config, index, self.queue, self.config_path),
+            name=f"shard{index}",
+            daemon=True,
+        )
+        process.start()
+        self.processes[index] = process
+        self.started[index] = time.monotonic()
+        logger.info(f"分片{index}已启动，共{len(config['user'])}个直播间，进程ID：{process.pid}")
+
+    def read_queue(self):
+        while True:
+            kind, index, data = self.queue.get()
+            if kind == "log":
+                logger.opt(raw=True).info(data)
+            elif kind == "status":
+                self.status[index] = data
+
+    def reload(self, *args):
+        # 由各分片重新加载配置文件中属于自己的直播间
+        for process in self.processes.values():
+            if process.is_alive():
+                os.kill(process.pid, signal.SIGHUP)
+
+    def toggle_profile(self, *args):
+        # 主进程不检测直播，由各分片分别进行性能分析
+        for process in self.processes.values():
+            if process.is_alive():
+                os.kill(process.pid, signal.SIGUSR1)
+
+    def run(self):
+        if hasattr(signal, "SIGHUP"):
+            signal.signal(signal.SIGHUP, self.reload)
+        if hasattr(signal, "SIGUSR1"):
+            signal.signal(signal.SIGUSR1, self.toggle_profile)
+        threading.Thread(target=self.read_queue, name="shard-log", daemon=True).start()
+        for index in range(self.shards):
+            self.start(index)
+        last_status = time.monotonic()
+        try:
+            while True:
+                time.sleep(1)
+                for index, process in self.processes.items():
+                    if process.is_alive():
+                        continue
+                    # 避免持续崩溃的分片频繁重启
+                    if time.monotonic() - self.started[index] < self.restart_delay:
+                        continue
+                    self.restarts[index] += 1
+                    logger.error(f"分片{index}异常退出（退出码{process.exitcode}），第{self.restarts[index]}次重启")
+                    self.start(index)
+                if time.monotonic() - last_status >= self.status_interval:
+                    last_status = time.monotonic()
+                    logger.info(f"分片状态：{self.stats()}")
+        except (KeyboardInterrupt, SystemExit):
+            logger.warning("用户中断录制，正在关闭所有分片")
+            for process in self.processes.values():
+                # Windows下Ctrl+C会同时发送到子进程；其他系统下终端的Ctrl+C同样会发送到子进程，
+                # 但只向主进程发送的信号不会，因此仍然转发，子进程只处理第一次SIGINT
+                if process.is_alive() and os.name != "nt":
+                    os.kill(process.pid, signal.SIGINT)
+            for process in self.processes.values():
+                process.join(timeout=30)
+                if process.is_alive():
+                    process.terminate()
+
+    def stats(self):
+        return {
+            index: dict(self.status.get(index, {}), alive=process.is_alive(), restarts=self.restarts[index])
+            for index, process in self.processes.items()
+        }
+
+
+def run_shard(config, index, shard_queue, config_path=None):
+    logger.remove()
+    logger.add(
+        sink=lambda message: shard_queue.put(("log", index, str(message))),
+        level="INFO",
+        format=f"[{{time:YYYY-MM-DD HH:mm:ss}}][shard{index}][{{level}}][{{function}}:{{line}}]{{message}}",
+    )
+
+    async def report_status():
+        while True:
+            shard_queue.put(("status", index, {
+                "recording": len(recording),
+                "scheduler": {k: v for k, v in scheduler.stats().items() if k != "lag"},
+                "supervisor": supervisor.stats(),
+            }))
+            await asyncio.sleep(10)
+
+    async def main():
+        task = asyncio.create_task(report_status())
+        if os.name != "nt":
+            # 第一次SIGINT时开始关闭，之后主进程转发的SIGINT不再打断关闭过程，避免丢失缓冲写入和临时文件的移动
+            main_task = asyncio.current_task()
+            loop = asyncio.get_running_loop()
+
+            def interrupt():
+                loop.remove_signal_handler(signal.SIGINT)
+                loop.add_signal_handler(signal.SIGINT, lambda: None)
+                main_task.cancel()
+
+            loop.add_signal_handler(signal.SIGINT, interrupt)
+        try:
+            # 分片数量修改后需要重启程序才能生效
+            shards = config["shards"]
+            await run_config(config, config_path, lambda new: ShardSupervisor.get_shard_config(dict(new, shards=shards), index))
+        finally:
+            task.cancel()
+
+    try:
+        asyncio.run(main())
+    except KeyboardInterrupt:
+        pass
 
 
 if __name__ == "__main__":
+    import argparse
     import sys
-    if len(sys.argv) != 2:
-        print("Usage: python live_recorder.py <config_file>")
-        sys.exit(1)
-    config_path = sys.argv[1]
+    multiprocessing.freeze_support()
+    parser = argparse.ArgumentParser(description="LiveRecorder")
+    parser.add_argument("config_file")
+    parser.add_argument("--profile", type=float, default=0, metavar="SECONDS", help="启动后进行性能分析的秒数")
+    args = parser.parse_args()
+    config_path = args.config_file
     logger.add(
         sink="logs/log_{time:YYYY-MM-DD}.log",
         rotation="00:00",
@@ -656,4 +4416,12 @@ if __name__ == "__main__":
         encoding="utf-8",
         format="[{time:YYYY-MM-DD HH:mm:ss}][{level}][{name}][{function}:{line}]{message}",
     )
-    asyncio.run(run(config_path))
+    try:
+        config = read_config(config_path)
+    except (OSError, ValueError) as error:
+        logger.error(f"配置文件加载失败\n{error}")
+        sys.exit(1)
+    if config.get("shards", 1) > 1:
+        ShardSupervisor(config, config_path).run()
+    else:
+        asyncio.run(run_config(config, config_path, profile=args.profile))